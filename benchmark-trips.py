@@ -7,16 +7,15 @@ from valhalla.utils import decode_polyline
 from common.models import Trajectory, CompoundTrajectory
 from geo.mapping import map_match
 from geo.math import num_haversine
-from valhalla import get_config, Actor
-from common.mapspeed import get_all_trips, get_trip_signals, get_edge_times, update_dt_and_speed
+from geo.matching import get_worker_actor
+from common.mapspeed import get_all_trips, get_trip_signals, update_dt_and_speed, EdgeTimeModel
 
 SAMPLE_SIZE = 1000
 
 
 def main():
-    config = get_config(tile_extract='./valhalla/custom_files/valhalla_tiles.tar', verbose=True)
-
     all_trips = get_all_trips()
+    model = EdgeTimeModel.load()
 
     # samples = random.sample(all_trips, SAMPLE_SIZE)
 
@@ -31,7 +30,7 @@ def main():
                                 lon=lon_array,
                                 time=signal_df["time_stamp"].to_numpy())
 
-        actor = Actor(config=config)
+        actor = get_worker_actor()
         try:
             encoded_line = map_match(actor, list(zip(lon_array, lat_array)))
         except RuntimeError as e:
@@ -48,11 +47,14 @@ def main():
         trip_time_min, trip_time_avg, trip_time_med, trip_time_max  = 0.0, 0.0, 0.0, 0.0
         min_speed, avg_speed, med_speed, max_speed = 0.0, 0.0, 0.0, 0.0
         total_samples = 0
-        for i in range(converted.dt.shape[0]):
-            h3_ini = h3.geo_to_h3(converted.lat[i], converted.lon[i], 15)
-            h3_end = h3.geo_to_h3(converted.lat[i+1], converted.lon[i+1], 15)
 
-            min_dt, avg_dt, med_dt, max_dt, sample_count = get_edge_times(h3_ini, h3_end, traj_id)
+        h3_cells = np.array([h3.geo_to_h3(lat, lon, 15) for lat, lon in zip(converted.lat, converted.lon)],
+                            dtype=np.int64)
+        edge_times = model.get_edge_times(h3_cells[:-1], h3_cells[1:], traj_id)
+
+        for i in range(converted.dt.shape[0]):
+            min_dt, avg_dt, med_dt, max_dt = [float(times[i]) for times in edge_times[:4]]
+            sample_count = int(edge_times[4][i])
 
             d = float(distances[i])
             if sample_count == 0:
@@ -1,9 +1,11 @@
+import argparse
 import numpy as np
 
 from tqdm import tqdm
 from db.api import EVedDb
-from geo.math import vec_bearings
-from pyquadkey2 import quadkey
+from geo.math import vec_bearings, bearing_sectors
+from geo.qk import vec_geo_to_qk
+from tools import parallel_imap
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
@@ -89,25 +91,29 @@ def get_trip_locations(vehicle_id, trip_id):
     return locations
 
 
+def get_sector(bearing):
+    return int(bearing_sectors(np.array([bearing]))[0])
+
+
 def update_bearing_ini(db, bearing, vehicle_id, trip_id, time_stamp):
-    sql = """update signal set bearing = ? 
+    sql = """update signal set bearing = ?, sector = ? 
              where vehicle_id = ? and trip_id = ? and time_stamp <= ?
           """
-    db.execute_sql(sql, [bearing, vehicle_id, trip_id, time_stamp])
+    db.execute_sql(sql, [bearing, get_sector(bearing), vehicle_id, trip_id, time_stamp])
 
 
 def update_bearing_end(db, bearing, vehicle_id, trip_id, time_stamp):
-    sql = """update signal set bearing = ? 
+    sql = """update signal set bearing = ?, sector = ? 
              where vehicle_id = ? and trip_id = ? and time_stamp >= ?
           """
-    db.execute_sql(sql, [bearing, vehicle_id, trip_id, time_stamp])
+    db.execute_sql(sql, [bearing, get_sector(bearing), vehicle_id, trip_id, time_stamp])
 
 
 def update_bearing_mid(db, bearing, vehicle_id, trip_id, ts0, ts1):
-    sql = """update signal set bearing = ? 
+    sql = """update signal set bearing = ?, sector = ? 
              where vehicle_id = ? and trip_id = ? and time_stamp > ? and time_stamp <= ?
           """
-    db.execute_sql(sql, [bearing, vehicle_id, trip_id, ts0, ts1])
+    db.execute_sql(sql, [bearing, get_sector(bearing), vehicle_id, trip_id, ts0, ts1])
 
 
 def update_quadkeys(db, vehicle_id, trip_id, locations, level=20):
@@ -115,8 +121,11 @@ def update_quadkeys(db, vehicle_id, trip_id, locations, level=20):
     update signal set quadkey = ?
     where  vehicle_id = ? and trip_id = ? and match_latitude = ? and match_longitude = ?
     """
-    updates = [(quadkey.from_geo((p[0], p[1]), level).to_quadint() >> (64 - 2 * level),
-                vehicle_id, trip_id, p[0], p[1]) for p in locations]
+    lats = np.array([p[0] for p in locations], dtype=np.float64)
+    lons = np.array([p[1] for p in locations], dtype=np.float64)
+    quadkeys = vec_geo_to_qk(lats, lons, level)
+    updates = [(qk, vehicle_id, trip_id, p[0], p[1])
+               for qk, p in zip(quadkeys.tolist(), locations)]
     db.execute_sql(sql, updates, many=True)
 
 
@@ -139,10 +148,147 @@ def process_trip(vehicle_id, trip_id):
             update_bearing_mid(db, bearings[i-1], vehicle_id, trip_id, locations[i-1][2], locations[i][2])
 
 
+def load_trip_signals(db, vehicle_id, trip_id):
+    sql = """
+    select   signal_id
+    ,        match_latitude
+    ,        match_longitude
+    ,        time_stamp
+    from     signal
+    where    vehicle_id = ? and trip_id = ?
+    order by time_stamp
+    """
+    rows = db.query(sql, (vehicle_id, trip_id))
+    signal_ids = np.array([r[0] for r in rows], dtype=np.int64)
+    lats = np.array([r[1] for r in rows], dtype=np.float64)
+    lons = np.array([r[2] for r in rows], dtype=np.float64)
+    time_stamps = np.array([r[3] for r in rows], dtype=np.int64)
+    return signal_ids, lats, lons, time_stamps
+
+
+def calculate_signal_bearings(lats, lons, time_stamps):
+    """
+    Calculates the bearing of every signal of a trip, with the same semantics
+    as the per-trip updates: each distinct location is stamped with its latest
+    time stamp, and every signal gets the bearing of the location pair whose
+    time interval contains it.
+    :param lats: Signal latitudes sorted by time stamp
+    :param lons: Signal longitudes sorted by time stamp
+    :param time_stamps: Sorted signal time stamps
+    :return: Array of bearings, or None if the trip has less than three
+        distinct locations
+    """
+    locations, inverse = np.unique(np.column_stack((lats, lons)), axis=0,
+                                   return_inverse=True)
+    if locations.shape[0] <= 2:
+        return None
+
+    location_ts = np.full(locations.shape[0], np.iinfo(np.int64).min)
+    np.maximum.at(location_ts, inverse.ravel(), time_stamps)
+
+    order = np.argsort(location_ts, kind="stable")
+    location_ts = location_ts[order]
+    bearings = vec_bearings(locations[order, 0], locations[order, 1])
+
+    index = np.searchsorted(location_ts, time_stamps, side="left") - 1
+    index = np.clip(index, 0, bearings.shape[0] - 1)
+    return bearings[index]
+
+
+TRIP_SIGNAL_COLUMNS = ["signal_id", "match_latitude", "match_longitude", "time_stamp"]
+
+
+def calculate_trip_updates(vehicle_id, trip_id, level=20, signals=None):
+    """
+    Worker function: reads the trip signals once and computes the bearing and
+    quadkey of every signal
+    :param signals: Trip signal arrays from EVedDb.iterate_trips, with the
+        TRIP_SIGNAL_COLUMNS, instead of querying the trip
+    :return: List of (bearing, sector, quadkey, signal_id) tuples
+    """
+    if signals is None:
+        signal_ids, lats, lons, time_stamps = load_trip_signals(EVedDb(), vehicle_id, trip_id)
+    else:
+        signal_ids, lats, lons, time_stamps = [signals[column] for column in TRIP_SIGNAL_COLUMNS]
+    if signal_ids.shape[0] == 0:
+        return []
+
+    quadkeys = vec_geo_to_qk(lats, lons, level)
+    bearings = calculate_signal_bearings(lats, lons, time_stamps)
+    if bearings is None:
+        bearings = sectors = [None] * signal_ids.shape[0]
+    else:
+        sectors = bearing_sectors(bearings).tolist()
+        bearings = bearings.tolist()
+    return list(zip(bearings, sectors, quadkeys.tolist(), signal_ids.tolist()))
+
+
+def update_signals(db, updates):
+    sql = """
+    update signal 
+    set    bearing = ?
+    ,      sector = ?
+    ,      quadkey = ?
+    where  signal_id = ?
+    """
+    db.execute_sql(sql, updates, many=True)
+
+
+def prepare_signal_sectors(db):
+    """
+    Adds the sector column to signal tables created before it existed
+    """
+    if db.table_has_column("signal", "sector") is None:
+        db.execute_sql("alter table signal add column sector INTEGER;")
+
+
+def create_sector_index(db):
+    sql = "create index if not exists ix_signal_quadkey_sector on signal (quadkey, sector, week_day, day_slot);"
+    db.execute_sql(sql)
+
+
+def process_trips(n_jobs=16, batch_size=500_000):
+    """
+    Computes the trip updates in worker processes and writes them from this
+    process only, in large transactions keyed on signal_id. The trips are
+    read in a single scan of the signal table, on the same connection as
+    the updates, and handed to the workers as arrays.
+    """
+    with EVedDb(persistent=True) as db:
+        db.set_pragmas({"synchronous": "OFF"})
+        trip_args = ({"vehicle_id": vehicle_id, "trip_id": trip_id, "signals": signals}
+                     for vehicle_id, trip_id, signals in db.iterate_trips(TRIP_SIGNAL_COLUMNS))
+        results = parallel_imap(calculate_trip_updates, trip_args,
+                                n_jobs=n_jobs, use_kwargs=True)
+
+        batch = []
+        for updates in tqdm(results):
+            batch.extend(updates)
+            if len(batch) >= batch_size:
+                with db.transaction():
+                    update_signals(db, batch)
+                batch = []
+        if len(batch):
+            with db.transaction():
+                update_signals(db, batch)
+
+
 def main():
-    trips = get_trips()
-    trip_args = [{"vehicle_id": p[0], "trip_id": p[1]} for p in trips]
-    parallel_process(trip_args, process_trip, use_kwargs=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--per-trip", action="store_true",
+                        help="Use the original per-trip UPDATE statements")
+    args = parser.parse_args()
+
+    db = EVedDb()
+    prepare_signal_sectors(db)
+
+    if args.per_trip:
+        trip_args = [{"vehicle_id": p[0], "trip_id": p[1]} for p in get_trips()]
+        parallel_process(trip_args, process_trip, use_kwargs=True)
+    else:
+        process_trips()
+
+    create_sector_index(db)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,11 @@
-import json
-import os
-
 import numpy as np
-import osmnx as ox
 
 from geo.road import RoadNetwork, download_road_network_bbox
+from geo.hmm import HmmMatcher
 from geo.trajectory import load_trajectory_points
 from geo.math import vec_haversine
 from db.api import EVedDb
-from itertools import pairwise
+from db.queue import WorkQueue
 
 
 def download_network(delta=0.5):
@@ -36,98 +33,80 @@ def get_trajectories():
     return [p[0] for p in db.query(sql)]
 
 
-def match_edges(road_network, trajectory):
-    edges = []
-    unique_locations = set()
-    edge_set = set()
-    for p in trajectory:
-        if p not in unique_locations:
-            e = road_network.get_matching_edge(*p, min_r=1.0)
-            if e is not None:
-                n0, n1, _ = e
-                edge = (n0, n1)
-                if edge not in edge_set:
-                    edge_set.add(edge)
-                    edges.append(edge)
-                unique_locations.add(p)
-    return edges
-
-
-def build_path(rn, edges):
+def get_path_nodes(edges):
     path = []
-    for e0, e1 in pairwise(edges):
-        if not len(path):
-            path.append(e0[0])
-        if e0[0] != e1[0] and e0[1] != e1[1]:
-            if e0[1] == e1[0]:
-                path.extend([e0[1], e1[1]])
-            else:
-                n0, n1 = int(e0[1]), int(e1[0])
-                sp = ox.distance.shortest_path(rn, n0, n1)
-                if sp is not None:
-                    path.extend(sp[1:])
+    for u, v in edges:
+        if not len(path) or path[-1] != u:
+            path.append(u)
+        path.append(v)
     return path
 
 
-def calculate_difference(rn, path, trajectory):
-    p_loc = np.array([(rn.nodes[n]['y'], rn.nodes[n]['x']) for n in path])
+def calculate_difference(rn, segments, trajectory):
+    """
+    Difference between the matched path and the trajectory lengths, summed
+    over the matched segments so the gaps between them are not counted
+    """
     t_loc = np.array([(t[0], t[1]) for t in trajectory])
+    diff = 0.0
+    for edges, _, (first, last) in segments:
+        path = get_path_nodes(edges)
+        p_loc = np.array([(rn.nodes[n]['y'], rn.nodes[n]['x']) for n in path])
+        s_loc = t_loc[first:last + 1]
 
-    p_length = vec_haversine(p_loc[1:, 0], p_loc[1:, 1],
-                             p_loc[:-1, 0], p_loc[:-1, 1]).sum()
-    t_length = vec_haversine(t_loc[1:, 0], t_loc[1:, 1],
-                             t_loc[:-1, 0], t_loc[:-1, 1]).sum()
-    return p_length - t_length
-
-
-def save_state(state, filename="./state.json"):
-    with open(filename, "w") as f:
-        f.write(json.dumps(state))
+        p_length = vec_haversine(p_loc[1:, 0], p_loc[1:, 1],
+                                 p_loc[:-1, 0], p_loc[:-1, 1]).sum()
+        t_length = vec_haversine(s_loc[1:, 0], s_loc[1:, 1],
+                                 s_loc[:-1, 0], s_loc[:-1, 1]).sum()
+        diff += p_length - t_length
+    return diff
 
 
-def load_state(filename="./state.json"):
-    if os.path.isfile(filename):
-        with open(filename, "r") as f:
-            text = f.read()
-            return json.loads(text)
-    else:
-        return None
-
-
-def process_trajectories():
+def process_trajectories(batch_size=100, stale_timeout=600.0):
     rn = download_network()
-    road_network = RoadNetwork(rn)
-
-    state = load_state()
-    if state is None:
-        state = {
-            "trajectories": get_trajectories(),
-            "errors": []
-        }
-
-    save_counter = 0
-    trajectories = state["trajectories"]
-    while len(trajectories) > 0:
-        trajectory_id = trajectories[0]
-        trajectory = load_trajectory_points(trajectory_id,
-                                            unique=True)
-        if len(trajectory) > 3:
-            edges = match_edges(road_network, trajectory)
-            path = build_path(rn, edges)
-
-            if len(path) > 0:
-                diff = calculate_difference(rn, path, trajectory)
-                print(f"Trajectory: {trajectory_id}, Difference: {diff}")
-                state["errors"].append((trajectory_id, diff))
-
-        trajectories = trajectories[1:]
-        state["trajectories"] = trajectories
-
-        save_counter += 1
-        if save_counter % 100 == 0:
-            save_state(state)
-
-    save_state(state)
+    road_network = RoadNetwork(rn, spoke_path="./db/ann-arbor-matches.spoke")
+    matcher = HmmMatcher(road_network)
+
+    db = EVedDb(persistent=True)
+    queue = WorkQueue(db, "calculate-matches")
+    queue.populate(get_trajectories())
+    queue.requeue(older_than=stale_timeout)
+
+    for batch in queue.iterate(batch_size, older_than=stale_timeout):
+        points = [load_trajectory_points(trajectory_id, unique=True)
+                  for trajectory_id in batch]
+        locations = [np.array([(p[0], p[1]) for p in trajectory]) if len(trajectory) > 3
+                     else np.zeros((0, 2)) for trajectory in points]
+
+        try:
+            matches = matcher.match_batch(locations)
+        except Exception as e:
+            # Match the trajectories one at a time, so only the failing
+            # ones are marked in error
+            print(e)
+            matches = [None] * len(batch)
+
+        done, diffs, errors = [], [], []
+        for trajectory_id, trajectory, location, segments in zip(batch, points, locations, matches):
+            try:
+                if segments is None:
+                    segments = matcher.match_batch([location])[0]
+                diff = None
+                if len(segments) > 0:
+                    diff = calculate_difference(rn, segments, trajectory)
+                    print(f"Trajectory: {trajectory_id}, Difference: {diff}")
+            except Exception as e:
+                errors.append((trajectory_id, str(e)))
+                print(e)
+            else:
+                done.append(trajectory_id)
+                diffs.append(diff)
+
+        with db.transaction():
+            for trajectory_id, error in errors:
+                queue.fail(trajectory_id, error)
+            queue.complete(done, diffs)
+    db.close()
 
 
 def main():
@@ -0,0 +1,28 @@
+from geo.minhash import MinHashIndex
+from geo.qkset import QuadkeySetStore
+from geo.trajectory import load_all_trajectory_quadkeys
+
+
+MINHASH_FILE = "./db/traj-minhash.npz"
+QK_SET_FOLDER = "./db/traj-qk-sets"
+
+
+def main():
+    """
+    Builds the trajectory similarity structures from a single pass over
+    the trajectory quadkeys: the MinHash index and the encoded quadkey sets
+    """
+    traj_ids, offsets, quadkeys = load_all_trajectory_quadkeys()
+    print(f"Loaded {quadkeys.shape[0]} quadkeys of {traj_ids.shape[0]} trajectories")
+
+    index = MinHashIndex.build(traj_ids, offsets, quadkeys)
+    index.save(MINHASH_FILE)
+    print(f"Saved {index.signatures.shape} signatures to {MINHASH_FILE}")
+
+    store = QuadkeySetStore.build(traj_ids, offsets, quadkeys)
+    store.save(QK_SET_FOLDER)
+    print(f"Saved {store.data.shape[0]} bytes of quadkey sets to {QK_SET_FOLDER}")
+
+
+if __name__ == "__main__":
+    main()
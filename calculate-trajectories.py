@@ -1,20 +1,19 @@
+import argparse
+import numpy as np
+
 from db.api import EVedDb
-from pyquadkey2 import quadkey
 from itertools import pairwise
 from tqdm import tqdm
-from raster.drawing import smooth_line
-from geo.qk import tile_to_str
-
+from geo.math import BEARING_SECTORS, bearing_sectors
+from geo.qk import vec_line_to_qk
+from geo.trajectory import LINK_QK_LEVEL, load_link_postings
+from tools import parallel_imap
 
-def get_qk_line(loc0, loc1, level):
-    qk0 = quadkey.from_geo((loc0[0], loc0[1]), level)
-    qk1 = quadkey.from_geo((loc1[0], loc1[1]), level)
 
-    ((tx0, ty0), _) = qk0.to_tile()
-    ((tx1, ty1), _) = qk1.to_tile()
+POSTINGS_FOLDER = "./db/link-postings"
 
-    line = smooth_line(tx0, ty0, tx1, ty1)
-    return [(quadkey.from_str(tile_to_str(int(p[0]), int(p[1]), int(level))), p[2]) for p in line if p[2] > 0.0]
+# Coarser levels of the link_qk_count pyramid
+PYRAMID_LEVELS = list(range(10, LINK_QK_LEVEL + 1))
 
 
 def create_trajectory_table():
@@ -36,7 +35,8 @@ def create_link_table():
         traj_id    INTEGER NOT NULL,
         signal_ini INTEGER NOT NULL,
         signal_end INTEGER NOT NULL,
-        bearing    DOUBLE  NOT NULL
+        bearing    DOUBLE  NOT NULL,
+        sector     INTEGER NOT NULL
     );
     """
     db = EVedDb()
@@ -49,13 +49,54 @@ def create_link_quadkey_table():
         lqk_id  INTEGER PRIMARY KEY AUTOINCREMENT,
         link_id INTEGER NOT NULL,
         quadkey INTEGER NOT NULL,
-        density DOUBLE  NOT NULL
+        density DOUBLE  NOT NULL,
+        sector  INTEGER NOT NULL
+    );
+    """
+    db = EVedDb()
+    db.execute_sql(sql)
+
+
+def create_link_quadkey_count_table():
+    sql = """
+    CREATE TABLE IF NOT EXISTS link_qk_count (
+        level      INTEGER NOT NULL,
+        quadkey    INTEGER NOT NULL,
+        link_count INTEGER NOT NULL,
+        traj_count INTEGER NOT NULL,
+        PRIMARY KEY (level, quadkey)
     );
     """
     db = EVedDb()
     db.execute_sql(sql)
 
 
+def populate_link_quadkey_counts(levels=None):
+    """
+    Fills the link_qk_count pyramid with the number of links and
+    trajectories under each quadkey of the given levels. A level's quadkeys
+    are the link_qk quadkeys shifted right by two bits per level.
+    """
+    print("Populate link quadkey counts")
+
+    levels = PYRAMID_LEVELS if levels is None else levels
+    sql = """
+    insert into link_qk_count (level, quadkey, link_count, traj_count)
+    select     ?
+    ,          q.quadkey >> ? as parent
+    ,          count(distinct q.link_id)
+    ,          count(distinct l.traj_id)
+    from       link_qk q
+    inner join link l on l.link_id = q.link_id
+    group by   parent;
+    """
+    with EVedDb(persistent=True) as db:
+        with db.transaction():
+            db.execute_sql("delete from link_qk_count;")
+            for level in tqdm(levels):
+                db.execute_sql(sql, [level, 2 * (LINK_QK_LEVEL - level)])
+
+
 def create_indices():
     sql_script = ["CREATE INDEX ix_link_qk_quadkey ON link_qk (quadkey ASC);",
                   "CREATE INDEX ix_link_traj ON link (traj_id ASC);",
@@ -65,6 +106,45 @@ def create_indices():
 
     for sql in sql_script:
         db.execute_sql(sql)
+    create_sector_index(db)
+
+
+def create_sector_index(db):
+    """
+    Creates the (quadkey, sector) index on link_qk. The link sector is
+    copied into link_qk so that bearing-filtered probes only read the index
+    entries of the neighbouring sectors.
+    """
+    sql = "CREATE INDEX IF NOT EXISTS ix_link_qk_quadkey_sector ON link_qk (quadkey, sector, link_id);"
+    db.execute_sql(sql)
+
+
+def add_link_sectors(sectors=BEARING_SECTORS):
+    """
+    Adds and fills the sector columns of existing link and link_qk tables.
+    Links without a bearing get sector -1.
+    """
+    print("Add link sectors")
+
+    width = 360.0 / sectors
+    with EVedDb(persistent=True) as db:
+        with db.transaction():
+            for table in ["link", "link_qk"]:
+                if db.table_has_column(table, "sector") is None:
+                    db.execute_sql(f"ALTER TABLE {table} ADD COLUMN sector INTEGER NOT NULL DEFAULT -1;")
+
+            sql = """
+            update link
+            set    sector = case when bearing >= 0 then cast((bearing + ?) / ? as integer) % ? else -1 end
+            """
+            db.execute_sql(sql, [width / 2.0, width, sectors])
+
+            sql = """
+            update link_qk
+            set    sector = (select l.sector from link l where l.link_id = link_qk.link_id)
+            """
+            db.execute_sql(sql)
+        create_sector_index(db)
 
 
 def populate_trajectories():
@@ -91,7 +171,7 @@ def load_trajectories():
     return db.query(sql)
 
 
-def load_trajectory_points(vehicle_id, trip_id):
+def load_trajectory_points(db, vehicle_id, trip_id):
     sql = """
     select   max(signal_id)
     ,        match_latitude
@@ -102,67 +182,179 @@ def load_trajectory_points(vehicle_id, trip_id):
     group by match_latitude, match_longitude, bearing
     order by signal_id;
     """
-    db = EVedDb()
     return db.query(sql, [vehicle_id, trip_id])
 
 
-def insert_link(traj_id, signal_ini, signal_end, bearing):
+TRAJECTORY_SIGNAL_COLUMNS = ["signal_id", "match_latitude", "match_longitude", "bearing"]
+
+
+def group_trajectory_points(signals):
+    """
+    Groups streamed trip signals like load_trajectory_points does: one point
+    per distinct location and bearing, with its latest signal id, sorted by
+    that id
+    :param signals: Trip signal arrays from EVedDb.iterate_trips, with the
+        TRAJECTORY_SIGNAL_COLUMNS
+    :return: List of (signal_id, latitude, longitude, bearing) tuples, with
+        a None bearing where the signals have none
+    """
+    bearings = np.nan_to_num(signals["bearing"], nan=-1.0)
+    keys = np.column_stack((signals["match_latitude"], signals["match_longitude"], bearings))
+    points, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+    signal_ids = np.full(points.shape[0], np.iinfo(np.int64).min)
+    np.maximum.at(signal_ids, inverse.ravel(), signals["signal_id"])
+
+    order = np.argsort(signal_ids)
+    return [(signal_id, lat, lon, None if bearing < 0.0 else bearing)
+            for signal_id, (lat, lon, bearing) in zip(signal_ids[order].tolist(), points[order].tolist())]
+
+
+def insert_links(db, links):
     sql = """
     insert into link 
-        (traj_id, signal_ini, signal_end, bearing) 
+        (link_id, traj_id, signal_ini, signal_end, bearing, sector) 
     values 
-        (?, ?, ?, ifnull(?, -1.0))
+        (?, ?, ?, ?, ?, ?)
     """
-    db = EVedDb()
-    db.execute_sql(sql, [traj_id, signal_ini, signal_end, bearing])
-    return db.query_scalar("select seq from sqlite_sequence where name = 'link';")
+    db.execute_sql(sql, parameters=links, many=True)
 
 
-def insert_link_quadkeys(link_quadkey_density_list):
+def insert_link_quadkeys(db, link_quadkey_density_list):
     sql = """
     insert into link_qk 
-        (link_id, quadkey, density) 
+        (link_id, quadkey, density, sector) 
     values 
-        (?, ?, ?)
+        (?, ?, ?, ?)
     """
-    db = EVedDb()
     db.execute_sql(sql, parameters=link_quadkey_density_list, many=True)
 
 
-def populate_links(level=20):
+def get_next_link_id(db):
+    link_id = db.query_scalar("select max(link_id) from link;")
+    return 1 if link_id is None else link_id + 1
+
+
+worker_db = None
+
+
+def get_worker_db():
+    global worker_db
+    if worker_db is None:
+        worker_db = EVedDb(persistent=True)
+    return worker_db
+
+
+def build_trajectory_links(traj_id, vehicle_id, trip_id, level=LINK_QK_LEVEL, signals=None):
+    """
+    Worker function: builds all the links of a trajectory and their
+    rasterized quadkeys, numbering the links locally from zero
+    :param signals: Trip signal arrays from EVedDb.iterate_trips, with the
+        TRAJECTORY_SIGNAL_COLUMNS, instead of querying the trip
+    :return: Tuple with the trajectory id, the list of
+        (signal_ini, signal_end, bearing, sector) links and the list of
+        (link index, quadkey, density, sector) tuples
+    """
+    if signals is None:
+        points = load_trajectory_points(get_worker_db(), vehicle_id, trip_id)
+    else:
+        points = group_trajectory_points(signals)
+
+    bearings = np.array([-1.0 if p[3] is None else p[3] for p in points[1:]], dtype=np.float64)
+    sectors = np.where(bearings >= 0.0, bearing_sectors(np.maximum(bearings, 0.0)), -1)
+    links = [(p0[0], p1[0], bearing, sector)
+             for (p0, p1), bearing, sector in zip(pairwise(points), bearings.tolist(), sectors.tolist())]
+
+    lats = np.array([p[1] for p in points], dtype=np.float64)
+    lons = np.array([p[2] for p in points], dtype=np.float64)
+    segments, qks, densities = vec_line_to_qk(lats, lons, level)
+    link_qks = list(zip(segments.tolist(), qks.tolist(), densities.tolist(), sectors[segments].tolist()))
+    return traj_id, links, link_qks
+
+
+def populate_links(level=LINK_QK_LEVEL, n_jobs=16, batch_size=500):
+    """
+    Builds the link and link_qk tables. The trajectories are read in a
+    single scan of the signal table and processed in worker processes,
+    while this process assigns the link identifiers and writes batch_size
+    trajectories per transaction.
+    :param level: Detail level of the link quadkeys. The trajectory queries
+        expect LINK_QK_LEVEL, and reach coarser levels by quadkey ranges.
+    """
     print("Populate links")
 
-    shift = 64 - 2 * level
+    traj_ids = {(vehicle_id, trip_id): traj_id for traj_id, vehicle_id, trip_id in load_trajectories()}
+
+    with EVedDb(persistent=True) as db:
+        db.set_pragmas({"synchronous": "OFF"})
+        args = ({"traj_id": traj_ids[(vehicle_id, trip_id)], "vehicle_id": vehicle_id, "trip_id": trip_id,
+                 "level": level, "signals": signals}
+                for vehicle_id, trip_id, signals in db.iterate_trips(TRAJECTORY_SIGNAL_COLUMNS)
+                if (vehicle_id, trip_id) in traj_ids)
+        results = parallel_imap(build_trajectory_links, args,
+                                n_jobs=n_jobs, use_kwargs=True)
 
-    trajectories = load_trajectories()
+        link_id = get_next_link_id(db)
+        links, link_qks = [], []
+        for i, (traj_id, traj_links, traj_link_qks) in enumerate(tqdm(results, total=len(traj_ids))):
+            links.extend([(link_id + j, traj_id, signal_ini, signal_end, bearing, sector)
+                          for j, (signal_ini, signal_end, bearing, sector) in enumerate(traj_links)])
+            link_qks.extend([(link_id + j, qk, density, sector)
+                             for j, qk, density, sector in traj_link_qks])
+            link_id += len(traj_links)
 
-    for traj_id, vehicle_id, trip_id in tqdm(trajectories):
-        points = load_trajectory_points(vehicle_id, trip_id)
+            if (i + 1) % batch_size == 0:
+                with db.transaction():
+                    insert_links(db, links)
+                    insert_link_quadkeys(db, link_qks)
+                links, link_qks = [], []
 
-        if len(points) > 1:
-            for p0, p1 in pairwise(points):
-                signal_ini = p0[0]
-                signal_end = p1[0]
-                bearing = p1[3]
-                link_id = insert_link(traj_id, signal_ini, signal_end, bearing)
+        with db.transaction():
+            insert_links(db, links)
+            insert_link_quadkeys(db, link_qks)
 
-                loc0 = (p0[1], p0[2])
-                loc1 = (p1[1], p1[2])
-                line = get_qk_line(loc0, loc1, level)
 
-                params = [(link_id, pt[0].to_quadint() >> shift, pt[1]) for pt in line]
-                insert_link_quadkeys(params)
+def save_link_postings():
+    print("Save link postings")
+    postings = load_link_postings()
+    postings.save(POSTINGS_FOLDER)
+    print(f"Saved {postings.link_ids.shape[0]} postings of {postings.qk_keys.shape[0]} quadkeys to {POSTINGS_FOLDER}")
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--add-sectors", action="store_true",
+                        help="Only add the bearing sectors to existing link tables")
+    parser.add_argument("--postings", action="store_true",
+                        help="Only save the link posting lists of existing link tables")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="Only rebuild the quadkey counts of existing link tables")
+    args = parser.parse_args()
+
+    if args.add_sectors:
+        add_link_sectors()
+        return
+
+    if args.postings:
+        save_link_postings()
+        return
+
+    if args.pyramid:
+        create_link_quadkey_count_table()
+        populate_link_quadkey_counts()
+        return
+
     create_trajectory_table()
     create_link_table()
     create_link_quadkey_table()
+    create_link_quadkey_count_table()
 
     populate_trajectories()
     populate_links()
 
     create_indices()
+    populate_link_quadkey_counts()
+    save_link_postings()
 
 
 if __name__ == "__main__":
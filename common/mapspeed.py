@@ -1,12 +1,12 @@
 import numpy as np
 import pandas as pd
 
-from numba import njit
+from numba import njit, prange
 from db.api import SpeedDb, EVedDb
 from typing import List, Tuple
 
 
-def get_all_trips() -> List[(int, int, int)]:
+def get_all_trips() -> List[Tuple[int, int, int]]:
     db = EVedDb()
     sql = "SELECT traj_id, vehicle_id, trip_id FROM trajectory"
     return db.query(sql)
@@ -37,33 +37,724 @@ def get_edge_speeds(h3_ini: int, h3_end: int, traj_id=-1) -> tuple[float, float,
         return 0.0, 0.0, 0.0
 
 
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1.0 + SKETCH_ACCURACY) / (1.0 - SKETCH_ACCURACY)
+SKETCH_ZERO_BIN = np.iinfo(np.int32).min
+
+
+def sketch_bins(dt: np.ndarray) -> np.ndarray:
+    """
+    Maps time deltas to the logarithmic buckets of the quantile sketch. Any
+    value is represented by its bucket within SKETCH_ACCURACY relative error,
+    and non-positive values go to a dedicated zero bucket.
+    """
+    bins = np.full(dt.shape, SKETCH_ZERO_BIN, dtype=np.int32)
+    positive = dt > 0
+    bins[positive] = np.ceil(np.log(dt[positive]) / np.log(SKETCH_GAMMA))
+    return bins
+
+
+def sketch_values(bins: np.ndarray) -> np.ndarray:
+    values = 2.0 * np.power(SKETCH_GAMMA, bins.astype(np.float64)) / (SKETCH_GAMMA + 1.0)
+    values[bins == SKETCH_ZERO_BIN] = 0.0
+    return values
+
+
+def encode_sketch(bins: np.ndarray, counts: np.ndarray) -> bytes:
+    return np.concatenate([bins, counts]).astype(np.int32).tobytes()
+
+
+def decode_sketch(blob: bytes) -> tuple[np.ndarray, np.ndarray]:
+    data = np.frombuffer(blob, dtype=np.int32).reshape(2, -1)
+    return data[0], data[1]
+
+
+def merge_sketch(bins0: np.ndarray, counts0: np.ndarray,
+                 bins1: np.ndarray, counts1: np.ndarray,
+                 sign: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Adds (or subtracts, with a negative sign) the bucket counts of two
+    sketches. Empty buckets are dropped and the buckets are kept sorted.
+    """
+    bins, inverse = np.unique(np.concatenate([bins0, bins1]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts0, sign * counts1]),
+                         minlength=bins.shape[0]).astype(np.int32)
+    keep = counts > 0
+    return bins[keep], counts[keep]
+
+
+def sketch_median(bins: np.ndarray, counts: np.ndarray) -> float:
+    """
+    Median of a sketch, averaging the two middle values like np.median
+    """
+    n = counts.sum()
+    cum = np.cumsum(counts)
+    ranks = np.array([(n - 1) // 2, n // 2])
+    return float(sketch_values(bins[np.searchsorted(cum, ranks, side="right")]).mean())
+
+
+def merge_edge_stats(db: SpeedDb, df: pd.DataFrame) -> None:
+    """
+    Merges a batch of new segments into the edge_stats table
+    :param db: Speed database, in a transaction
+    :param df: DataFrame with the h3_ini, h3_end and dt segment columns
+    """
+    df = df.assign(dt_sq=df["dt"] ** 2, bin=sketch_bins(df["dt"].to_numpy()))
+    agg = df.groupby(["h3_ini", "h3_end"]).agg(n=("dt", "size"),
+                                                dt_sum=("dt", "sum"),
+                                                dt_sumsq=("dt_sq", "sum"),
+                                                dt_min=("dt", "min"),
+                                                dt_max=("dt", "max")).reset_index()
+    buckets = df.groupby(["h3_ini", "h3_end", "bin"]).size().reset_index(name="count")
+    bucket_bins = buckets["bin"].to_numpy(dtype=np.int32)
+    bucket_counts = buckets["count"].to_numpy(dtype=np.int32)
+    key_change = (buckets["h3_ini"].diff() != 0) | (buckets["h3_end"].diff() != 0)
+    bounds = np.append(np.flatnonzero(key_change.to_numpy()), buckets.shape[0])
+
+    db.execute_sql("create temp table if not exists edge_key (h3_ini INTEGER, h3_end INTEGER)")
+    db.execute_sql("delete from edge_key")
+    db.execute_sql("insert into edge_key (h3_ini, h3_end) values (?, ?)",
+                   agg[["h3_ini", "h3_end"]].itertuples(index=False, name=None), many=True)
+    sql = """
+    select     s.h3_ini
+    ,          s.h3_end
+    ,          s.n
+    ,          s.dt_sum
+    ,          s.dt_sumsq
+    ,          s.dt_min
+    ,          s.dt_max
+    ,          s.sketch
+    from       edge_stats s
+    inner join edge_key k on k.h3_ini = s.h3_ini and k.h3_end = s.h3_end
+    """
+    existing = {(r[0], r[1]): r[2:] for r in db.query(sql)}
+
+    rows = []
+    for i, (h3_ini, h3_end, n, dt_sum, dt_sumsq, dt_min, dt_max) in \
+            enumerate(agg.itertuples(index=False, name=None)):
+        bins = bucket_bins[bounds[i]:bounds[i + 1]]
+        counts = bucket_counts[bounds[i]:bounds[i + 1]]
+        old = existing.get((h3_ini, h3_end))
+        if old is not None:
+            old_bins, old_counts = decode_sketch(old[5])
+            bins, counts = merge_sketch(old_bins, old_counts, bins, counts)
+            n, dt_sum, dt_sumsq = n + old[0], dt_sum + old[1], dt_sumsq + old[2]
+            dt_min, dt_max = min(dt_min, old[3]), max(dt_max, old[4])
+        rows.append((h3_ini, h3_end, n, dt_sum, dt_sumsq, dt_min, dt_max,
+                     encode_sketch(bins, counts)))
+
+    sql = """
+    insert or replace into edge_stats
+        (h3_ini, h3_end, n, dt_sum, dt_sumsq, dt_min, dt_max, sketch)
+    values
+        (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    db.execute_sql(sql, rows, many=True)
+
+
+def refresh_edge_stats(chunk_size: int = 1_000_000) -> int:
+    """
+    Incrementally refreshes the edge_stats table with the segments added
+    since the last refresh, tracked by their speed_id
+    :param chunk_size: Number of segments merged per transaction
+    :return: Number of merged segments
+    """
+    db = SpeedDb(persistent=True)
+    db.create_edge_stats()
+    res = db.query("select last_speed_id from edge_stats_state where state_id = 0")
+    last_speed_id = res[0][0] if len(res) else 0
+
+    sql = """
+    select   speed_id
+    ,        h3_ini
+    ,        h3_end
+    ,        dt
+    from     segment
+    where    speed_id > ?
+    order by speed_id
+    limit    ?
+    """
+    total = 0
+    while True:
+        df = db.query_df(sql, (last_speed_id, chunk_size))
+        if df.shape[0] == 0:
+            break
+        last_speed_id = int(df["speed_id"].iloc[-1])
+        with db.transaction():
+            merge_edge_stats(db, df)
+            db.execute_sql("insert or replace into edge_stats_state (state_id, last_speed_id) values (0, ?)",
+                           [last_speed_id])
+        total += df.shape[0]
+    db.close()
+    return total
+
+
+def check_edge_stats(db: SpeedDb) -> None:
+    """
+    Fails if the edge_stats table was never refreshed. Readers do not
+    refresh it themselves, as that writes to the database.
+    """
+    if not db.table_exists("edge_stats_state") or \
+            db.query_scalar("select count(*) from edge_stats_state") == 0:
+        raise RuntimeError("The edge_stats table is missing, run compute-seg-speed.py to build it")
+
+
 def get_edge_times(h3_ini: int,
                    h3_end: int,
                    traj_id=-1,
                    min_samples=1) -> tuple[float, float, float, float, int]:
+    """
+    Travel time statistics of an edge, from the edge_stats aggregates. The
+    contribution of traj_id is subtracted to leave it out. The median comes
+    from the quantile sketch, within SKETCH_ACCURACY relative error.
+    :return: Tuple with the minimum, average, median and maximum travel
+        times and the number of samples
+    """
     db = SpeedDb()
+    check_edge_stats(db)
     sql = """
-        select dt 
-        from   segment 
-        where  h3_ini = ? and h3_end = ? and traj_id != ?
+    select s.n
+    ,      s.dt_sum
+    ,      s.dt_sumsq
+    ,      s.dt_min
+    ,      s.sketch
+    ,      (select last_speed_id from edge_stats_state) as last_speed_id
+    from   edge_stats s
+    where  s.h3_ini = ? and s.h3_end = ?
     """
-    df = db.query_df(sql, (h3_ini, h3_end, traj_id))
+    res = db.query(sql, (h3_ini, h3_end))
+    if len(res) == 0:
+        return 0, 0, 0, 0, 0
 
-    if df.shape[0] >= min_samples:
-        dt_array = df["dt"].to_numpy()
-        std_dt = np.std(dt_array)
-        avg_dt = np.mean(dt_array)
-        min_dt = max(avg_dt - 2 * std_dt, np.min(dt_array))
+    n, dt_sum, dt_sumsq, min_dt, sketch, last_speed_id = res[0]
+    bins, counts = decode_sketch(sketch)
+    if traj_id != -1:
+        sql = """
+        select dt
+        from   segment
+        where  h3_ini = ? and h3_end = ? and traj_id = ? and speed_id <= ?
+        """
+        trip_dt = np.array([r[0] for r in db.query(sql, (h3_ini, h3_end, traj_id, last_speed_id))])
+        if trip_dt.shape[0] > 0:
+            n -= trip_dt.shape[0]
+            dt_sum -= trip_dt.sum()
+            dt_sumsq -= (trip_dt ** 2).sum()
+            trip_bins, trip_counts = np.unique(sketch_bins(trip_dt), return_counts=True)
+            bins, counts = merge_sketch(bins, counts, trip_bins, trip_counts, sign=-1)
+            if n > 0 and trip_dt.min() <= min_dt:
+                min_dt = float(sketch_values(bins[:1])[0])
+
+    if n >= min_samples and n > 0:
+        avg_dt = dt_sum / n
+        std_dt = np.sqrt(max(dt_sumsq / n - avg_dt ** 2, 0.0))
+        min_dt = max(avg_dt - 2 * std_dt, min_dt)
         max_dt = avg_dt + 2 * std_dt
         return (min_dt,
                 avg_dt,
-                np.median(dt_array),
+                sketch_median(bins, counts),
                 max_dt,
-                df.shape[0])
+                n)
     else:
         return 0, 0, 0, 0, 0
 
 
+@njit()
+def sketch_bin_value(b: int) -> float:
+    if b == SKETCH_ZERO_BIN:
+        return 0.0
+    return 2.0 * SKETCH_GAMMA ** b / (SKETCH_GAMMA + 1.0)
+
+
+@njit()
+def lookup_edges(keys_ini, keys_end, h3_ini, h3_end):
+    """
+    Binary searches (h3_ini, h3_end) pairs in the lexicographically sorted
+    key arrays
+    :return: Array of key indices, -1 where the pair is missing
+    """
+    n = keys_ini.shape[0]
+    idx = np.full(h3_ini.shape[0], -1, dtype=np.int64)
+    for i in range(h3_ini.shape[0]):
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys_ini[mid] < h3_ini[i] or (keys_ini[mid] == h3_ini[i] and keys_end[mid] < h3_end[i]):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < n and keys_ini[lo] == h3_ini[i] and keys_end[lo] == h3_end[i]:
+            idx[i] = lo
+    return idx
+
+
+@njit()
+def edge_time_stats(idx, n, dt_sum, dt_sumsq, dt_min,
+                    sketch_offsets, sketch_bins, sketch_counts,
+                    trip_idx, trip_dt, trip_bins, min_samples):
+    """
+    Computes the get_edge_times statistics of a list of edges, leaving out
+    the samples of one trip
+    :param idx: Edge indices, -1 for unknown edges
+    :param trip_idx: Edge indices of the left out samples, sorted together
+        with their bins
+    :param trip_dt: Left out sample values
+    :param trip_bins: Sketch bins of the left out samples
+    :return: Tuple with the arrays of minimum, average, median and maximum
+        times and sample counts
+    """
+    m = idx.shape[0]
+    min_dts = np.zeros(m)
+    avg_dts = np.zeros(m)
+    med_dts = np.zeros(m)
+    max_dts = np.zeros(m)
+    counts = np.zeros(m, dtype=np.int64)
+    for i in range(m):
+        e = idx[i]
+        if e < 0:
+            continue
+        t0 = np.searchsorted(trip_idx, e, side="left")
+        t1 = np.searchsorted(trip_idx, e, side="right")
+        k = n[e] - (t1 - t0)
+        if k < min_samples or k <= 0:
+            continue
+
+        s, sq, trip_min = dt_sum[e], dt_sumsq[e], np.inf
+        for t in range(t0, t1):
+            s -= trip_dt[t]
+            sq -= trip_dt[t] ** 2
+            trip_min = min(trip_min, trip_dt[t])
+
+        # Walk the sketch buckets without the left out samples
+        r0, r1 = (k - 1) // 2, k // 2
+        v0, v1, first = 0.0, 0.0, np.nan
+        seen = 0
+        t = t0
+        for j in range(sketch_offsets[e], sketch_offsets[e + 1]):
+            c = sketch_counts[j]
+            while t < t1 and trip_bins[t] < sketch_bins[j]:
+                t += 1
+            while t < t1 and trip_bins[t] == sketch_bins[j]:
+                c -= 1
+                t += 1
+            if c <= 0:
+                continue
+            value = sketch_bin_value(sketch_bins[j])
+            if np.isnan(first):
+                first = value
+            if seen <= r0 < seen + c:
+                v0 = value
+            if seen <= r1 < seen + c:
+                v1 = value
+                break
+            seen += c
+
+        avg = s / k
+        std = np.sqrt(max(sq / k - avg ** 2, 0.0))
+        lower = dt_min[e] if trip_min > dt_min[e] else first
+        min_dts[i] = max(avg - 2 * std, lower)
+        avg_dts[i] = avg
+        med_dts[i] = (v0 + v1) / 2.0
+        max_dts[i] = avg + 2 * std
+        counts[i] = k
+    return min_dts, avg_dts, med_dts, max_dts, counts
+
+
+class EdgeTimeModel(object):
+
+    def __init__(self, keys_ini, keys_end, n, dt_sum, dt_sumsq, dt_min,
+                 sketch_offsets, sketch_bins, sketch_counts, last_speed_id):
+        """
+        In-memory copy of the edge_stats table, with the (h3_ini, h3_end)
+        keys in lexicographic order, and the sketches as a CSR of buckets.
+        Use EdgeTimeModel.load to build it.
+        """
+        self.keys_ini = keys_ini
+        self.keys_end = keys_end
+        self.n = n
+        self.dt_sum = dt_sum
+        self.dt_sumsq = dt_sumsq
+        self.dt_min = dt_min
+        self.sketch_offsets = sketch_offsets
+        self.sketch_bins = sketch_bins
+        self.sketch_counts = sketch_counts
+        self.last_speed_id = last_speed_id
+
+    @classmethod
+    def load(cls):
+        """
+        Loads the edge_stats table, which compute-seg-speed.py refreshes
+        """
+        db = SpeedDb()
+        check_edge_stats(db)
+        sql = """
+        select   h3_ini
+        ,        h3_end
+        ,        n
+        ,        dt_sum
+        ,        dt_sumsq
+        ,        dt_min
+        ,        sketch
+        from     edge_stats
+        order by h3_ini, h3_end
+        """
+        rows = db.query(sql)
+        last_speed_id = db.query_scalar("select last_speed_id from edge_stats_state")
+
+        sizes = np.array([len(r[6]) // 8 for r in rows], dtype=np.int64)
+        sketch_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        sketch_offsets[1:] = np.cumsum(sizes)
+
+        # Each blob holds the bins followed by the counts
+        data = np.frombuffer(b"".join(r[6] for r in rows), dtype=np.int32)
+        positions = np.arange(sketch_offsets[-1]) + np.repeat(sketch_offsets[:-1], sizes)
+        return EdgeTimeModel(np.array([r[0] for r in rows], dtype=np.int64),
+                             np.array([r[1] for r in rows], dtype=np.int64),
+                             np.array([r[2] for r in rows], dtype=np.int64),
+                             np.array([r[3] for r in rows], dtype=np.float64),
+                             np.array([r[4] for r in rows], dtype=np.float64),
+                             np.array([r[5] for r in rows], dtype=np.float64),
+                             sketch_offsets,
+                             data[positions],
+                             data[positions + np.repeat(sizes, sizes)],
+                             last_speed_id)
+
+    def lookup(self, h3_ini: np.ndarray, h3_end: np.ndarray) -> np.ndarray:
+        return lookup_edges(self.keys_ini, self.keys_end,
+                            np.asarray(h3_ini, dtype=np.int64),
+                            np.asarray(h3_end, dtype=np.int64))
+
+    def get_trip_samples(self, traj_id: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Loads the aggregated samples of a trip, sorted by edge and bin
+        :return: Tuple with the arrays of edge indices, dt and sketch bins
+        """
+        db = SpeedDb()
+        sql = """
+        select h3_ini
+        ,      h3_end
+        ,      dt
+        from   segment
+        where  traj_id = ? and speed_id <= ?
+        """
+        rows = db.query(sql, (traj_id, self.last_speed_id))
+        idx = self.lookup(np.array([r[0] for r in rows], dtype=np.int64),
+                          np.array([r[1] for r in rows], dtype=np.int64))
+        dt = np.array([r[2] for r in rows], dtype=np.float64)
+        bins = sketch_bins(dt)
+        order = np.lexsort((bins, idx))
+        return idx[order], dt[order], bins[order]
+
+    def get_edge_times(self,
+                       h3_ini: np.ndarray,
+                       h3_end: np.ndarray,
+                       traj_id=-1,
+                       min_samples=1) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Vectorized get_edge_times over a whole route
+        :param h3_ini: Array of edge start cells
+        :param h3_end: Array of edge end cells
+        :param traj_id: Trajectory to leave out, or -1
+        :param min_samples: Minimum number of samples per edge
+        :return: Tuple with the arrays of minimum, average, median and
+            maximum times and sample counts, zero for unknown edges
+        """
+        if traj_id != -1:
+            trip_idx, trip_dt, trip_bins = self.get_trip_samples(traj_id)
+        else:
+            trip_idx = np.zeros(0, dtype=np.int64)
+            trip_dt = np.zeros(0, dtype=np.float64)
+            trip_bins = np.zeros(0, dtype=np.int32)
+        return edge_time_stats(self.lookup(h3_ini, h3_end),
+                               self.n, self.dt_sum, self.dt_sumsq, self.dt_min,
+                               self.sketch_offsets, self.sketch_bins, self.sketch_counts,
+                               trip_idx, trip_dt, trip_bins, min_samples)
+
+
+SLOTS_PER_DAY = 144
+SLOT_SECONDS = 86400 // SLOTS_PER_DAY
+
+# Fallback levels of the time cube, from the finest to the coarsest, as
+# the number of slot buckets per day: 10 minutes, one hour, four hours and
+# the whole day of the same day type. Zero pools all the days together.
+CUBE_LEVELS = np.array([144, 24, 6, 1, 0], dtype=np.int64)
+
+
+def get_week_day_slot(day_num: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts day numbers to week days (zero is Sunday) and 10-minute day
+    slots, like the signal table's week_day and day_slot columns
+    :param day_num: Array of fractional day numbers
+    :return: Tuple with the week day and day slot arrays
+    """
+    t = np.asarray(day_num, dtype=np.float64) - 1.0 / 6.0
+    day = np.floor(t)
+    return (day.astype(np.int64) + 2) % 7, ((t - day) * SLOTS_PER_DAY).astype(np.int64)
+
+
+@njit()
+def is_weekend(week_day: int) -> int:
+    return 1 if week_day == 0 or week_day == 6 else 0
+
+
+@njit()
+def cube_cell_key(edge: int, day_type: int, day_slot: int, level_slots: int) -> int:
+    if level_slots == 0:
+        return edge
+    return (edge * 2 + day_type) * level_slots + day_slot * level_slots // SLOTS_PER_DAY
+
+
+@njit()
+def cube_find(edge, day_type, day_slot, level_offsets, cell_keys, cell_n, min_samples):
+    """
+    Finds the finest cube cell of an edge with enough samples
+    :return: Tuple with the cell index and its level, or (-1, -1)
+    """
+    for level in range(CUBE_LEVELS.shape[0]):
+        key = cube_cell_key(edge, day_type, day_slot, CUBE_LEVELS[level])
+        lo, hi = level_offsets[level], level_offsets[level + 1]
+        j = lo + np.searchsorted(cell_keys[lo:hi], key)
+        if j < hi and cell_keys[j] == key and cell_n[j] >= min_samples:
+            return j, level
+    return -1, -1
+
+
+@njit()
+def cube_edge_times(idx, week_day, day_slot, level_offsets,
+                    cell_keys, cell_n, cell_sum, cell_sumsq, cell_min, min_samples):
+    """
+    Looks up the time statistics of a list of edges, each at its own week
+    day and day slot
+    :return: Tuple with the arrays of minimum, average and maximum times,
+        sample counts and fallback levels, -1 for unknown edges
+    """
+    m = idx.shape[0]
+    min_dts = np.zeros(m)
+    avg_dts = np.zeros(m)
+    max_dts = np.zeros(m)
+    counts = np.zeros(m, dtype=np.int64)
+    levels = np.full(m, -1, dtype=np.int64)
+    for i in range(m):
+        if idx[i] < 0:
+            continue
+        j, level = cube_find(idx[i], is_weekend(week_day[i]), day_slot[i],
+                             level_offsets, cell_keys, cell_n, min_samples)
+        if j < 0:
+            continue
+        avg = cell_sum[j] / cell_n[j]
+        std = np.sqrt(max(cell_sumsq[j] / cell_n[j] - avg ** 2, 0.0))
+        min_dts[i] = max(avg - 2 * std, cell_min[j])
+        avg_dts[i] = avg
+        max_dts[i] = avg + 2 * std
+        counts[i] = cell_n[j]
+        levels[i] = level
+    return min_dts, avg_dts, max_dts, counts, levels
+
+
+@njit()
+def cube_route_time(idx, default_dt, week_day, time_s, level_offsets,
+                    cell_keys, cell_n, cell_sum, min_samples):
+    """
+    Drives a route from a departure time, looking up each edge at the time
+    the route reaches it
+    :param default_dt: Edge times to use where the cube has no data
+    :param week_day: Departure week day
+    :param time_s: Departure time in seconds since midnight
+    :return: Route duration in seconds
+    """
+    duration = 0.0
+    for i in range(idx.shape[0]):
+        dt = default_dt[i]
+        if idx[i] >= 0:
+            j, level = cube_find(idx[i], is_weekend(week_day), int(time_s // SLOT_SECONDS),
+                                 level_offsets, cell_keys, cell_n, min_samples)
+            if j >= 0:
+                dt = cell_sum[j] / cell_n[j]
+        duration += dt
+        time_s += dt
+        while time_s >= 86400.0:
+            time_s -= 86400.0
+            week_day = (week_day + 1) % 7
+    return duration
+
+
+@njit(parallel=True)
+def cube_route_profile(idx, default_dt, week_day, level_offsets,
+                       cell_keys, cell_n, cell_sum, min_samples):
+    """
+    Route durations for departures at the start of every day slot
+    """
+    durations = np.zeros(SLOTS_PER_DAY)
+    for slot in prange(SLOTS_PER_DAY):
+        durations[slot] = cube_route_time(idx, default_dt, week_day, float(slot * SLOT_SECONDS),
+                                          level_offsets, cell_keys, cell_n, cell_sum, min_samples)
+    return durations
+
+
+class EdgeTimeCube(object):
+
+    def __init__(self, arrays: dict):
+        """
+        Time-dependent edge times, keyed by edge, day type (weekday or
+        weekend) and day slot bucket. Each fallback level in CUBE_LEVELS
+        keeps its populated cells as a sorted array of integer keys, with
+        the sample counts, sums, sums of squares and minimums alongside.
+        Use EdgeTimeCube.load to build it from the segment table.
+        :param arrays: Dictionary of arrays, as saved by EdgeTimeCube.save
+        """
+        self.keys_ini = arrays["keys_ini"]
+        self.keys_end = arrays["keys_end"]
+        self.level_offsets = arrays["level_offsets"]
+        self.cell_keys = arrays["cell_keys"]
+        self.cell_n = arrays["cell_n"]
+        self.cell_sum = arrays["cell_sum"]
+        self.cell_sumsq = arrays["cell_sumsq"]
+        self.cell_min = arrays["cell_min"]
+
+    @classmethod
+    def load(cls):
+        """
+        Aggregates the segment table into a time cube. A segment's time is
+        its trip's day_num plus its time_stamp offset, shifted by one day
+        so that the integer cast floors the early hours of day zero.
+        """
+        db = SpeedDb()
+        sql = """
+        select   h3_ini
+        ,        h3_end
+        ,        case when (cast(t as integer) + 1) % 7 in (0, 6) then 1 else 0 end as day_type
+        ,        cast((t - cast(t as integer)) * 144 as integer) as day_slot
+        ,        count(*) as n
+        ,        sum(dt) as dt_sum
+        ,        sum(dt * dt) as dt_sumsq
+        ,        min(dt) as dt_min
+        from     (select h3_ini
+                  ,      h3_end
+                  ,      dt
+                  ,      day_num + time_stamp / 86400000.0 + 5.0 / 6.0 as t
+                  from   segment)
+        group by h3_ini, h3_end, day_type, day_slot
+        order by h3_ini, h3_end
+        """
+        df = db.query_df(sql)
+        h3_ini = df["h3_ini"].to_numpy(dtype=np.int64)
+        h3_end = df["h3_end"].to_numpy(dtype=np.int64)
+        day_type = df["day_type"].to_numpy(dtype=np.int64)
+        day_slot = np.minimum(df["day_slot"].to_numpy(dtype=np.int64), SLOTS_PER_DAY - 1)
+
+        # Rows are sorted by edge, so edges are numbered where the key changes
+        is_new = np.ones(h3_ini.shape[0], dtype=bool)
+        is_new[1:] = (h3_ini[1:] != h3_ini[:-1]) | (h3_end[1:] != h3_end[:-1])
+        edge = np.cumsum(is_new) - 1
+
+        keys, n, dt_sum, dt_sumsq, dt_min = [], [], [], [], []
+        for level_slots in CUBE_LEVELS:
+            if level_slots == 0:
+                cell = edge
+            else:
+                cell = (edge * 2 + day_type) * level_slots + day_slot * level_slots // SLOTS_PER_DAY
+            unique, inverse = np.unique(cell, return_inverse=True)
+            cell_min = np.full(unique.shape[0], np.inf)
+            np.minimum.at(cell_min, inverse, df["dt_min"].to_numpy())
+            keys.append(unique)
+            n.append(np.bincount(inverse, weights=df["n"].to_numpy()).astype(np.int64))
+            dt_sum.append(np.bincount(inverse, weights=df["dt_sum"].to_numpy()))
+            dt_sumsq.append(np.bincount(inverse, weights=df["dt_sumsq"].to_numpy()))
+            dt_min.append(cell_min)
+
+        level_offsets = np.zeros(CUBE_LEVELS.shape[0] + 1, dtype=np.int64)
+        level_offsets[1:] = np.cumsum([k.shape[0] for k in keys])
+        return EdgeTimeCube({"keys_ini": h3_ini[is_new],
+                             "keys_end": h3_end[is_new],
+                             "level_offsets": level_offsets,
+                             "cell_keys": np.concatenate(keys),
+                             "cell_n": np.concatenate(n),
+                             "cell_sum": np.concatenate(dt_sum),
+                             "cell_sumsq": np.concatenate(dt_sumsq),
+                             "cell_min": np.concatenate(dt_min)})
+
+    def save(self, file_name: str) -> None:
+        np.savez(file_name,
+                 keys_ini=self.keys_ini,
+                 keys_end=self.keys_end,
+                 level_offsets=self.level_offsets,
+                 cell_keys=self.cell_keys,
+                 cell_n=self.cell_n,
+                 cell_sum=self.cell_sum,
+                 cell_sumsq=self.cell_sumsq,
+                 cell_min=self.cell_min)
+
+    @staticmethod
+    def from_file(file_name: str):
+        with np.load(file_name) as data:
+            return EdgeTimeCube({key: data[key] for key in data.files})
+
+    def lookup(self, h3_ini: np.ndarray, h3_end: np.ndarray) -> np.ndarray:
+        return lookup_edges(self.keys_ini, self.keys_end,
+                            np.asarray(h3_ini, dtype=np.int64),
+                            np.asarray(h3_end, dtype=np.int64))
+
+    def get_edge_times(self,
+                       h3_ini: np.ndarray,
+                       h3_end: np.ndarray,
+                       week_day,
+                       day_slot,
+                       min_samples=5) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Looks up the edge times at the given week days and day slots, falling
+        back to coarser time buckets where there are fewer than min_samples
+        :param h3_ini: Array of edge start cells
+        :param h3_end: Array of edge end cells
+        :param week_day: Week day, or array of week days, zero is Sunday
+        :param day_slot: Day slot, or array of day slots
+        :param min_samples: Minimum number of samples per cell
+        :return: Tuple with the arrays of minimum, average and maximum times,
+            sample counts and fallback levels, -1 for unknown edges
+        """
+        idx = self.lookup(h3_ini, h3_end)
+        week_day = np.broadcast_to(np.asarray(week_day, dtype=np.int64), idx.shape)
+        day_slot = np.broadcast_to(np.asarray(day_slot, dtype=np.int64), idx.shape)
+        return cube_edge_times(idx, np.ascontiguousarray(week_day), np.ascontiguousarray(day_slot),
+                               self.level_offsets, self.cell_keys, self.cell_n,
+                               self.cell_sum, self.cell_sumsq, self.cell_min, min_samples)
+
+    def get_route_time(self,
+                       h3_cells: np.ndarray,
+                       default_dt: np.ndarray,
+                       week_day: int,
+                       time_s: float,
+                       min_samples=5) -> float:
+        """
+        Estimates the duration of a route departing at a given time
+        :param h3_cells: Array of the route's H3 cells, edge i joins cells i
+            and i + 1
+        :param default_dt: Array of edge times to use where there is no data
+        :param week_day: Departure week day, zero is Sunday
+        :param time_s: Departure time in seconds since midnight
+        :param min_samples: Minimum number of samples per cell
+        :return: Route duration in seconds
+        """
+        h3_cells = np.asarray(h3_cells, dtype=np.int64)
+        return cube_route_time(self.lookup(h3_cells[:-1], h3_cells[1:]),
+                               np.asarray(default_dt, dtype=np.float64), week_day, time_s,
+                               self.level_offsets, self.cell_keys, self.cell_n, self.cell_sum,
+                               min_samples)
+
+    def get_route_profile(self,
+                          h3_cells: np.ndarray,
+                          default_dt: np.ndarray,
+                          week_day: int,
+                          min_samples=5) -> np.ndarray:
+        """
+        Route durations for departures at each of the 144 day slots
+        :return: Array of durations in seconds
+        """
+        h3_cells = np.asarray(h3_cells, dtype=np.int64)
+        return cube_route_profile(self.lookup(h3_cells[:-1], h3_cells[1:]),
+                                  np.asarray(default_dt, dtype=np.float64), week_day,
+                                  self.level_offsets, self.cell_keys, self.cell_n, self.cell_sum,
+                                  min_samples)
+
+
 def get_trip_signals(vehicle_id: int, trip_id: int) -> pd.DataFrame:
     db = EVedDb()
     sql = """
@@ -78,6 +769,37 @@ def get_trip_signals(vehicle_id: int, trip_id: int) -> pd.DataFrame:
     """
     return db.query_df(sql, (vehicle_id, trip_id))
 
+
+TRIP_SIGNAL_COLUMNS = ["match_latitude", "match_longitude", "day_num", "time_stamp"]
+
+
+def group_trip_signals(signals: dict) -> pd.DataFrame:
+    """
+    Groups streamed trip signals like get_trip_signals does: one row per
+    distinct location, with its earliest day number and latest time stamp
+    :param signals: Trip signal arrays from EVedDb.iterate_trips, with the
+        TRIP_SIGNAL_COLUMNS
+    :return: DataFrame sorted by day number and time stamp
+    """
+    df = pd.DataFrame({column: signals[column] for column in TRIP_SIGNAL_COLUMNS})
+    df = df.groupby(["match_latitude", "match_longitude"], as_index=False) \
+           .agg(day_num=("day_num", "min"), time_stamp=("time_stamp", "max"))
+    return df.sort_values(["day_num", "time_stamp"], kind="stable").reset_index(drop=True)
+
+
+def iterate_trip_signals():
+    """
+    Reads the grouped signals of all the trajectories in a single scan of
+    the signal table, instead of one get_trip_signals query per trip
+    :return: Generator of (traj_id, vehicle_id, trip_id, DataFrame) tuples
+    """
+    traj_ids = {(vehicle_id, trip_id): traj_id for traj_id, vehicle_id, trip_id in get_all_trips()}
+    db = EVedDb()
+    for vehicle_id, trip_id, signals in db.iterate_trips(TRIP_SIGNAL_COLUMNS):
+        if (vehicle_id, trip_id) in traj_ids:
+            yield traj_ids[(vehicle_id, trip_id)], vehicle_id, trip_id, group_trip_signals(signals)
+
+
 @njit
 def update_dt_and_speed(distance: float,
                         dt: float,
@@ -0,0 +1,251 @@
+import numpy as np
+
+from numba import njit, prange
+from db.api import EVedDb
+from geo.math import BEARING_SECTORS, bearing_sectors, vec_bearings, vec_haversine
+from geo.qk import vec_line_to_qk
+
+
+QK_LEVEL = 20
+SLOTS_PER_DAY = 144
+SLOT_SECONDS = 86400 // SLOTS_PER_DAY
+
+
+@njit()
+def find_cell(block, time_code, block_offsets, cell_times):
+    """
+    Binary searches a week time code within a (quadkey, sector) block
+    :return: Cell index, or -1 if the block has no samples at that time
+    """
+    if block < 0:
+        return -1
+    lo, hi = block_offsets[block], block_offsets[block + 1]
+    j = lo + np.searchsorted(cell_times[lo:hi], time_code)
+    if j < hi and cell_times[j] == time_code:
+        return j
+    return -1
+
+
+@njit()
+def qk_edge_time(i, time_code, edge_offsets, blocks, weights, lengths, default_dt,
+                 block_offsets, cell_times, cell_n, cell_sum, min_samples):
+    """
+    Estimates the time to drive an edge from the speeds recorded on its
+    quadkeys, weighted by the quadkeys' line coverage
+    :return: Edge time in seconds, or the default time without samples
+    """
+    num, den = 0.0, 0.0
+    for k in range(edge_offsets[i], edge_offsets[i + 1]):
+        j = find_cell(blocks[k], time_code, block_offsets, cell_times)
+        if j >= 0 and cell_n[j] >= min_samples:
+            num += weights[k] * cell_sum[j]
+            den += weights[k] * cell_n[j]
+    if den > 0.0 and num > 0.0:
+        return lengths[i] / (num / den / 3.6)
+    return default_dt[i]
+
+
+@njit()
+def qk_route_time(week_day, time_s, edge_offsets, blocks, weights, lengths, default_dt,
+                  block_offsets, cell_times, cell_n, cell_sum, min_samples):
+    """
+    Drives a route from a departure time, pricing each edge at the time the
+    route reaches it
+    :return: Route duration in seconds
+    """
+    duration = 0.0
+    for i in range(lengths.shape[0]):
+        time_code = week_day * SLOTS_PER_DAY + int(time_s // SLOT_SECONDS)
+        dt = qk_edge_time(i, time_code, edge_offsets, blocks, weights, lengths, default_dt,
+                          block_offsets, cell_times, cell_n, cell_sum, min_samples)
+        duration += dt
+        time_s += dt
+        while time_s >= 86400.0:
+            time_s -= 86400.0
+            week_day = (week_day + 1) % 7
+    return duration
+
+
+@njit(parallel=True)
+def qk_route_profile(week_day, edge_offsets, blocks, weights, lengths, default_dt,
+                     block_offsets, cell_times, cell_n, cell_sum, min_samples):
+    """
+    Route durations for departures at the start of every day slot
+    """
+    durations = np.zeros(SLOTS_PER_DAY)
+    for slot in prange(SLOTS_PER_DAY):
+        durations[slot] = qk_route_time(week_day, float(slot * SLOT_SECONDS),
+                                        edge_offsets, blocks, weights, lengths, default_dt,
+                                        block_offsets, cell_times, cell_n, cell_sum, min_samples)
+    return durations
+
+
+class QuadkeyRoute(object):
+
+    def __init__(self, edge_offsets, blocks, weights, lengths, default_dt):
+        """
+        A route rasterized into level-20 quadkeys, with each quadkey resolved
+        to its (quadkey, sector) block of a QuadkeySpeedCube. Edge i owns
+        the quadkeys from edge_offsets[i] to edge_offsets[i + 1].
+        """
+        self.edge_offsets = edge_offsets
+        self.blocks = blocks
+        self.weights = weights
+        self.lengths = lengths
+        self.default_dt = default_dt
+
+
+class QuadkeySpeedCube(object):
+
+    def __init__(self, arrays: dict):
+        """
+        Signal speeds aggregated by level-20 quadkey, bearing sector, week
+        day and day slot. The (quadkey, sector) pairs are sorted into blocks,
+        and each block holds its cells sorted by week time code, which is
+        week_day * 144 + day_slot, with the sample count and speed sum.
+        Use QuadkeySpeedCube.load to build it from the signal table.
+        :param arrays: Dictionary of arrays, as saved by QuadkeySpeedCube.save
+        """
+        self.sectors = int(arrays["sectors"])
+        self.block_keys = arrays["block_keys"]
+        self.block_offsets = arrays["block_offsets"]
+        self.cell_times = arrays["cell_times"]
+        self.cell_n = arrays["cell_n"]
+        self.cell_sum = arrays["cell_sum"]
+
+    @classmethod
+    def load(cls, sectors: int = BEARING_SECTORS):
+        """
+        Aggregates the signal table in a single pass
+        :param sectors: Number of bearing sectors
+        """
+        db = EVedDb()
+        width = 360.0 / sectors
+        sql = """
+        select   quadkey
+        ,        cast((bearing + ?) / ? as integer) % ? as sector
+        ,        week_day * 144 + day_slot as time_code
+        ,        count(*) as n
+        ,        sum(speed) as speed_sum
+        from     signal
+        where    quadkey is not null and bearing is not null and speed is not null
+                 and week_day is not null and day_slot is not null
+        group by quadkey, sector, time_code
+        order by quadkey, sector, time_code
+        """
+        df = db.query_df(sql, [width / 2.0, width, sectors])
+        keys = df["quadkey"].to_numpy(dtype=np.int64) * sectors + df["sector"].to_numpy(dtype=np.int64)
+
+        is_new = np.ones(keys.shape[0], dtype=bool)
+        is_new[1:] = keys[1:] != keys[:-1]
+        block_offsets = np.append(np.flatnonzero(is_new), keys.shape[0]).astype(np.int64)
+        return QuadkeySpeedCube({"sectors": sectors,
+                                 "block_keys": keys[is_new],
+                                 "block_offsets": block_offsets,
+                                 "cell_times": df["time_code"].to_numpy(dtype=np.int64),
+                                 "cell_n": df["n"].to_numpy(dtype=np.int64),
+                                 "cell_sum": df["speed_sum"].to_numpy(dtype=np.float64)})
+
+    def save(self, file_name: str) -> None:
+        np.savez(file_name,
+                 sectors=self.sectors,
+                 block_keys=self.block_keys,
+                 block_offsets=self.block_offsets,
+                 cell_times=self.cell_times,
+                 cell_n=self.cell_n,
+                 cell_sum=self.cell_sum)
+
+    @staticmethod
+    def from_file(file_name: str):
+        with np.load(file_name) as data:
+            return QuadkeySpeedCube({key: data[key] for key in data.files})
+
+    def find_blocks(self, quadkeys: np.ndarray, sectors: np.ndarray) -> np.ndarray:
+        """
+        Vectorized lookup of (quadkey, sector) blocks
+        :return: Array of block indices, -1 where there are no samples
+        """
+        keys = np.asarray(quadkeys, dtype=np.int64) * self.sectors + np.asarray(sectors, dtype=np.int64)
+        blocks = np.searchsorted(self.block_keys, keys)
+        found = blocks < self.block_keys.shape[0]
+        found[found] = self.block_keys[blocks[found]] == keys[found]
+        return np.where(found, blocks, -1)
+
+    def get_speeds(self,
+                   quadkeys: np.ndarray,
+                   bearings: np.ndarray,
+                   week_day,
+                   day_slot) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized speed lookup
+        :param quadkeys: Array of level-20 integer quadkeys
+        :param bearings: Array of bearings in degrees
+        :param week_day: Week day, or array of week days, zero is Sunday
+        :param day_slot: Day slot, or array of day slots
+        :return: Tuple with the arrays of sample counts and speed sums
+        """
+        blocks = self.find_blocks(quadkeys, bearing_sectors(bearings, self.sectors))
+        time_codes = np.broadcast_to(np.asarray(week_day, dtype=np.int64) * SLOTS_PER_DAY +
+                                     np.asarray(day_slot, dtype=np.int64), blocks.shape)
+        counts = np.zeros(blocks.shape[0], dtype=np.int64)
+        speed_sums = np.zeros(blocks.shape[0])
+        for i in range(blocks.shape[0]):
+            j = find_cell(blocks[i], time_codes[i], self.block_offsets, self.cell_times)
+            if j >= 0:
+                counts[i] = self.cell_n[j]
+                speed_sums[i] = self.cell_sum[j]
+        return counts, speed_sums
+
+    def prepare_route(self,
+                      lats: np.ndarray,
+                      lons: np.ndarray,
+                      default_dt: np.ndarray) -> QuadkeyRoute:
+        """
+        Rasterizes a route's edges into quadkeys and resolves their blocks,
+        once for any number of departure times
+        :param lats: Array of route node latitudes
+        :param lons: Array of route node longitudes
+        :param default_dt: Array of edge times to use where there are no
+            samples, like the graph's travel_time
+        :return: Prepared route
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        segments, quadkeys, weights = vec_line_to_qk(lats, lons, QK_LEVEL)
+        sectors = bearing_sectors(vec_bearings(lats, lons), self.sectors)
+
+        edge_offsets = np.searchsorted(segments, np.arange(lats.shape[0])).astype(np.int64)
+        return QuadkeyRoute(edge_offsets,
+                            self.find_blocks(quadkeys, sectors[segments]),
+                            weights,
+                            vec_haversine(lats[:-1], lons[:-1], lats[1:], lons[1:]),
+                            np.asarray(default_dt, dtype=np.float64))
+
+    def get_route_time(self,
+                       route: QuadkeyRoute,
+                       week_day: int,
+                       time_s: float,
+                       min_samples: int = 1) -> float:
+        """
+        Estimates the duration of a route departing at a given time
+        :param route: Route from prepare_route
+        :param week_day: Departure week day, zero is Sunday
+        :param time_s: Departure time in seconds since midnight
+        :param min_samples: Minimum number of samples per quadkey cell
+        :return: Route duration in seconds
+        """
+        return qk_route_time(week_day, time_s,
+                             route.edge_offsets, route.blocks, route.weights, route.lengths, route.default_dt,
+                             self.block_offsets, self.cell_times, self.cell_n, self.cell_sum, min_samples)
+
+    def get_route_profile(self,
+                          route: QuadkeyRoute,
+                          week_day: int,
+                          min_samples: int = 1) -> np.ndarray:
+        """
+        Route durations for departures at each of the 144 day slots
+        :return: Array of durations in seconds
+        """
+        return qk_route_profile(week_day,
+                                route.edge_offsets, route.blocks, route.weights, route.lengths, route.default_dt,
+                                self.block_offsets, self.cell_times, self.cell_n, self.cell_sum, min_samples)
@@ -1,11 +1,12 @@
 import numpy as np
 import h3.api.numpy_int as h3
 
-from common.mapspeed import get_all_trips, get_trip_signals
+from common.mapspeed import get_trip_signals, iterate_trip_signals, refresh_edge_stats
 from common.models import Trajectory, CompoundTrajectory
 from db.api import SpeedDb
 from geo.mapping import map_match
-from valhalla import Actor, get_config
+from geo.matching import get_worker_actor
+from tools import parallel_imap
 from valhalla.utils import decode_polyline
 from dataclasses import dataclass, astuple
 
@@ -23,8 +24,8 @@ class Segment:
         return astuple(self)
 
 
-def insert_segments(segments: list[Segment]) -> None:
-    db = SpeedDb()
+def insert_segments(db: SpeedDb,
+                    segments: list[Segment]) -> None:
     sql = """
     INSERT INTO segment 
         (h3_ini, h3_end, dt, day_num, time_stamp, traj_id)
@@ -50,38 +51,52 @@ def generate_segments(trajectory: Trajectory,
     return segments
 
 
-def main():
-    config = get_config(tile_extract='./valhalla/custom_files/valhalla_tiles.tar',
-                        verbose=True)
+def process_trip(traj_id: int,
+                 vehicle_id: int,
+                 trip_id: int,
+                 trip_df=None) -> tuple[int, list[Segment]]:
+    """
+    Worker function: map-matches a trip with the worker's Actor and
+    generates its segments
+    :param trip_df: Grouped trip signals, instead of querying the trip
+    :return: Tuple with the trajectory id and the list of segments
+    """
+    if trip_df is None:
+        trip_df = get_trip_signals(vehicle_id, trip_id)
+    lat_array = trip_df["match_latitude"].values
+    lon_array = trip_df["match_longitude"].values
+    time_stamps = trip_df["time_stamp"].values
+    day_num = float(trip_df["day_num"].values[0])
 
-    trips = get_all_trips()
+    trajectory = Trajectory(lat=lat_array, lon=lon_array, time=time_stamps)
 
-    for traj_id, vehicle_id, trip_id in trips:
-        print(f"Vehicle {vehicle_id}, trip {trip_id}, trajectory: {traj_id}")
+    try:
+        encoded_line = map_match(get_worker_actor(), list(zip(lon_array, lat_array)))
+    except RuntimeError as e:
+        print(e)
+        return traj_id, []
 
-        trip_df = get_trip_signals(vehicle_id, trip_id)
-        lat_array = trip_df["match_latitude"].values
-        lon_array = trip_df["match_longitude"].values
-        time_stamps = trip_df["time_stamp"].values
-        day_num = float(trip_df["day_num"].values[0])
+    polyline = np.array(decode_polyline(encoded_line, order="latlng"))
 
-        trajectory = Trajectory(lat=lat_array, lon=lon_array, time=time_stamps)
+    compound = CompoundTrajectory(trajectory, polyline[:,0], polyline[:,1])
+    converted = compound.to_trajectory()
 
-        try:
-            actor = Actor(config)
-            encoded_line = map_match(actor, list(zip(lon_array, lat_array)))
-        except RuntimeError as e:
-            print(e)
-            continue
+    return traj_id, generate_segments(converted, day_num, traj_id)
 
-        polyline = np.array(decode_polyline(encoded_line, order="latlng"))
 
-        compound = CompoundTrajectory(trajectory, polyline[:,0], polyline[:,1])
-        converted = compound.to_trajectory()
+def main(n_jobs=8):
+    args = ({"traj_id": traj_id, "vehicle_id": vehicle_id, "trip_id": trip_id, "trip_df": trip_df}
+            for traj_id, vehicle_id, trip_id, trip_df in iterate_trip_signals())
 
-        segments = generate_segments(converted, day_num, traj_id)
+    db = SpeedDb(persistent=True)
+    for traj_id, segments in parallel_imap(process_trip, args, n_jobs=n_jobs, use_kwargs=True):
+        print(f"Trajectory: {traj_id}, segments: {len(segments)}")
         if len(segments):
-            insert_segments(segments)
+            with db.transaction():
+                insert_segments(db, segments)
+    db.close()
+
+    print(f"Refreshed edge statistics with {refresh_edge_stats()} segments")
 
 
 if __name__ == "__main__":
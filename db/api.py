@@ -1,5 +1,6 @@
 import sqlite3
 import os
+import threading
 import json
 import numpy as np
 import pandas as pd
@@ -7,6 +8,19 @@ import pandas.io.sql as sqlio
 import contextlib
 
 
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": -1048576,
+    "temp_store": "MEMORY"
+}
+
+# Integer signal columns, read as int64 arrays. NULLs in the nullable ones,
+# like quadkey or sector, are read as -1.
+SIGNAL_INTEGER_COLUMNS = {"signal_id", "vehicle_id", "trip_id", "time_stamp", "match_type",
+                          "quadkey", "week_day", "day_slot", "sector"}
+
+
 class SqlCache(object):
 
     def __init__(self, sql_dir='./db/sql/eved'):
@@ -25,55 +39,149 @@ class SqlCache(object):
 
 class BaseDb(object):
 
-    def __init__(self, folder='./db', file_name='database.db'):
+    def __init__(self, folder='./db', file_name='database.db', persistent=False):
+        """
+        Database wrapper
+        :param folder: Database folder
+        :param file_name: Database file name
+        :param persistent: Keep one open connection per thread instead of
+            opening and closing a connection on every call
+        """
         self.db_folder = folder
         self.db_file_name = os.path.join(folder, file_name)
         self.sql_cache = SqlCache()
+        self.persistent = persistent
+        self.connections = dict()
+        self.depth = dict()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def connect(self):
         return sqlite3.connect(self.db_file_name, check_same_thread=False)
 
+    @staticmethod
+    def _thread_key():
+        return os.getpid(), threading.get_ident()
+
+    def open(self):
+        """
+        Returns the calling thread's persistent connection, opening it if
+        needed. The connection stays open until close() is called.
+        """
+        key = self._thread_key()
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                conn = self.connect()
+                self.connections[key] = conn
+        return conn
+
+    def close(self):
+        """
+        Closes all the persistent connections opened by this process
+        """
+        pid = os.getpid()
+        with self.lock:
+            keys = [key for key in self.connections if key[0] == pid]
+            for key in keys:
+                self.connections.pop(key).close()
+                self.depth.pop(key, None)
+
+    def in_transaction(self):
+        return self.depth.get(self._thread_key(), 0) > 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs all the statements issued by the calling thread inside the scope
+        on a single connection and commits them once, when the outermost scope
+        exits. Rolls back on error. Scopes can be nested.
+        """
+        key = self._thread_key()
+        owned = not self.persistent and key not in self.connections
+        conn = self.open()
+        self.depth[key] = self.depth.get(key, 0) + 1
+        try:
+            yield conn
+        except BaseException:
+            self.depth[key] -= 1
+            if self.depth[key] == 0:
+                conn.rollback()
+            raise
+        else:
+            self.depth[key] -= 1
+            if self.depth[key] == 0:
+                conn.commit()
+        finally:
+            if owned and self.depth[key] == 0:
+                with self.lock:
+                    self.connections.pop(key).close()
+                    self.depth.pop(key)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Yields the connection to use for a single call: the thread's open
+        connection if there is one, or a one-shot connection otherwise
+        """
+        conn = self.connections.get(self._thread_key())
+        if conn is not None:
+            yield conn
+        elif self.persistent:
+            yield self.open()
+        else:
+            conn = self.connect()
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+    def commit(self, conn):
+        if not self.in_transaction():
+            conn.commit()
+
     def execute_sql(self, sql, parameters=None, many=False):
         if parameters is None:
             parameters = []
-        conn = self.connect()
-        cur = conn.cursor()
-        if not many:
-            cur.execute(sql, parameters)
-        else:
-            cur.executemany(sql, parameters)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            if not many:
+                cur.execute(sql, parameters)
+            else:
+                cur.executemany(sql, parameters)
+            self.commit(conn)
+            cur.close()
 
     def query_df(self, sql: str, parameters=None,
                  convert_none: bool = True) -> pd.DataFrame:
-        conn = self.connect()
-        df = sqlio.read_sql_query(sql, conn, params=parameters)
+        with self.connection() as conn:
+            df = sqlio.read_sql_query(sql, conn, params=parameters)
         if convert_none:
             df.fillna(value=np.nan, inplace=True)
-        conn.close()
         return df
 
     def query(self, sql, parameters=None):
         if parameters is None:
             parameters = []
-        conn = self.connect()
-        cur = conn.cursor()
-        result = list(cur.execute(sql, parameters))
-        cur.close()
-        conn.close()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            result = list(cur.execute(sql, parameters))
+            cur.close()
         return result
 
     @contextlib.contextmanager
     def query_iterator(self, sql, parameters=None):
         if parameters is None:
             parameters = []
-        conn = self.connect()
-        cur = conn.cursor()
-        yield cur.execute(sql, parameters)
-        cur.close()
-        conn.close()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            yield cur.execute(sql, parameters)
+            cur.close()
 
     def query_scalar(self, sql, parameters=None):
         if parameters is None:
@@ -119,21 +227,67 @@ class BaseDb(object):
         return table_name in tables
 
     def insert_list(self, sql_cache_key, values):
-        conn = self.connect()
-        cur = conn.cursor()
         sql = self.sql_cache.get(sql_cache_key)
+        self.execute_sql(sql, values, many=True)
+
+    def drop_indices(self, table):
+        """
+        Drops all the explicit indices of a table
+        :param table: Table name
+        :return: List of the CREATE INDEX statements to restore them
+        """
+        sql = """
+        select name
+        ,      sql
+        from   sqlite_master
+        where  type = 'index' and tbl_name = ? and sql is not null
+        """
+        indices = self.query(sql, [table])
+        for name, _ in indices:
+            self.execute_sql(f"DROP INDEX {name}")
+        return [index_sql for _, index_sql in indices]
+
+    def get_pragmas(self, names):
+        """
+        Reads the current values of the given pragmas
+        :return: Dictionary of pragma values, that set_pragmas can restore
+        """
+        with self.connection() as conn:
+            return {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in names}
+
+    def set_pragmas(self, pragmas):
+        with self.connection() as conn:
+            for name, value in pragmas.items():
+                conn.execute(f"PRAGMA {name} = {value}")
 
-        cur.executemany(sql, values)
-
-        conn.commit()
-        cur.close()
-        conn.close()
+    @contextlib.contextmanager
+    def bulk_load(self, table):
+        """
+        Prepares a table for a bulk load: drops its indices and relaxes the
+        durability settings of the connection. The indices are recreated and
+        the previous settings, such as a WAL journal mode, restored when the
+        scope exits.
+        :param table: Table to load
+        """
+        self.open()
+        indices = self.drop_indices(table)
+        pragmas = self.get_pragmas(BULK_LOAD_PRAGMAS.keys())
+        self.set_pragmas(BULK_LOAD_PRAGMAS)
+        try:
+            yield self
+        finally:
+            self.set_pragmas(pragmas)
+            for sql in indices:
+                self.execute_sql(sql)
+            if not self.persistent:
+                self.close()
 
 
 class EVedDb(BaseDb):
 
-    def __init__(self, folder='./db'):
-        super().__init__(folder=folder, file_name='eved.db')
+    def __init__(self, folder='./db', persistent=False):
+        super().__init__(folder=folder, file_name='eved.db',
+                         persistent=persistent)
 
         if not os.path.exists(self.db_file_name):
             self.create_schema(schema_dir='schema/eved')
@@ -141,11 +295,85 @@ class EVedDb(BaseDb):
     def insert_signals(self, signals):
         self.insert_list("signal/insert", signals)
 
+    def iterate_trips(self, columns, where=None, parameters=None, fetch_size=50_000):
+        """
+        Scans the signal table once, in (vehicle_id, trip_id, time_stamp)
+        order through the ix_signal_vehicle_trip index, and yields the
+        signals of one trip at a time. Only the current trip and one fetch
+        of rows are held in memory. The scan runs on the connection of the
+        calling thread, so a persistent database can write to the signal
+        table between trips.
+        :param columns: List of signal column names
+        :param where: Optional filter on the signal columns, like
+            "vehicle_id = ?"
+        :param parameters: Parameters of the filter
+        :param fetch_size: Number of rows per fetch
+        :return: Generator of (vehicle_id, trip_id, signals) tuples, where
+            signals maps each column name to a NumPy array of the trip's
+            values, float64 with NaN for NULL unless the column is in
+            SIGNAL_INTEGER_COLUMNS
+        """
+        if parameters is None:
+            parameters = []
+        select = [f"ifnull({column}, -1)" if column in SIGNAL_INTEGER_COLUMNS else column
+                  for column in columns]
+        dtypes = [np.int64 if column in SIGNAL_INTEGER_COLUMNS else np.float64
+                  for column in columns]
+        sql = f"""
+        select   vehicle_id
+        ,        trip_id
+        ,        {", ".join(select)}
+        from     signal indexed by ix_signal_vehicle_trip
+        {"" if where is None else "where " + where}
+        order by vehicle_id, trip_id, time_stamp
+        """
+
+        def to_arrays(rows):
+            return {column: np.array([row[i] for row in rows], dtype=dtype)
+                    for i, (column, dtype) in enumerate(zip(columns, dtypes))}
+
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql, parameters)
+                trip, rows = None, []
+                while True:
+                    batch = cur.fetchmany(fetch_size)
+                    if len(batch) == 0:
+                        break
+                    for row in batch:
+                        if row[:2] != trip:
+                            if len(rows):
+                                yield trip[0], trip[1], to_arrays(rows)
+                            trip, rows = row[:2], []
+                        rows.append(row[2:])
+                if len(rows):
+                    yield trip[0], trip[1], to_arrays(rows)
+            finally:
+                cur.close()
+
+    def bulk_insert_signals(self, chunks) -> int:
+        """
+        Bulk loads signals into an empty or existing signal table. Each chunk
+        is inserted in its own transaction, and the table indices are only
+        built after the last chunk.
+        :param chunks: Iterable of signal row lists
+        :return: Number of inserted rows
+        """
+        row_count = 0
+        with self.bulk_load("signal"):
+            for signals in chunks:
+                with self.transaction():
+                    self.insert_signals(signals)
+                row_count += len(signals)
+        return row_count
+
 
 class TrajDb(BaseDb):
 
-    def __init__(self, folder="./db"):
-        super().__init__(folder=folder, file_name="eved_traj.db")
+    def __init__(self, folder="./db", persistent=False):
+        super().__init__(folder=folder, file_name="eved_traj.db",
+                         persistent=persistent)
 
         if not os.path.exists(self.db_file_name):
             self.create_schema(schema_dir='schema/eved_traj')
@@ -162,8 +390,42 @@ class TrajDb(BaseDb):
 
 class SpeedDb(BaseDb):
 
-    def __init__(self, folder="./db"):
-        super().__init__(folder=folder, file_name="speed.db")
+    def __init__(self, folder="./db", persistent=False):
+        super().__init__(folder=folder, file_name="speed.db",
+                         persistent=persistent)
 
         if not os.path.exists(self.db_file_name):
             self.create_schema(schema_dir='schema/speed')
+
+    def create_edge_stats(self):
+        """
+        Creates the edge_stats materialization of the segment table, its
+        refresh watermark and the segment indices used for leave-one-out
+        queries, if they do not exist yet
+        """
+        sql = """
+        create table if not exists edge_stats (
+            h3_ini      INTEGER NOT NULL,
+            h3_end      INTEGER NOT NULL,
+            n           INTEGER NOT NULL,
+            dt_sum      FLOAT NOT NULL,
+            dt_sumsq    FLOAT NOT NULL,
+            dt_min      FLOAT NOT NULL,
+            dt_max      FLOAT NOT NULL,
+            sketch      BLOB NOT NULL,
+            PRIMARY KEY (h3_ini, h3_end)
+        ) without rowid;
+        """
+        self.execute_sql(sql)
+        sql = """
+        create table if not exists edge_stats_state (
+            state_id        INTEGER PRIMARY KEY CHECK (state_id = 0),
+            last_speed_id   INTEGER NOT NULL
+        );
+        """
+        self.execute_sql(sql)
+        sql = "create index if not exists segment_h3_traj_ix on segment (h3_ini, h3_end, traj_id, dt);"
+        self.execute_sql(sql)
+        sql = "create index if not exists segment_traj_ix on segment (traj_id);"
+        self.execute_sql(sql)
+
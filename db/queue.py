@@ -0,0 +1,187 @@
+import os
+import socket
+import time
+
+from db.api import BaseDb
+
+
+PENDING = 0
+RUNNING = 1
+DONE = 2
+ERROR = 3
+
+
+class WorkQueue(object):
+
+    def __init__(self, db: BaseDb, name: str):
+        """
+        Durable work queue of trajectory ids, stored in the job table of a
+        database. Each job is pending, running, done or in error. Jobs are
+        claimed atomically, so several worker processes can share a queue,
+        and they should be completed in the same transaction that writes
+        their results, so a crash never loses or duplicates work.
+        :param db: Database holding the queue, ideally the one where the
+            results are written
+        :param name: Queue name, so several pipelines can share the table
+        """
+        self.db = db
+        self.name = name
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.started_at = time.time()
+        self.create()
+
+    def create(self) -> None:
+        sql = """
+        create table if not exists job (
+            queue       TEXT    NOT NULL,
+            traj_id     INTEGER NOT NULL,
+            status      INTEGER NOT NULL DEFAULT 0,
+            worker      TEXT,
+            claimed_at  REAL,
+            result      TEXT,
+            error       TEXT,
+            PRIMARY KEY (queue, traj_id)
+        ) without rowid;
+        """
+        self.db.execute_sql(sql)
+        sql = "create index if not exists ix_job_queue_status on job (queue, status, traj_id);"
+        self.db.execute_sql(sql)
+
+    def populate(self, traj_ids) -> None:
+        """
+        Adds trajectory ids as pending jobs. Ids already in the queue keep
+        their status, so populating is idempotent.
+        """
+        sql = "insert or ignore into job (queue, traj_id, status) values (?, ?, ?)"
+        self.db.execute_sql(sql, [(self.name, int(traj_id), PENDING) for traj_id in traj_ids],
+                            many=True)
+
+    def is_stale(self, worker: str, claimed_at: float, claimed_before: float) -> bool:
+        """
+        Tells whether a running job was left behind by a dead worker. The
+        workers of this host are checked by process id only, those of other
+        hosts can only be aged out.
+        :param worker: The job's worker, as hostname:pid
+        :param claimed_at: Time the job was claimed
+        :param claimed_before: Age limit for the workers of other hosts,
+            their jobs claimed earlier are stale
+        """
+        if worker is None or claimed_at is None:
+            return True
+        if worker == self.worker:
+            # A previous process that had the same id
+            return claimed_at < self.started_at
+
+        host, _, pid = worker.rpartition(":")
+        if host != socket.gethostname():
+            return claimed_at <= claimed_before
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            pass
+        return False
+
+    def requeue(self, older_than: float = None) -> int:
+        """
+        Returns the running jobs of dead workers to the pending state, so a
+        restarted run resumes them at once
+        :param older_than: Also requeue the jobs claimed more than these
+            seconds ago, for workers on other hosts
+        :return: Number of requeued jobs
+        """
+        claimed_before = -1.0 if older_than is None else time.time() - older_than
+        sql = "select traj_id, worker, claimed_at from job where queue = ? and status = ?"
+        stale = [traj_id for traj_id, worker, claimed_at in self.db.query(sql, [self.name, RUNNING])
+                 if self.is_stale(worker, claimed_at, claimed_before)]
+
+        sql = """
+        update job
+        set    status = ?, worker = null, claimed_at = null
+        where  queue = ? and traj_id = ? and status = ?
+        """
+        self.db.execute_sql(sql, [(PENDING, self.name, traj_id, RUNNING) for traj_id in stale],
+                            many=True)
+        return len(stale)
+
+    def claim(self, n: int = 1) -> list[int]:
+        """
+        Atomically claims up to n pending jobs for this worker, in traj_id
+        order
+        :return: List of claimed trajectory ids, empty when the queue is done
+        """
+        sql = """
+        update job
+        set    status = ?, worker = ?, claimed_at = ?
+        where  queue = ? and traj_id in (
+                   select   traj_id
+                   from     job
+                   where    queue = ? and status = ?
+                   order by traj_id
+                   limit    ?)
+        returning traj_id
+        """
+        with self.db.transaction() as conn:
+            rows = conn.execute(sql, [RUNNING, self.worker, time.time(),
+                                      self.name, self.name, PENDING, n]).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def owned(self, traj_ids) -> set[int]:
+        """
+        Lists the jobs that are still running for this worker. Call it in
+        the transaction that writes the results, and skip the other ids,
+        so a job that was requeued and claimed again is only written once.
+        :param traj_ids: Trajectory ids
+        :return: Set of the trajectory ids this worker still holds
+        """
+        traj_ids = [int(traj_id) for traj_id in traj_ids]
+        if len(traj_ids) == 0:
+            return set()
+        sql = f"""
+        select traj_id
+        from   job
+        where  queue = ? and worker = ? and status = ? and traj_id in ({",".join("?" * len(traj_ids))})
+        """
+        return set(r[0] for r in self.db.query(sql, [self.name, self.worker, RUNNING] + traj_ids))
+
+    def complete(self, traj_ids, results=None) -> None:
+        """
+        Marks this worker's jobs as done, optionally storing a result with
+        each. Jobs that were requeued and claimed by another worker are left
+        to it.
+        :param traj_ids: Trajectory ids
+        :param results: Optional list of results, one per id
+        """
+        if results is None:
+            results = [None] * len(traj_ids)
+        sql = "update job set status = ?, result = ? where queue = ? and traj_id = ? and worker = ?"
+        self.db.execute_sql(sql, [(DONE, None if r is None else str(r), self.name, int(traj_id), self.worker)
+                                  for traj_id, r in zip(traj_ids, results)], many=True)
+
+    def fail(self, traj_id: int, error: str) -> None:
+        sql = "update job set status = ?, error = ? where queue = ? and traj_id = ? and worker = ?"
+        self.db.execute_sql(sql, [ERROR, error, self.name, int(traj_id), self.worker])
+
+    def iterate(self, batch_size: int = 100, older_than: float = None):
+        """
+        Claims and yields batches of jobs until the queue has no pending job.
+        Before giving up, it requeues the jobs of workers that died during
+        the run.
+        :param older_than: Age limit of running jobs, see requeue
+        :return: Generator of lists of trajectory ids
+        """
+        while True:
+            traj_ids = self.claim(batch_size)
+            if len(traj_ids) == 0:
+                if self.requeue(older_than) == 0:
+                    break
+                continue
+            yield traj_ids
+
+    def counts(self) -> dict[int, int]:
+        """
+        Number of jobs per status
+        """
+        sql = "select status, count(*) from job where queue = ? group by status"
+        return {status: count for status, count in self.db.query(sql, [self.name])}
@@ -44,5 +44,6 @@ CREATE TABLE signal (
     bearing             DOUBLE,
     quadkey             INTEGER,
     week_day            INTEGER,
-    day_slot            INTEGER
+    day_slot            INTEGER,
+    sector              INTEGER
 );
\ No newline at end of file
@@ -0,0 +1,195 @@
+import json
+import os
+
+import numpy as np
+import networkx as nx
+
+from shapely.geometry import LineString
+
+
+EDGE_ATTRIBUTES = ["length", "bearing", "speed_kph", "travel_time"]
+
+
+def encode_json(value) -> np.ndarray:
+    return np.frombuffer(json.dumps(value).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_json(array: np.ndarray):
+    return json.loads(array.tobytes().decode("utf-8"))
+
+
+def to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class GraphArrays(object):
+    """
+    Compact array form of a road network multigraph. Nodes and edges are
+    stored as flat arrays, the edge geometries as a CSR of polyline points,
+    and the derived edge attributes (length, bearing, speed and travel time)
+    as precomputed columns. Any other attribute is kept as JSON and only
+    decoded when the networkx graph is materialized.
+    """
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        self.node_ids = arrays["node_ids"]
+        self.node_lats = arrays["node_lats"]
+        self.node_lons = arrays["node_lons"]
+        self.edge_u = arrays["edge_u"]
+        self.edge_v = arrays["edge_v"]
+        self.edge_keys = arrays["edge_keys"]
+        self.geometry_offsets = arrays["geometry_offsets"]
+        self.geometry_lats = arrays["geometry_lats"]
+        self.geometry_lons = arrays["geometry_lons"]
+
+    def edge_attribute(self, name: str) -> np.ndarray:
+        """
+        Precomputed edge attribute column, NaN where the edge has none
+        """
+        return self.arrays[name]
+
+    def has_edge_attributes(self) -> bool:
+        """
+        Checks whether the derived edge attributes were computed
+        """
+        return all(not np.isnan(self.arrays[name]).all() for name in EDGE_ATTRIBUTES)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Converts a networkx multigraph
+        :param graph: Road network graph, with y and x node coordinates
+        :return: GraphArrays object
+        """
+        node_ids = np.array(list(graph.nodes), dtype=np.int64)
+        node_index = {n: i for i, n in enumerate(node_ids.tolist())}
+        node_attrs = []
+        node_lats = np.zeros(node_ids.shape[0])
+        node_lons = np.zeros(node_ids.shape[0])
+        for i, (_, data) in enumerate(graph.nodes(data=True)):
+            node_lats[i] = data["y"]
+            node_lons[i] = data["x"]
+            node_attrs.append({k: to_json_value(v) for k, v in data.items() if k not in ("y", "x")})
+
+        edges = list(graph.edges(keys=True, data=True))
+        m = len(edges)
+        arrays = {
+            "edge_u": np.zeros(m, dtype=np.int64),
+            "edge_v": np.zeros(m, dtype=np.int64),
+            "edge_keys": np.zeros(m, dtype=np.int64)
+        }
+        for name in EDGE_ATTRIBUTES:
+            arrays[name] = np.full(m, np.nan)
+
+        geometry_offsets = np.zeros(m + 1, dtype=np.int64)
+        geometry_lats = []
+        geometry_lons = []
+        edge_attrs = []
+        for i, (u, v, k, data) in enumerate(edges):
+            arrays["edge_u"][i] = node_index[u]
+            arrays["edge_v"][i] = node_index[v]
+            arrays["edge_keys"][i] = k
+            for name in EDGE_ATTRIBUTES:
+                if name in data:
+                    arrays[name][i] = data[name]
+            if "geometry" in data:
+                lons, lats = data["geometry"].xy
+                geometry_lats.extend(lats)
+                geometry_lons.extend(lons)
+            geometry_offsets[i + 1] = len(geometry_lats)
+            edge_attrs.append({k: to_json_value(v) for k, v in data.items()
+                               if k not in EDGE_ATTRIBUTES and k != "geometry"})
+
+        arrays.update({
+            "node_ids": node_ids,
+            "node_lats": node_lats,
+            "node_lons": node_lons,
+            "geometry_offsets": geometry_offsets,
+            "geometry_lats": np.array(geometry_lats, dtype=np.float64),
+            "geometry_lons": np.array(geometry_lons, dtype=np.float64),
+            "graph_attrs": encode_json({k: to_json_value(v) for k, v in graph.graph.items()}),
+            "node_attrs": encode_json(node_attrs),
+            "edge_attrs": encode_json(edge_attrs)
+        })
+        return GraphArrays(arrays)
+
+    def save(self, file_name: str) -> None:
+        np.savez(file_name, **self.arrays)
+
+    @classmethod
+    def load(cls, file_name: str):
+        with np.load(file_name) as npz:
+            return GraphArrays({name: npz[name] for name in npz.files})
+
+    @staticmethod
+    def get_cache_path(file_name: str) -> str:
+        return os.path.splitext(file_name)[0] + ".npz"
+
+    @staticmethod
+    def is_cache_valid(file_name: str) -> bool:
+        """
+        Checks whether the array cache of a GraphML file exists and is not
+        older than it
+        """
+        cache_path = GraphArrays.get_cache_path(file_name)
+        if not os.path.isfile(cache_path):
+            return False
+        return not os.path.isfile(file_name) or \
+            os.path.getmtime(cache_path) >= os.path.getmtime(file_name)
+
+    def get_edge_geometry(self, i: int) -> np.ndarray:
+        """
+        Polyline of an edge as a [lat, lon] array, from its geometry or its
+        end nodes when it has none
+        """
+        lo, hi = self.geometry_offsets[i], self.geometry_offsets[i + 1]
+        if hi > lo:
+            return np.column_stack([self.geometry_lats[lo:hi], self.geometry_lons[lo:hi]])
+        nodes = [self.edge_u[i], self.edge_v[i]]
+        return np.column_stack([self.node_lats[nodes], self.node_lons[nodes]])
+
+    def get_adjacency(self):
+        """
+        Builds a CSR adjacency with one entry per connected node pair, taken
+        from its lowest-key edge. The successors of node i are
+        adj_nodes[adj_offsets[i]:adj_offsets[i + 1]].
+        :return: Tuple with the CSR offsets, the adjacent node indices and the
+            indices of the edges they come from
+        """
+        order = np.lexsort((self.edge_keys, self.edge_v, self.edge_u))
+        u, v = self.edge_u[order], self.edge_v[order]
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        edges = order[first]
+
+        counts = np.bincount(self.edge_u[edges], minlength=self.node_ids.shape[0])
+        offsets = np.zeros(self.node_ids.shape[0] + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return offsets, self.edge_v[edges], edges
+
+    def to_graph(self):
+        """
+        Materializes the networkx multigraph
+        """
+        graph = nx.MultiDiGraph(**decode_json(self.arrays["graph_attrs"]))
+        node_attrs = decode_json(self.arrays["node_attrs"])
+        ids = self.node_ids.tolist()
+        for i, n in enumerate(ids):
+            graph.add_node(n, y=float(self.node_lats[i]), x=float(self.node_lons[i]),
+                           **node_attrs[i])
+
+        edge_attrs = decode_json(self.arrays["edge_attrs"])
+        columns = {name: self.arrays[name] for name in EDGE_ATTRIBUTES}
+        for i in range(self.edge_u.shape[0]):
+            data = edge_attrs[i]
+            for name, column in columns.items():
+                if not np.isnan(column[i]):
+                    data[name] = float(column[i])
+            lo, hi = self.geometry_offsets[i], self.geometry_offsets[i + 1]
+            if hi > lo:
+                data["geometry"] = LineString(zip(self.geometry_lons[lo:hi], self.geometry_lats[lo:hi]))
+            graph.add_edge(ids[self.edge_u[i]], ids[self.edge_v[i]], int(self.edge_keys[i]), **data)
+        return graph
@@ -0,0 +1,328 @@
+import numpy as np
+import math
+
+from numba import njit, prange
+
+
+EARTH_RADIUS = 6378137.0
+
+
+@njit()
+def vec_project(lats: np.ndarray,
+                lons: np.ndarray,
+                lat0: float,
+                lon0: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Projects locations to a local equirectangular plane in meters, centered
+    on a reference location. Accurate enough for city-sized networks.
+    :param lats: Array of latitudes in degrees
+    :param lons: Array of longitudes in degrees
+    :param lat0: Reference latitude
+    :param lon0: Reference longitude
+    :return: Tuple with the arrays of x (east) and y (north) coordinates
+    """
+    cos_lat0 = math.cos(math.radians(lat0))
+    xs = EARTH_RADIUS * np.radians(lons - lon0) * cos_lat0
+    ys = EARTH_RADIUS * np.radians(lats - lat0)
+    return xs, ys
+
+
+@njit()
+def point_segment_distance(px, py, x0, y0, x1, y1):
+    """
+    Distance from a point to a segment, in the plane
+    :return: Tuple with the distance and the position of the closest point
+        along the segment, as a fraction of its length
+    """
+    dx = x1 - x0
+    dy = y1 - y0
+    len2 = dx * dx + dy * dy
+    t = 0.0
+    if len2 > 0.0:
+        t = min(max(((px - x0) * dx + (py - y0) * dy) / len2, 0.0), 1.0)
+    cx = x0 + t * dx - px
+    cy = y0 + t * dy - py
+    return math.sqrt(cx * cx + cy * cy), t
+
+
+@njit()
+def build_grid_cells(x0, y0, x1, y1, min_x, min_y, cell_size, nx, ny):
+    """
+    Assigns each segment to all the grid cells its bounding box overlaps
+    :return: Tuple with the CSR cell offsets and the segment indices
+    """
+    n = x0.shape[0]
+    counts = np.zeros(nx * ny + 1, dtype=np.int64)
+    for s in range(n):
+        cx0 = int((min(x0[s], x1[s]) - min_x) / cell_size)
+        cx1 = int((max(x0[s], x1[s]) - min_x) / cell_size)
+        cy0 = int((min(y0[s], y1[s]) - min_y) / cell_size)
+        cy1 = int((max(y0[s], y1[s]) - min_y) / cell_size)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                counts[cx * ny + cy + 1] += 1
+
+    offsets = np.cumsum(counts)
+    fill = offsets[:-1].copy()
+    segments = np.zeros(offsets[-1], dtype=np.int64)
+    for s in range(n):
+        cx0 = int((min(x0[s], x1[s]) - min_x) / cell_size)
+        cx1 = int((max(x0[s], x1[s]) - min_x) / cell_size)
+        cy0 = int((min(y0[s], y1[s]) - min_y) / cell_size)
+        cy1 = int((max(y0[s], y1[s]) - min_y) / cell_size)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = cx * ny + cy
+                segments[fill[cell]] = s
+                fill[cell] += 1
+    return offsets, segments
+
+
+@njit()
+def grid_cell_range(px, py, r, min_x, min_y, cell_size, nx, ny):
+    cx0 = max(int(math.floor((px - r - min_x) / cell_size)), 0)
+    cx1 = min(int(math.floor((px + r - min_x) / cell_size)), nx - 1)
+    cy0 = max(int(math.floor((py - r - min_y) / cell_size)), 0)
+    cy1 = min(int(math.floor((py + r - min_y) / cell_size)), ny - 1)
+    return cx0, cx1, cy0, cy1
+
+
+@njit()
+def grid_query_nearest(px, py, bearing, max_distance,
+                       x0, y0, x1, y1, seg_edge, seg_start, seg_bearing,
+                       cell_offsets, cell_segments,
+                       min_x, min_y, cell_size, nx, ny):
+    """
+    Finds the segment nearest to a point by scanning growing squares of grid
+    cells, each time only the ring of cells not scanned before. Segments
+    within a millimeter of the nearest are considered ties (e.g. the two
+    directions of a two-way street), which are broken by the bearing, when
+    given. Points outside the grid are searched too, as far as max_distance
+    allows.
+    :return: Tuple with the edge index (-1 if none), the distance and the
+        offset of the closest point along the edge, in meters
+    """
+    best_edge = -1
+    best_dist = np.inf
+    best_offset = 0.0
+    best_cos = -2.0
+
+    # The farthest grid cell, beyond which growing the square finds nothing
+    far_x = max(abs(px - min_x), abs(min_x + nx * cell_size - px))
+    far_y = max(abs(py - min_y), abs(min_y + ny * cell_size - py))
+    extent = max(far_x, far_y)
+
+    scanned = False
+    sx0, sx1, sy0, sy1 = 0, -1, 0, -1
+    r = cell_size
+    while True:
+        r = min(r, max_distance)
+        cx0, cx1, cy0, cy1 = grid_cell_range(px, py, r, min_x, min_y, cell_size, nx, ny)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                if scanned and sx0 <= cx <= sx1 and sy0 <= cy <= sy1:
+                    continue
+
+                cell = cx * ny + cy
+                for k in range(cell_offsets[cell], cell_offsets[cell + 1]):
+                    s = cell_segments[k]
+                    d, t = point_segment_distance(px, py, x0[s], y0[s], x1[s], y1[s])
+                    if d > max_distance or d > best_dist + 1e-3:
+                        continue
+
+                    c = -1.0
+                    if not np.isnan(bearing):
+                        c = math.cos(math.radians(seg_bearing[s] - bearing))
+
+                    if d < best_dist - 1e-3 or c > best_cos:
+                        best_edge = seg_edge[s]
+                        best_dist = d
+                        best_cos = c
+                        seg_len = math.sqrt((x1[s] - x0[s]) ** 2 + (y1[s] - y0[s]) ** 2)
+                        best_offset = seg_start[s] + t * seg_len
+        if cx0 <= cx1 and cy0 <= cy1:
+            scanned = True
+            sx0, sx1, sy0, sy1 = cx0, cx1, cy0, cy1
+
+        if best_dist <= r or r >= max_distance or r > extent:
+            break
+        r *= 2.0
+    return best_edge, best_dist, best_offset
+
+
+@njit()
+def grid_query_radius(px, py, r,
+                      x0, y0, x1, y1, seg_edge, seg_start,
+                      cell_offsets, cell_segments,
+                      min_x, min_y, cell_size, nx, ny):
+    """
+    Finds all the edges with a segment within a radius of a point
+    :return: Tuple with the arrays of edge indices, distances and offsets of
+        the closest points along the edges, one entry per edge
+    """
+    edges = []
+    dists = []
+    offsets = []
+    cx0, cx1, cy0, cy1 = grid_cell_range(px, py, r, min_x, min_y, cell_size, nx, ny)
+    for cx in range(cx0, cx1 + 1):
+        for cy in range(cy0, cy1 + 1):
+            cell = cx * ny + cy
+            for k in range(cell_offsets[cell], cell_offsets[cell + 1]):
+                s = cell_segments[k]
+                d, t = point_segment_distance(px, py, x0[s], y0[s], x1[s], y1[s])
+                if d <= r:
+                    seg_len = math.sqrt((x1[s] - x0[s]) ** 2 + (y1[s] - y0[s]) ** 2)
+                    edges.append(seg_edge[s])
+                    dists.append(d)
+                    offsets.append(seg_start[s] + t * seg_len)
+
+    edge_array = np.array(edges, dtype=np.int64)
+    dist_array = np.array(dists, dtype=np.float64)
+    offset_array = np.array(offsets, dtype=np.float64)
+
+    # Keep the closest segment of each edge
+    order = np.argsort(dist_array)
+    order = order[np.argsort(edge_array[order], kind="mergesort")]
+    keep = np.ones(order.shape[0], dtype=np.bool_)
+    for i in range(1, order.shape[0]):
+        keep[i] = edge_array[order[i]] != edge_array[order[i - 1]]
+    order = order[keep]
+    return edge_array[order], dist_array[order], offset_array[order]
+
+
+@njit(parallel=True)
+def grid_query_nearest_batch(pxs, pys, bearings, max_distance,
+                             x0, y0, x1, y1, seg_edge, seg_start, seg_bearing,
+                             cell_offsets, cell_segments,
+                             min_x, min_y, cell_size, nx, ny):
+    n = pxs.shape[0]
+    edges = np.zeros(n, dtype=np.int64)
+    dists = np.zeros(n)
+    offsets = np.zeros(n)
+    for i in prange(n):
+        edges[i], dists[i], offsets[i] = grid_query_nearest(pxs[i], pys[i], bearings[i], max_distance,
+                                                            x0, y0, x1, y1, seg_edge, seg_start, seg_bearing,
+                                                            cell_offsets, cell_segments,
+                                                            min_x, min_y, cell_size, nx, ny)
+    return edges, dists, offsets
+
+
+@njit(parallel=True)
+def grid_query_radius_batch(pxs, pys, radii,
+                            x0, y0, x1, y1, seg_edge, seg_start,
+                            cell_offsets, cell_segments,
+                            min_x, min_y, cell_size, nx, ny):
+    n = pxs.shape[0]
+    counts = np.zeros(n, dtype=np.int64)
+    for i in prange(n):
+        e, _, _ = grid_query_radius(pxs[i], pys[i], radii[i],
+                                    x0, y0, x1, y1, seg_edge, seg_start,
+                                    cell_offsets, cell_segments,
+                                    min_x, min_y, cell_size, nx, ny)
+        counts[i] = e.shape[0]
+
+    query_offsets = np.zeros(n + 1, dtype=np.int64)
+    query_offsets[1:] = np.cumsum(counts)
+    edges = np.zeros(query_offsets[n], dtype=np.int64)
+    dists = np.zeros(query_offsets[n])
+    offsets = np.zeros(query_offsets[n])
+    for i in prange(n):
+        e, d, o = grid_query_radius(pxs[i], pys[i], radii[i],
+                                    x0, y0, x1, y1, seg_edge, seg_start,
+                                    cell_offsets, cell_segments,
+                                    min_x, min_y, cell_size, nx, ny)
+        edges[query_offsets[i]:query_offsets[i + 1]] = e
+        dists[query_offsets[i]:query_offsets[i + 1]] = d
+        offsets[query_offsets[i]:query_offsets[i + 1]] = o
+    return query_offsets, edges, dists, offsets
+
+
+class EdgeGrid(object):
+
+    def __init__(self,
+                 geometries: list[np.ndarray],
+                 cell_size: float = 100.0):
+        """
+        Uniform grid index over the segments of the edge geometries, in
+        locally projected meters. Each segment is listed in every cell its
+        bounding box overlaps, so queries only scan the cells around the query
+        location, regardless of how long the longest edge is.
+        :param geometries: List of edge polylines as [lat, lon] arrays
+        :param cell_size: Cell side in meters
+        """
+        lengths = np.array([g.shape[0] for g in geometries], dtype=np.int64)
+        points = np.concatenate(geometries)
+        self.lat0 = float(points[:, 0].mean())
+        self.lon0 = float(points[:, 1].mean())
+        xs, ys = vec_project(points[:, 0], points[:, 1], self.lat0, self.lon0)
+
+        # Segments join consecutive points of the same edge
+        point_edge = np.repeat(np.arange(len(geometries)), lengths)
+        valid = point_edge[1:] == point_edge[:-1]
+        self.seg_edge = point_edge[:-1][valid]
+        self.x0, self.y0 = xs[:-1][valid], ys[:-1][valid]
+        self.x1, self.y1 = xs[1:][valid], ys[1:][valid]
+        self.seg_bearing = (np.degrees(np.arctan2(self.x1 - self.x0, self.y1 - self.y0)) + 360.0) % 360.0
+
+        # Offset of each segment start along its edge
+        seg_len = np.hypot(self.x1 - self.x0, self.y1 - self.y0)
+        cum_len = np.cumsum(seg_len) - seg_len
+        first = np.searchsorted(self.seg_edge, self.seg_edge)
+        self.seg_start = cum_len - cum_len[first]
+        self.edge_length = np.bincount(self.seg_edge, weights=seg_len, minlength=len(geometries))
+
+        self.cell_size = float(cell_size)
+        self.min_x = float(xs.min()) - cell_size
+        self.min_y = float(ys.min()) - cell_size
+        self.nx = int((xs.max() - self.min_x) / cell_size) + 2
+        self.ny = int((ys.max() - self.min_y) / cell_size) + 2
+        self.cell_offsets, self.cell_segments = build_grid_cells(self.x0, self.y0, self.x1, self.y1,
+                                                                 self.min_x, self.min_y,
+                                                                 self.cell_size, self.nx, self.ny)
+
+    def project(self, locations: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        lats = np.ascontiguousarray(locations[:, 0], dtype=np.float64)
+        lons = np.ascontiguousarray(locations[:, 1], dtype=np.float64)
+        return vec_project(lats, lons, self.lat0, self.lon0)
+
+    def query_nearest(self,
+                      locations: np.ndarray,
+                      bearings: np.ndarray = None,
+                      max_distance: float = np.inf) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the nearest edge to each location, in parallel
+        :param locations: Array of locations in [lat, lon] format
+        :param bearings: Optional array of GPS bearings to break ties between
+            overlapping edges, NaN for none
+        :param max_distance: Maximum search distance in meters
+        :return: Tuple with the arrays of edge indices (-1 when there is no
+            edge within max_distance), distances and offsets along the edges
+        """
+        xs, ys = self.project(locations)
+        if bearings is None:
+            bearings = np.full(xs.shape[0], np.nan)
+        return grid_query_nearest_batch(xs, ys, np.asarray(bearings, dtype=np.float64),
+                                        float(max_distance),
+                                        self.x0, self.y0, self.x1, self.y1,
+                                        self.seg_edge, self.seg_start, self.seg_bearing,
+                                        self.cell_offsets, self.cell_segments,
+                                        self.min_x, self.min_y, self.cell_size, self.nx, self.ny)
+
+    def query_radius(self,
+                     locations: np.ndarray,
+                     r) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds all the edges within a radius of each location, in parallel
+        :param locations: Array of locations in [lat, lon] format
+        :param r: Radius in meters, either a scalar or one per location
+        :return: Tuple with the CSR query offsets and the arrays of edge
+            indices, distances and offsets along the edges. The results of
+            location i are edges[query_offsets[i]:query_offsets[i + 1]].
+        """
+        xs, ys = self.project(locations)
+        radii = np.ascontiguousarray(np.broadcast_to(np.asarray(r, dtype=np.float64), xs.shape))
+        return grid_query_radius_batch(xs, ys, radii,
+                                       self.x0, self.y0, self.x1, self.y1,
+                                       self.seg_edge, self.seg_start,
+                                       self.cell_offsets, self.cell_segments,
+                                       self.min_x, self.min_y, self.cell_size, self.nx, self.ny)
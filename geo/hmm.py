@@ -0,0 +1,373 @@
+import heapq
+import math
+
+import numpy as np
+
+from numba import njit, prange
+from geo.road import RoadNetwork
+
+
+@njit()
+def bounded_dijkstra(src, dst, limit, adj_offsets, adj_nodes, edge_len, dist, pred, touched):
+    """
+    Shortest path distances from a source node over the CSR adjacency, up to
+    a distance limit, or until a target node is settled (dst >= 0).
+    The dist and pred arrays must come in reset (inf and -1), and the touched
+    nodes must be reset by the caller with reset_dijkstra.
+    :return: Number of touched nodes, listed at the start of touched
+    """
+    n_touched = 1
+    dist[src] = 0.0
+    touched[0] = src
+    heap = [(0.0, src)]
+    while len(heap) > 0:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if u == dst:
+            break
+        for j in range(adj_offsets[u], adj_offsets[u + 1]):
+            v = adj_nodes[j]
+            dv = d + edge_len[j]
+            if dv <= limit and dv < dist[v]:
+                if dist[v] == np.inf:
+                    touched[n_touched] = v
+                    n_touched += 1
+                dist[v] = dv
+                pred[v] = j
+                heapq.heappush(heap, (dv, v))
+    return n_touched
+
+
+@njit()
+def reset_dijkstra(n_touched, dist, pred, touched):
+    for i in range(n_touched):
+        dist[touched[i]] = np.inf
+        pred[touched[i]] = -1
+
+
+@njit()
+def backtrack(t, cand_offsets, cand_point, scores, back, chosen, starts):
+    """
+    Closes a matched segment by following the back pointers from the best
+    candidate of its last point
+    """
+    lo, hi = cand_offsets[t], cand_offsets[t + 1]
+    b = lo + np.argmax(scores[lo:hi])
+    while b != -1:
+        chosen[cand_point[b]] = b
+        if back[b] == -1:
+            starts[cand_point[b]] = True
+        b = back[b]
+
+
+@njit()
+def viterbi(xs, ys, cand_offsets, cand_edges, cand_dists, cand_offs,
+            sigma, beta, max_route_factor, max_route_slack, breakage,
+            edge_src, adj_offsets, adj_nodes, edge_len, dist, pred, touched):
+    """
+    Viterbi decoding of one trajectory. The hidden states are the candidate
+    edge positions of each point, the emission score is Gaussian on the
+    distance to the edge, and the transition score is exponential on the
+    difference between the route and the straight-line distances. Moving
+    back along the same edge by less than sigma is taken as GPS noise. Points
+    without candidates are skipped, and the trajectory is split where no
+    transition is feasible.
+    :return: Tuple with the chosen candidate of each point (-1 when not
+        matched) and whether it starts a matched segment
+    """
+    n = xs.shape[0]
+    m = cand_edges.shape[0]
+    scores = np.full(m, -np.inf)
+    back = np.full(m, -1, dtype=np.int64)
+    cand_point = np.zeros(m, dtype=np.int64)
+    for t in range(n):
+        cand_point[cand_offsets[t]:cand_offsets[t + 1]] = t
+    emission = -0.5 * (cand_dists / sigma) ** 2
+
+    chosen = np.full(n, -1, dtype=np.int64)
+    starts = np.zeros(n, dtype=np.bool_)
+    prev = -1
+    for t in range(n):
+        lo, hi = cand_offsets[t], cand_offsets[t + 1]
+        if hi == lo:
+            continue
+
+        if prev != -1:
+            plo, phi = cand_offsets[prev], cand_offsets[prev + 1]
+            gc = math.sqrt((xs[t] - xs[prev]) ** 2 + (ys[t] - ys[prev]) ** 2)
+            limit = gc * max_route_factor + max_route_slack
+            feasible = False
+            if gc <= breakage:
+                for a in range(plo, phi):
+                    if scores[a] == -np.inf:
+                        continue
+                    ja = cand_edges[a]
+                    rest = edge_len[ja] - cand_offs[a]
+                    n_touched = bounded_dijkstra(adj_nodes[ja], -1, limit,
+                                                 adj_offsets, adj_nodes, edge_len,
+                                                 dist, pred, touched)
+                    for b in range(lo, hi):
+                        jb = cand_edges[b]
+                        if jb == ja and cand_offs[b] >= cand_offs[a] - sigma:
+                            route = max(cand_offs[b] - cand_offs[a], 0.0)
+                        else:
+                            route = rest + dist[edge_src[jb]] + cand_offs[b]
+                        if route > limit:
+                            continue
+                        s = scores[a] - abs(route - gc) / beta + emission[b]
+                        if s > scores[b]:
+                            scores[b] = s
+                            back[b] = a
+                            feasible = True
+                    reset_dijkstra(n_touched, dist, pred, touched)
+            if feasible:
+                prev = t
+                continue
+            backtrack(prev, cand_offsets, cand_point, scores, back, chosen, starts)
+
+        scores[lo:hi] = emission[lo:hi]
+        prev = t
+
+    if prev != -1:
+        backtrack(prev, cand_offsets, cand_point, scores, back, chosen, starts)
+    return chosen, starts
+
+
+@njit(parallel=True)
+def viterbi_batch(traj_offsets, xs, ys, cand_offsets, cand_edges, cand_dists, cand_offs,
+                  sigma, beta, max_route_factor, max_route_slack, breakage,
+                  edge_src, adj_offsets, adj_nodes, edge_len):
+    """
+    Runs the Viterbi decoding of a batch of trajectories in parallel. The
+    points of trajectory i are xs[traj_offsets[i]:traj_offsets[i + 1]] and
+    the candidates of point p are cand_offsets[p]:cand_offsets[p + 1].
+    :return: Tuple with the chosen candidate of each point and whether it
+        starts a matched segment
+    """
+    n_points = xs.shape[0]
+    n_nodes = adj_offsets.shape[0] - 1
+    chosen = np.full(n_points, -1, dtype=np.int64)
+    starts = np.zeros(n_points, dtype=np.bool_)
+    for i in prange(traj_offsets.shape[0] - 1):
+        p0, p1 = traj_offsets[i], traj_offsets[i + 1]
+        c0, c1 = cand_offsets[p0], cand_offsets[p1]
+        dist = np.full(n_nodes, np.inf)
+        pred = np.full(n_nodes, -1, dtype=np.int64)
+        touched = np.zeros(n_nodes, dtype=np.int64)
+        c, s = viterbi(xs[p0:p1], ys[p0:p1], cand_offsets[p0:p1 + 1] - c0,
+                       cand_edges[c0:c1], cand_dists[c0:c1], cand_offs[c0:c1],
+                       sigma, beta, max_route_factor, max_route_slack, breakage,
+                       edge_src, adj_offsets, adj_nodes, edge_len, dist, pred, touched)
+        for k in range(p1 - p0):
+            chosen[p0 + k] = c[k] + c0 if c[k] >= 0 else -1
+            starts[p0 + k] = s[k]
+    return chosen, starts
+
+
+@njit()
+def trace_edges(path_edges, path_offs, tolerance, edge_src, adj_offsets, adj_nodes, edge_len):
+    """
+    Expands the sequence of matched edge positions of a segment into the
+    full sequence of traversed edges, filling the gaps with shortest paths
+    :param tolerance: Backward movement along the same edge that is taken as
+        GPS noise instead of a loop, in meters
+    :return: Array of CSR edge indices
+    """
+    n_nodes = adj_offsets.shape[0] - 1
+    dist = np.full(n_nodes, np.inf)
+    pred = np.full(n_nodes, -1, dtype=np.int64)
+    touched = np.zeros(n_nodes, dtype=np.int64)
+
+    edges = [path_edges[0]]
+    for i in range(1, path_edges.shape[0]):
+        ja, jb = path_edges[i - 1], path_edges[i]
+        if ja == jb and path_offs[i] >= path_offs[i - 1] - tolerance:
+            continue
+
+        src, dst = adj_nodes[ja], edge_src[jb]
+        n_touched = bounded_dijkstra(src, dst, np.inf, adj_offsets, adj_nodes,
+                                     edge_len, dist, pred, touched)
+        gap = []
+        node = dst
+        while node != src and pred[node] != -1:
+            gap.append(pred[node])
+            node = edge_src[pred[node]]
+        reset_dijkstra(n_touched, dist, pred, touched)
+
+        for k in range(len(gap) - 1, -1, -1):
+            edges.append(gap[k])
+        edges.append(jb)
+    return np.array(edges, dtype=np.int64)
+
+
+def encode_polyline(locations: np.ndarray, precision: int = 6) -> str:
+    """
+    Encodes locations in [lat, lon] format with the Google polyline
+    algorithm, as used by Valhalla (precision 6)
+    """
+    factor = 10 ** precision
+    values = np.round(np.asarray(locations) * factor).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=[[0, 0]]).ravel()
+    chars = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return "".join(chars)
+
+
+class HmmMatcher(object):
+
+    def __init__(self, road_network: RoadNetwork,
+                 sigma: float = 10.0,
+                 beta: float = 10.0,
+                 search_radius: float = 50.0,
+                 max_candidates: int = 8,
+                 max_route_factor: float = 3.0,
+                 breakage: float = 2000.0):
+        """
+        Hidden Markov Model map matcher running on a road network, fully
+        offline. Candidates come from the edge segment grid, and trajectories
+        are decoded in parallel by a compiled Viterbi kernel with bounded
+        shortest path transitions.
+        :param road_network: RoadNetwork to match onto
+        :param sigma: GPS noise standard deviation, in meters
+        :param beta: Scale of the route vs. straight-line distance
+            difference of the transitions, in meters
+        :param search_radius: Candidate search radius, in meters
+        :param max_candidates: Maximum number of candidate edges per point
+        :param max_route_factor: Maximum ratio between the route and the
+            straight-line distances of a transition
+        :param breakage: Distance between consecutive points above which
+            the trajectory is split, in meters
+        """
+        self.rn = road_network
+        self.grid = road_network.get_edge_grid()
+        self.edge_src = road_network.edge_src
+        self.edge_len = self.grid.edge_length
+        self.sigma = sigma
+        self.beta = beta
+        self.search_radius = search_radius
+        self.max_candidates = max_candidates
+        self.max_route_factor = max_route_factor
+        self.breakage = breakage
+
+    def get_candidates(self, locations: np.ndarray):
+        """
+        Batched candidate generation, keeping the max_candidates nearest
+        edges of each location
+        :return: Tuple with the CSR candidate offsets and the arrays of edge
+            indices, distances and offsets along the edges
+        """
+        offsets, edges, dists, offs = self.grid.query_radius(locations, self.search_radius)
+        points = np.repeat(np.arange(locations.shape[0]), np.diff(offsets))
+        order = np.lexsort((dists, points))
+        rank = np.arange(order.shape[0]) - offsets[points[order]]
+        keep = order[rank < self.max_candidates]
+
+        counts = np.bincount(points[keep], minlength=locations.shape[0])
+        cand_offsets = np.zeros(locations.shape[0] + 1, dtype=np.int64)
+        cand_offsets[1:] = np.cumsum(counts)
+        return cand_offsets, edges[keep], dists[keep], offs[keep]
+
+    def cut_edge(self, j: int, start: float, end: float) -> np.ndarray:
+        """
+        Part of an edge polyline between two offsets, in [lat, lon] format
+        """
+        geometry = self.rn.arrays.get_edge_geometry(self.rn.adj_edges[j])
+        k0 = np.searchsorted(self.grid.seg_edge, j)
+        seg_start = self.grid.seg_start[k0:k0 + geometry.shape[0] - 1]
+        seg_len = np.append(np.diff(seg_start), self.edge_len[j] - seg_start[-1])
+
+        def point_at(offset):
+            k = min(max(np.searchsorted(seg_start, offset, side="right") - 1, 0), seg_len.shape[0] - 1)
+            t = (offset - seg_start[k]) / seg_len[k] if seg_len[k] > 0 else 0.0
+            return geometry[k] + min(max(t, 0.0), 1.0) * (geometry[k + 1] - geometry[k])
+
+        inner = geometry[1:-1][(seg_start[1:] > start) & (seg_start[1:] < end)]
+        return np.vstack([point_at(start), inner, point_at(end)])
+
+    def build_segment(self, path_edges: np.ndarray, path_offs: np.ndarray):
+        """
+        Builds the matched edge list and polyline of a matched segment
+        :return: Tuple with the list of (u, v) edges and the polyline in
+            [lat, lon] format
+        """
+        edges = trace_edges(path_edges, path_offs, self.sigma, self.edge_src,
+                            self.rn.adj_offsets, self.rn.adj_nodes, self.edge_len)
+
+        # Drop the end edges that are only touched within GPS noise of their
+        # end nodes
+        start, end = path_offs[0], path_offs[-1]
+        if edges.shape[0] > 1 and self.edge_len[edges[0]] - start < self.sigma:
+            edges, start = edges[1:], 0.0
+        if edges.shape[0] > 1 and end < self.sigma:
+            edges, end = edges[:-1], self.edge_len[edges[-2]]
+        if edges.shape[0] == 1:
+            parts = [self.cut_edge(edges[0], start, end)]
+        else:
+            parts = [self.cut_edge(edges[0], start, self.edge_len[edges[0]])]
+            parts += [self.cut_edge(j, 0.0, self.edge_len[j])[1:] for j in edges[1:-1]]
+            parts.append(self.cut_edge(edges[-1], 0.0, end)[1:])
+
+        ids = self.rn.ids
+        edge_list = [(ids[self.edge_src[j]], ids[self.rn.adj_nodes[j]]) for j in edges]
+        return edge_list, np.vstack(parts)
+
+    def match_batch(self, trajectories: list[np.ndarray]) -> list[list]:
+        """
+        Matches a batch of trajectories, decoding them in parallel
+        :param trajectories: List of location arrays in [lat, lon] format
+        :return: List with the matched segments of each trajectory, as
+            (edge list, polyline, point range) tuples. The point range holds
+            the indices of the first and last trajectory points of the
+            segment.
+        """
+        traj_offsets = np.zeros(len(trajectories) + 1, dtype=np.int64)
+        traj_offsets[1:] = np.cumsum([t.shape[0] for t in trajectories])
+        if traj_offsets[-1] == 0:
+            return [[] for _ in trajectories]
+
+        locations = np.vstack(trajectories)[:, :2].astype(np.float64)
+        xs, ys = self.grid.project(locations)
+        cand_offsets, cand_edges, cand_dists, cand_offs = self.get_candidates(locations)
+        chosen, starts = viterbi_batch(traj_offsets, xs, ys,
+                                       cand_offsets, cand_edges, cand_dists, cand_offs,
+                                       self.sigma, self.beta, self.max_route_factor,
+                                       2 * self.search_radius, self.breakage,
+                                       self.edge_src, self.rn.adj_offsets,
+                                       self.rn.adj_nodes, self.edge_len)
+
+        results = []
+        for i in range(len(trajectories)):
+            c = chosen[traj_offsets[i]:traj_offsets[i + 1]]
+            points = np.flatnonzero(c >= 0)
+            s = starts[traj_offsets[i]:traj_offsets[i + 1]][points]
+            c = c[points]
+            bounds = np.append(np.flatnonzero(s), c.shape[0])
+            results.append([self.build_segment(cand_edges[c[lo:hi]], cand_offs[c[lo:hi]]) +
+                            ((int(points[lo]), int(points[hi - 1])),)
+                            for lo, hi in zip(bounds[:-1], bounds[1:])])
+        return results
+
+    def match(self, locations: np.ndarray) -> list:
+        """
+        Matches a single trajectory
+        :param locations: Array of locations in [lat, lon] format
+        :return: List of matched segments as (edge list, polyline, point
+            range) tuples
+        """
+        return self.match_batch([np.asarray(locations)])[0]
+
+    def match_polylines(self, locations: np.ndarray) -> list[str]:
+        """
+        Offline counterpart of the Valhalla based map_match. The trajectory
+        is split where the matching breaks, so this returns the encoded
+        polyline of every matched segment, in trajectory order.
+        :param locations: Array of locations in [lat, lon] format
+        :return: List of encoded polylines, empty if nothing matched
+        """
+        return [encode_polyline(line) for _, line, _ in self.match(locations)]
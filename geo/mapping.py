@@ -2,12 +2,18 @@ from valhalla import Actor
 
 
 def map_match(actor: Actor,
-              coords: list[(float,float)]) -> str:
+              coords: list[(float,float)],
+              times: list[float] = None) -> str:
+    shape = [{"lat": p[1], "lon": p[0]} for p in coords]
+    if times is not None:
+        for point, time in zip(shape, times):
+            point["time"] = time
+
     param = {
-        "use_timestamps": False,
+        "use_timestamps": times is not None,
         "shortest": True,
         "shape_match": "walk_or_snap",
-        "shape": [{"lat": p[1], "lon": p[0]} for p in coords],
+        "shape": shape,
         "costing": "auto",
         "format": "osrm",
         "directions_options": {
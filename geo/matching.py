@@ -0,0 +1,62 @@
+from valhalla import Actor, get_config
+from geo.mapping import map_match
+from tools import parallel_imap
+
+
+TILE_EXTRACT = "./valhalla/custom_files/valhalla_tiles.tar"
+
+worker_actor = None
+
+
+def get_worker_actor(tile_extract: str = TILE_EXTRACT) -> Actor:
+    """
+    Returns the calling process' Valhalla Actor, creating it on first use.
+    The Actor lives as long as the process, so each pool worker only opens
+    the tile extract once.
+    :param tile_extract: Valhalla tile extract file
+    :return: Actor object
+    """
+    global worker_actor
+    if worker_actor is None:
+        config = get_config(tile_extract=tile_extract, verbose=False)
+        worker_actor = Actor(config)
+    return worker_actor
+
+
+def match_task(key, coords, times=None, tile_extract=TILE_EXTRACT):
+    """
+    Worker function: map-matches a single trajectory
+    :param key: Caller key for the trajectory, returned untouched
+    :param coords: List of (lon, lat) coordinates
+    :param times: Optional list of time stamps in seconds, one per coordinate
+    :param tile_extract: Valhalla tile extract file
+    :return: Tuple with the key, the encoded polyline (or None) and the error
+        message (or None)
+    """
+    try:
+        return key, map_match(get_worker_actor(tile_extract), coords, times), None
+    except RuntimeError as e:
+        return key, None, str(e)
+
+
+def match_trajectories(tasks,
+                       n_jobs: int = 8,
+                       max_in_flight: int = None,
+                       tile_extract: str = TILE_EXTRACT):
+    """
+    Map-matches trajectories across a pool of worker processes, each holding
+    its own long-lived Actor. Only max_in_flight trajectories are submitted
+    at any time, so the tasks can be lazily loaded and the results streamed
+    to a single writer.
+    :param tasks: Iterable of (key, coords, times) tuples, where times may
+        be None
+    :param n_jobs: Number of worker processes
+    :param max_in_flight: Maximum number of submitted but not yet consumed
+        trajectories, defaults to 2 * n_jobs
+    :param tile_extract: Valhalla tile extract file
+    :return: Generator of (key, geometry, error) tuples in completion order
+    """
+    args = ({"key": key, "coords": coords, "times": times, "tile_extract": tile_extract}
+            for key, coords, times in tasks)
+    yield from parallel_imap(match_task, args, n_jobs=n_jobs,
+                             use_kwargs=True, max_in_flight=max_in_flight)
@@ -181,6 +181,52 @@ def vec_bearings(latitudes: np.ndarray,
     return bearings
 
 
+BEARING_SECTORS = 36
+
+
+def bearing_sectors(bearings: np.ndarray,
+                    sectors: int = BEARING_SECTORS) -> np.ndarray:
+    """
+    Bins bearings into sectors centered on multiples of 360 / sectors, so
+    sector zero holds the bearings within half a sector of north
+    :param bearings: Array of bearings in degrees, from 0 to 360
+    :param sectors: Number of sectors
+    :return: Array of sector numbers
+    """
+    width = 360.0 / sectors
+    return np.floor((np.asarray(bearings, dtype=np.float64) + width / 2.0) / width).astype(np.int64) % sectors
+
+
+def bearing_sector_span(angle_delta: float,
+                        sectors: int = BEARING_SECTORS) -> int:
+    """
+    Calculates how many sectors away a bearing within angle_delta of
+    another can fall
+    :param angle_delta: Angle tolerance in degrees
+    :param sectors: Number of sectors
+    :return: Maximum sector offset
+    """
+    return min(int(math.ceil(angle_delta * sectors / 360.0)), sectors // 2)
+
+
+def bearing_sector_range(bearing: float,
+                         angle_delta: float,
+                         sectors: int = BEARING_SECTORS) -> list[int]:
+    """
+    Lists the sectors that overlap the bearings within angle_delta of a
+    bearing, so that a query can probe them before refining exactly
+    :param bearing: Bearing in degrees
+    :param angle_delta: Angle tolerance in degrees
+    :param sectors: Number of sectors
+    :return: List of sector numbers
+    """
+    if angle_delta >= 180.0:
+        return list(range(sectors))
+    lo, hi = bearing_sectors(np.array([bearing - angle_delta + 360.0, bearing + angle_delta]), sectors)
+    count = (hi - lo) % sectors + 1
+    return [int((lo + i) % sectors) for i in range(count)]
+
+
 def heron_area(a: float, b: float, c: float) -> float:
     c, b, a = np.sort(np.array([a, b, c]))
     return math.sqrt((a + (b + c)) *
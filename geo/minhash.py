@@ -0,0 +1,228 @@
+import numpy as np
+
+from numba import njit, prange
+
+
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows make sets candidates from a Jaccard similarity of
+# about (1 / 16) ** (1 / 8) = 0.7, so the many trips sharing a corridor do
+# not all collide
+LSH_BANDS = 16
+LSH_MAX_CANDIDATES = 1000
+EMPTY_HASH = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+@njit()
+def mix64(x):
+    """
+    SplitMix64 finalizer, a fast bijective mix of 64-bit integers
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@njit()
+def minhash_signature(items, seeds):
+    """
+    Calculates the MinHash signature of a set of integers, with one hash
+    function per seed
+    :param items: Array of integers, like quadkeys
+    :param seeds: Array of uint64 hash seeds
+    :return: Array of uint64 minimum hashes, EMPTY_HASH for empty sets
+    """
+    signature = np.full(seeds.shape[0], EMPTY_HASH, dtype=np.uint64)
+    for i in range(items.shape[0]):
+        x = np.uint64(items[i])
+        for k in range(seeds.shape[0]):
+            h = mix64(x ^ seeds[k])
+            if h < signature[k]:
+                signature[k] = h
+    return signature
+
+
+@njit(parallel=True)
+def minhash_signatures(offsets, items, seeds):
+    """
+    Calculates the MinHash signatures of many sets, stored as a CSR. Set i
+    is items[offsets[i]:offsets[i + 1]].
+    :return: Matrix of signatures, one row per set
+    """
+    n = offsets.shape[0] - 1
+    signatures = np.zeros((n, seeds.shape[0]), dtype=np.uint64)
+    for i in prange(n):
+        signatures[i] = minhash_signature(items[offsets[i]:offsets[i + 1]], seeds)
+    return signatures
+
+
+@njit()
+def band_hashes(signatures, bands):
+    """
+    Hashes each band of rows of the signatures into a single key
+    :return: Matrix of band keys, one row per signature
+    """
+    n = signatures.shape[0]
+    rows = signatures.shape[1] // bands
+    keys = np.zeros((n, bands), dtype=np.uint64)
+    for i in range(n):
+        for b in range(bands):
+            h = np.uint64(b)
+            for r in range(b * rows, (b + 1) * rows):
+                h = mix64(h ^ signatures[i, r])
+            keys[i, b] = h
+    return keys
+
+
+@njit()
+def lsh_candidates(query_keys, band_keys, band_items):
+    """
+    Collects the items that share at least one band key with the query
+    :param query_keys: Array of the query's band keys
+    :param band_keys: Matrix of sorted band keys, one row per band
+    :param band_items: Matrix of the items of the sorted band keys
+    :return: Array of candidate items, repeated once per shared band
+    """
+    bands = query_keys.shape[0]
+    lo = np.zeros(bands, dtype=np.int64)
+    hi = np.zeros(bands, dtype=np.int64)
+    total = 0
+    for b in range(bands):
+        lo[b] = np.searchsorted(band_keys[b], query_keys[b], side="left")
+        hi[b] = np.searchsorted(band_keys[b], query_keys[b], side="right")
+        total += hi[b] - lo[b]
+
+    candidates = np.zeros(total, dtype=np.int64)
+    k = 0
+    for b in range(bands):
+        for j in range(lo[b], hi[b]):
+            candidates[k] = band_items[b, j]
+            k += 1
+    return candidates
+
+
+@njit(parallel=True)
+def signature_similarity(signature, signatures, candidates):
+    """
+    Estimates the Jaccard similarity of a signature to candidate signatures
+    as the fraction of equal minimum hashes
+    """
+    similarity = np.zeros(candidates.shape[0])
+    for i in prange(candidates.shape[0]):
+        equal = 0
+        for k in range(signature.shape[0]):
+            if signatures[candidates[i], k] == signature[k] and signature[k] != EMPTY_HASH:
+                equal += 1
+        similarity[i] = equal / signature.shape[0]
+    return similarity
+
+
+class MinHashIndex(object):
+
+    def __init__(self, arrays: dict):
+        """
+        MinHash signatures of many sets, with an LSH banding index. The
+        signatures are a fixed-width uint64 matrix with one row per key, and
+        each band keeps its keys sorted with the rows they come from, so a
+        query costs one binary search per band.
+        Use MinHashIndex.build to create it.
+        :param arrays: Dictionary of arrays, as saved by MinHashIndex.save
+        """
+        self.keys = arrays["keys"]
+        self.seeds = arrays["seeds"]
+        self.signatures = arrays["signatures"]
+        self.band_keys = arrays["band_keys"]
+        self.band_items = arrays["band_items"]
+
+    @classmethod
+    def build(cls,
+              keys: np.ndarray,
+              offsets: np.ndarray,
+              items: np.ndarray,
+              permutations: int = MINHASH_PERMUTATIONS,
+              bands: int = LSH_BANDS,
+              seed: int = 0):
+        """
+        Builds the index of sets stored as a CSR
+        :param keys: Sorted array of set keys, like trajectory ids
+        :param offsets: CSR offsets, set i is items[offsets[i]:offsets[i + 1]]
+        :param items: Array of set items, like quadkeys
+        :param permutations: Number of hash functions, a multiple of bands
+        :param bands: Number of LSH bands. More bands with fewer rows each
+            lower the similarity at which sets become candidates.
+        :param seed: Random seed of the hash functions
+        """
+        rng = np.random.default_rng(seed)
+        seeds = rng.integers(0, np.iinfo(np.int64).max, permutations, dtype=np.int64).astype(np.uint64)
+        signatures = minhash_signatures(offsets, items, seeds)
+
+        hashes = band_hashes(signatures, bands).T
+        order = np.argsort(hashes, axis=1, kind="stable")
+        return MinHashIndex({"keys": np.asarray(keys, dtype=np.int64),
+                             "seeds": seeds,
+                             "signatures": signatures,
+                             "band_keys": np.take_along_axis(hashes, order, axis=1),
+                             "band_items": order.astype(np.int64)})
+
+    def save(self, file_name: str) -> None:
+        np.savez(file_name,
+                 keys=self.keys,
+                 seeds=self.seeds,
+                 signatures=self.signatures,
+                 band_keys=self.band_keys,
+                 band_items=self.band_items)
+
+    @staticmethod
+    def from_file(file_name: str):
+        with np.load(file_name) as data:
+            return MinHashIndex({key: data[key] for key in data.files})
+
+    def get_signature(self, key: int) -> np.ndarray | None:
+        i = np.searchsorted(self.keys, key)
+        if i < self.keys.shape[0] and self.keys[i] == key:
+            return self.signatures[i]
+        return None
+
+    def signature(self, items: np.ndarray) -> np.ndarray:
+        return minhash_signature(np.asarray(items, dtype=np.int64), self.seeds)
+
+    def query_signature(self,
+                        signature: np.ndarray,
+                        top_k: int = 10,
+                        exclude: int = None,
+                        max_candidates: int = LSH_MAX_CANDIDATES) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the most similar sets among the LSH candidates
+        :param signature: Query signature
+        :param top_k: Number of results
+        :param exclude: Key to leave out, like the query's own
+        :param max_candidates: Maximum number of candidates to compare, those
+            sharing the most bands with the query are kept
+        :return: Tuple with the arrays of keys and estimated similarities,
+            sorted by decreasing similarity
+        """
+        if np.all(signature == EMPTY_HASH):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        query_keys = band_hashes(signature.reshape(1, -1), self.band_keys.shape[0])[0]
+        candidates, shared = np.unique(lsh_candidates(query_keys, self.band_keys, self.band_items),
+                                       return_counts=True)
+        if exclude is not None:
+            keep = self.keys[candidates] != exclude
+            candidates, shared = candidates[keep], shared[keep]
+        if candidates.shape[0] > max_candidates:
+            candidates = candidates[np.argsort(-shared, kind="stable")[:max_candidates]]
+
+        similarity = signature_similarity(signature, self.signatures, candidates)
+        best = np.argsort(-similarity, kind="stable")[:top_k]
+        return self.keys[candidates[best]], similarity[best]
+
+    def query(self,
+              items: np.ndarray,
+              top_k: int = 10,
+              exclude: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the sets most similar to a set of items
+        :return: Tuple with the arrays of keys and estimated similarities,
+            sorted by decreasing similarity
+        """
+        return self.query_signature(self.signature(items), top_k, exclude)
@@ -0,0 +1,151 @@
+import os
+import math
+import numpy as np
+
+from numba import njit
+
+
+POSTING_ARRAYS = ["level", "qk_keys", "offsets", "traj_ids", "link_ids", "bearings",
+                  "traj_keys", "traj_offsets", "traj_rows"]
+
+
+@njit()
+def match_postings(query_lo, query_hi, query_bearings, cos_angle_delta,
+                   qk_keys, offsets, bearings):
+    """
+    Merges the posting lists of the query quadkey ranges, keeping the
+    postings with a compatible bearing
+    :param query_lo: Array of the lowest quadkeys of the query ranges
+    :param query_hi: Array of the highest quadkeys of the query ranges
+    :param query_bearings: Array of query bearings in degrees
+    :param cos_angle_delta: Cosine of the angle tolerance
+    :return: Tuple with the arrays of query indices and posting rows
+    """
+    list_lo = np.searchsorted(qk_keys, query_lo, side="left")
+    list_hi = np.searchsorted(qk_keys, query_hi, side="right")
+    n = 0
+    for i in range(query_lo.shape[0]):
+        for j in range(offsets[list_lo[i]], offsets[list_hi[i]]):
+            if math.cos(math.radians(query_bearings[i] - bearings[j])) >= cos_angle_delta:
+                n += 1
+
+    query_idx = np.zeros(n, dtype=np.int64)
+    rows = np.zeros(n, dtype=np.int64)
+    k = 0
+    for i in range(query_lo.shape[0]):
+        for j in range(offsets[list_lo[i]], offsets[list_hi[i]]):
+            if math.cos(math.radians(query_bearings[i] - bearings[j])) >= cos_angle_delta:
+                query_idx[k] = i
+                rows[k] = j
+                k += 1
+    return query_idx, rows
+
+
+class LinkPostings(object):
+
+    def __init__(self, arrays: dict):
+        """
+        Inverted index from quadkeys to the trajectory links that cross
+        them. The postings of qk_keys[i] are the rows offsets[i] to
+        offsets[i + 1] of the traj_ids, link_ids and bearings arrays, sorted
+        by trajectory and link. The traj_rows array lists the same rows
+        grouped by trajectory, from traj_offsets, so the links of a single
+        trajectory are also available. The arrays can be memory-mapped, see
+        LinkPostings.open.
+        :param arrays: Dictionary of arrays, as saved by LinkPostings.save
+        """
+        self.level = int(arrays["level"])
+        self.qk_keys = arrays["qk_keys"]
+        self.offsets = arrays["offsets"]
+        self.traj_ids = arrays["traj_ids"]
+        self.link_ids = arrays["link_ids"]
+        self.bearings = arrays["bearings"]
+        self.traj_keys = arrays["traj_keys"]
+        self.traj_offsets = arrays["traj_offsets"]
+        self.traj_rows = arrays["traj_rows"]
+
+    @classmethod
+    def build(cls,
+              quadkeys: np.ndarray,
+              traj_ids: np.ndarray,
+              link_ids: np.ndarray,
+              bearings: np.ndarray,
+              level: int = 20):
+        """
+        Builds the index from unsorted (quadkey, traj_id, link_id, bearing)
+        postings
+        :param level: Detail level of the quadkeys
+        """
+        order = np.lexsort((link_ids, traj_ids, quadkeys))
+        quadkeys = np.asarray(quadkeys, dtype=np.int64)[order]
+        traj_ids = np.asarray(traj_ids, dtype=np.int64)[order]
+
+        qk_keys, counts = np.unique(quadkeys, return_counts=True)
+        offsets = np.zeros(qk_keys.shape[0] + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        traj_rows = np.argsort(traj_ids, kind="stable").astype(np.int64)
+        traj_keys, counts = np.unique(traj_ids, return_counts=True)
+        traj_offsets = np.zeros(traj_keys.shape[0] + 1, dtype=np.int64)
+        traj_offsets[1:] = np.cumsum(counts)
+        return LinkPostings({"level": np.array(level),
+                             "qk_keys": qk_keys,
+                             "offsets": offsets,
+                             "traj_ids": traj_ids,
+                             "link_ids": np.asarray(link_ids, dtype=np.int64)[order],
+                             "bearings": np.asarray(bearings, dtype=np.float64)[order],
+                             "traj_keys": traj_keys,
+                             "traj_offsets": traj_offsets,
+                             "traj_rows": traj_rows})
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        for name in POSTING_ARRAYS:
+            np.save(os.path.join(folder, f"{name}.npy"), np.asarray(getattr(self, name)))
+
+    @staticmethod
+    def open(folder: str, mmap_mode: str = "r"):
+        """
+        Opens a saved index, memory-mapping its arrays by default
+        """
+        return LinkPostings({name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+                             for name in POSTING_ARRAYS})
+
+    def get_trajectory_links(self, traj_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Lists the link quadkeys of a trajectory
+        :return: Tuple with the arrays of quadkeys and link bearings
+        """
+        i = np.searchsorted(self.traj_keys, traj_id)
+        if i == self.traj_keys.shape[0] or self.traj_keys[i] != traj_id:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        rows = self.traj_rows[self.traj_offsets[i]:self.traj_offsets[i + 1]]
+        lists = np.searchsorted(self.offsets, rows, side="right") - 1
+        return self.qk_keys[lists], self.bearings[rows]
+
+    def match(self,
+              quadkeys: np.ndarray,
+              bearings: np.ndarray,
+              angle_delta: float = 2.5,
+              level: int = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the links that cross the query quadkeys with a bearing within
+        angle_delta of the query's
+        :param quadkeys: Array of query quadkeys
+        :param bearings: Array of query bearings in degrees, one per quadkey
+        :param angle_delta: Angle tolerance in degrees
+        :param level: Detail level of the query quadkeys, not above the
+            index's. Coarser quadkeys match all the links within them.
+        :return: Tuple with the arrays of link ids, matched query quadkeys
+            and trajectory ids, one entry per (query, posting) match
+        """
+        level = self.level if level is None else level
+        shift = 2 * (self.level - level)
+        quadkeys = np.asarray(quadkeys, dtype=np.int64)
+        query_lo = quadkeys << shift
+        query_idx, rows = match_postings(query_lo, query_lo + ((1 << shift) - 1),
+                                         np.asarray(bearings, dtype=np.float64),
+                                         math.cos(math.radians(angle_delta)),
+                                         self.qk_keys, self.offsets, self.bearings)
+        return self.link_ids[rows], quadkeys[query_idx], self.traj_ids[rows]
@@ -1,6 +1,10 @@
 
+import math
 import numba
+import numpy as np
+
 from numba import jit
+from raster.drawing import smooth_lines, supercover_lines
 
 
 @jit(nopython=True)
@@ -46,3 +50,258 @@ def tile_to_qk(x, y, level):
         if (y & mask) != 0:
             q += 2
     return q
+
+
+MIN_LATITUDE = -85.05112878
+MAX_LATITUDE = 85.05112878
+MIN_LONGITUDE = -180.0
+MAX_LONGITUDE = 180.0
+TILE_SIZE = 256
+
+
+@jit(nopython=True)
+def clip(n, min_value, max_value):
+    return min(max(n, min_value), max_value)
+
+
+@jit(nopython=True)
+def geo_to_tile(lat, lon, level):
+    """
+    Converts a geographic location to tile coordinates
+    Code adapted from https://docs.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+    :param lat: Latitude in degrees
+    :param lon: Longitude in degrees
+    :param level: Detail level
+    :return: Tuple with the tile x and y coordinates
+    """
+    lat = clip(lat, MIN_LATITUDE, MAX_LATITUDE)
+    lon = clip(lon, MIN_LONGITUDE, MAX_LONGITUDE)
+
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(lat * math.pi / 180.0)
+    y = 0.5 - math.log((1.0 + sin_lat) / (1.0 - sin_lat)) / (4.0 * math.pi)
+
+    map_size = TILE_SIZE << level
+    pixel_x = int(clip(x * map_size + 0.5, 0, map_size - 1))
+    pixel_y = int(clip(y * map_size + 0.5, 0, map_size - 1))
+    return pixel_x // TILE_SIZE, pixel_y // TILE_SIZE
+
+
+@jit(nopython=True)
+def tile_to_geo(x, y, level):
+    """
+    Converts tile coordinates to the geographic location of the tile's
+    north-west corner
+    :param x: Tile x coordinate
+    :param y: Tile y coordinate
+    :param level: Detail level
+    :return: Tuple with the latitude and longitude in degrees
+    """
+    map_size = TILE_SIZE << level
+    px = clip(x * TILE_SIZE, 0, map_size - 1) / map_size - 0.5
+    py = 0.5 - clip(y * TILE_SIZE, 0, map_size - 1) / map_size
+
+    lat = 90.0 - 360.0 * math.atan(math.exp(-py * 2.0 * math.pi)) / math.pi
+    lon = 360.0 * px
+    return lat, lon
+
+
+@jit(nopython=True)
+def qk_to_tile(qk, level):
+    """
+    Converts an integer quadkey to tile coordinates
+    :param qk: Integer quadkey
+    :param level: Detail level
+    :return: Tuple with the tile x and y coordinates
+    """
+    x = 0
+    y = 0
+    for i in range(level, 0, -1):
+        mask = 1 << (i - 1)
+        digit = (qk >> (2 * (i - 1))) & 3
+
+        if (digit & 1) != 0:
+            x |= mask
+        if (digit & 2) != 0:
+            y |= mask
+    return x, y
+
+
+@jit(nopython=True)
+def vec_geo_to_tile(lats: np.ndarray,
+                    lons: np.ndarray,
+                    level: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts arrays of geographic locations to tile coordinates
+    :param lats: Array of latitudes in degrees
+    :param lons: Array of longitudes in degrees
+    :param level: Detail level
+    :return: Tuple with the arrays of tile x and y coordinates
+    """
+    n = lats.shape[0]
+    xs = np.zeros(n, dtype=np.int64)
+    ys = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        xs[i], ys[i] = geo_to_tile(lats[i], lons[i], level)
+    return xs, ys
+
+
+@jit(nopython=True)
+def vec_tile_to_qk(xs: np.ndarray,
+                   ys: np.ndarray,
+                   level: int) -> np.ndarray:
+    """
+    Converts arrays of tile coordinates to integer quadkeys. The quadkeys are
+    returned as signed 64-bit integers so they can be stored in SQLite, which
+    is lossless for all levels up to 31.
+    :param xs: Array of tile x coordinates
+    :param ys: Array of tile y coordinates
+    :param level: Detail level
+    :return: Array of integer quadkeys
+    """
+    n = xs.shape[0]
+    qks = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        x = xs[i]
+        y = ys[i]
+        q = 0
+        for j in range(level, 0, -1):
+            mask = 1 << (j - 1)
+
+            q = q << 2
+            if (x & mask) != 0:
+                q += 1
+            if (y & mask) != 0:
+                q += 2
+        qks[i] = q
+    return qks
+
+
+@jit(nopython=True)
+def vec_geo_to_qk(lats: np.ndarray,
+                  lons: np.ndarray,
+                  level: int) -> np.ndarray:
+    """
+    Converts arrays of geographic locations to integer quadkeys. This is the
+    same value as quadkey.from_geo(...).to_quadint() >> (64 - 2 * level).
+    :param lats: Array of latitudes in degrees
+    :param lons: Array of longitudes in degrees
+    :param level: Detail level
+    :return: Array of integer quadkeys
+    """
+    xs, ys = vec_geo_to_tile(lats, lons, level)
+    return vec_tile_to_qk(xs, ys, level)
+
+
+@jit(nopython=True)
+def vec_qk_to_tile(qks: np.ndarray,
+                   level: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts an array of integer quadkeys to tile coordinates
+    :param qks: Array of integer quadkeys
+    :param level: Detail level
+    :return: Tuple with the arrays of tile x and y coordinates
+    """
+    n = qks.shape[0]
+    xs = np.zeros(n, dtype=np.int64)
+    ys = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        xs[i], ys[i] = qk_to_tile(qks[i], level)
+    return xs, ys
+
+
+@jit(nopython=True)
+def vec_qk_to_geo(qks: np.ndarray,
+                  level: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts an array of integer quadkeys to the locations of the tiles'
+    north-west corners
+    :param qks: Array of integer quadkeys
+    :param level: Detail level
+    :return: Tuple with the arrays of latitudes and longitudes in degrees
+    """
+    n = qks.shape[0]
+    lats = np.zeros(n)
+    lons = np.zeros(n)
+    for i in range(n):
+        x, y = qk_to_tile(qks[i], level)
+        lats[i], lons[i] = tile_to_geo(x, y, level)
+    return lats, lons
+
+
+def qk_parent(qk, level: int, parent_level: int):
+    """
+    Calculates the ancestor of integer quadkeys at a coarser level
+    :param qk: Integer quadkey or array of integer quadkeys
+    :param level: Detail level of the quadkeys
+    :param parent_level: Detail level of the ancestor, not above level
+    :return: Ancestor quadkey(s)
+    """
+    return qk >> (2 * (level - parent_level))
+
+
+def qk_children(qk) -> np.ndarray:
+    """
+    Calculates the four children of an integer quadkey, one level below
+    :param qk: Integer quadkey
+    :return: Array with the four child quadkeys
+    """
+    return (np.int64(qk) << 2) + np.arange(4, dtype=np.int64)
+
+
+def qk_child_range(qk, level: int, child_level: int) -> tuple[int, int]:
+    """
+    Calculates the inclusive range of all the descendant quadkeys at a finer
+    level. Integer quadkeys share their ancestor's bits as a prefix, so all
+    the descendants are contiguous.
+    :param qk: Integer quadkey
+    :param level: Detail level of the quadkey
+    :param child_level: Detail level of the descendants, not below level
+    :return: Tuple with the lowest and highest descendant quadkeys
+    """
+    shift = 2 * (child_level - level)
+    lo = int(qk) << shift
+    return lo, lo + (1 << shift) - 1
+
+
+def qk_child_ranges(qks: np.ndarray,
+                    level: int,
+                    child_level: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the inclusive descendant ranges of a set of integer quadkeys,
+    merging the ranges of consecutive quadkeys, so a query at a coarse level
+    becomes a few range scans over finer quadkeys
+    :param qks: Array of integer quadkeys
+    :param level: Detail level of the quadkeys
+    :param child_level: Detail level of the descendants, not below level
+    :return: Tuple with the arrays of lowest and highest descendant quadkeys
+        of each range
+    """
+    qks = np.unique(np.asarray(qks, dtype=np.int64))
+    is_first = np.ones(qks.shape[0], dtype=bool)
+    is_first[1:] = qks[1:] != qks[:-1] + 1
+    is_last = np.ones(qks.shape[0], dtype=bool)
+    is_last[:-1] = is_first[1:]
+
+    shift = 2 * (child_level - level)
+    return qks[is_first] << shift, ((qks[is_last] + 1) << shift) - 1
+
+
+def vec_line_to_qk(lats: np.ndarray,
+                   lons: np.ndarray,
+                   level: int,
+                   supercover: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rasterizes all the segments of a polyline into quadkeys in a single call
+    :param lats: Array of polyline latitudes in degrees
+    :param lons: Array of polyline longitudes in degrees
+    :param level: Detail level
+    :param supercover: Use unit-weight supercover cells instead of the
+        anti-aliased line
+    :return: Tuple with the arrays of segment indices (segment i goes from
+        point i to point i + 1), integer quadkeys and weights
+    """
+    xs, ys = vec_geo_to_tile(lats, lons, level)
+    draw_lines = supercover_lines if supercover else smooth_lines
+    segments, tx, ty, weights = draw_lines(xs[:-1], ys[:-1], xs[1:], ys[1:])
+    return segments, vec_tile_to_qk(tx, ty, level), weights
@@ -0,0 +1,190 @@
+import os
+import numpy as np
+
+from numba import njit, prange
+
+
+@njit()
+def varint_size(value):
+    size = 1
+    while value >= 128:
+        value >>= 7
+        size += 1
+    return size
+
+
+@njit()
+def encode_sets(offsets, items):
+    """
+    Encodes sorted integer sets as the LEB128 varints of their deltas
+    :param offsets: CSR offsets, set i is items[offsets[i]:offsets[i + 1]]
+    :param items: Array of non-negative integers, sorted within each set
+    :return: Tuple with the byte offsets of the sets and the encoded bytes
+    """
+    n = offsets.shape[0] - 1
+    byte_offsets = np.zeros(n + 1, dtype=np.int64)
+    for i in range(n):
+        size = 0
+        previous = 0
+        for j in range(offsets[i], offsets[i + 1]):
+            size += varint_size(items[j] - previous)
+            previous = items[j]
+        byte_offsets[i + 1] = byte_offsets[i] + size
+
+    data = np.zeros(byte_offsets[n], dtype=np.uint8)
+    for i in range(n):
+        k = byte_offsets[i]
+        previous = 0
+        for j in range(offsets[i], offsets[i + 1]):
+            delta = items[j] - previous
+            previous = items[j]
+            while delta >= 128:
+                data[k] = (delta & 127) | 128
+                delta >>= 7
+                k += 1
+            data[k] = delta
+            k += 1
+    return byte_offsets, data
+
+
+@njit()
+def decode_set(data, start, count):
+    values = np.zeros(count, dtype=np.int64)
+    k = start
+    value = 0
+    for i in range(count):
+        delta = 0
+        shift = 0
+        while True:
+            b = np.int64(data[k])
+            k += 1
+            delta |= (b & 127) << shift
+            shift += 7
+            if b < 128:
+                break
+        value += delta
+        values[i] = value
+    return values
+
+
+@njit()
+def intersection_size(query, data, start, count):
+    """
+    Counts the items of an encoded set that are in a sorted query array,
+    decoding the set on the fly
+    """
+    k = start
+    value = 0
+    q = 0
+    inter = 0
+    for i in range(count):
+        delta = 0
+        shift = 0
+        while True:
+            b = np.int64(data[k])
+            k += 1
+            delta |= (b & 127) << shift
+            shift += 7
+            if b < 128:
+                break
+        value += delta
+        while q < query.shape[0] and query[q] < value:
+            q += 1
+        if q == query.shape[0]:
+            break
+        if query[q] == value:
+            inter += 1
+            q += 1
+    return inter
+
+
+@njit(parallel=True)
+def jaccard_batch(query, data, byte_offsets, counts, rows):
+    """
+    Jaccard similarities of a sorted query array to many encoded sets
+    :param rows: Array of set rows
+    :return: Array of similarities
+    """
+    similarity = np.zeros(rows.shape[0])
+    for i in prange(rows.shape[0]):
+        r = rows[i]
+        inter = intersection_size(query, data, byte_offsets[r], counts[r])
+        union = query.shape[0] + counts[r] - inter
+        if union > 0:
+            similarity[i] = inter / union
+    return similarity
+
+
+class QuadkeySetStore(object):
+
+    def __init__(self, keys, counts, byte_offsets, data):
+        """
+        Quadkey sets of many keys, like trajectory ids, stored sorted and
+        delta-encoded as LEB128 varints in one byte array. The arrays can
+        be memory-mapped, see QuadkeySetStore.open.
+        """
+        self.keys = keys
+        self.counts = counts
+        self.byte_offsets = byte_offsets
+        self.data = data
+
+    @classmethod
+    def build(cls, keys: np.ndarray, offsets: np.ndarray, items: np.ndarray):
+        """
+        Encodes sets stored as a CSR
+        :param keys: Sorted array of set keys
+        :param offsets: CSR offsets, set i is items[offsets[i]:offsets[i + 1]]
+        :param items: Array of quadkeys, sorted and unique within each set
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        byte_offsets, data = encode_sets(offsets, np.asarray(items, dtype=np.int64))
+        return QuadkeySetStore(np.asarray(keys, dtype=np.int64), np.diff(offsets), byte_offsets, data)
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "keys.npy"), self.keys)
+        np.save(os.path.join(folder, "counts.npy"), self.counts)
+        np.save(os.path.join(folder, "byte_offsets.npy"), self.byte_offsets)
+        np.save(os.path.join(folder, "data.npy"), self.data)
+
+    @staticmethod
+    def open(folder: str, mmap_mode: str = "r"):
+        """
+        Opens a saved store, memory-mapping its arrays by default
+        """
+        arrays = [np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ["keys", "counts", "byte_offsets", "data"]]
+        return QuadkeySetStore(*arrays)
+
+    def get_rows(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :return: Array of rows of the keys, -1 for missing keys
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        rows = np.searchsorted(self.keys, keys)
+        found = rows < self.keys.shape[0]
+        found[found] = self.keys[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def get(self, key: int) -> np.ndarray:
+        """
+        :return: Sorted array of the key's quadkeys, empty if it is missing
+        """
+        row = self.get_rows(np.array([key]))[0]
+        if row < 0:
+            return np.zeros(0, dtype=np.int64)
+        return decode_set(self.data, self.byte_offsets[row], self.counts[row])
+
+    def jaccard(self, query: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """
+        Jaccard similarities of a quadkey set to the sets of many keys
+        :param query: Array of quadkeys
+        :param keys: Array of keys
+        :return: Array of similarities, zero for missing keys
+        """
+        query = np.unique(np.asarray(query, dtype=np.int64))
+        rows = self.get_rows(keys)
+        similarity = np.zeros(rows.shape[0])
+        found = rows >= 0
+        similarity[found] = jaccard_batch(query, self.data, self.byte_offsets, self.counts, rows[found])
+        return similarity
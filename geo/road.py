@@ -1,11 +1,15 @@
 from typing import Set, Tuple, Any
 
+import os
 import osmnx as ox
 import numpy as np
 
 from math import radians, cos, sqrt
+from numba import njit, prange
 from geo.spoke import GeoSpoke
-from geo.math import heron_area, heron_distance
+from geo.grid import EdgeGrid
+from geo.graph import GraphArrays
+from geo.math import heron_area, num_haversine
 
 
 def download_road_network_bbox(north, south, east, west,
@@ -48,101 +52,267 @@ def fix_edge_bearing(best_edge, bearing, graph):
     return best_edge
 
 
+@njit()
+def num_heron_distance(a: float, b: float, c: float) -> float:
+    c, b, a = np.sort(np.array([a, b, c]))
+    area = sqrt(max((a + (b + c)) *
+                    (c - (a - b)) *
+                    (c + (a - b)) *
+                    (a + (b - c)), 0.0)) / 4
+    return 2 * area / b
+
+
+@njit()
+def find_adjacent(adj_offsets, adj_nodes, u, v):
+    for j in range(adj_offsets[u], adj_offsets[u + 1]):
+        if adj_nodes[j] == v:
+            return j
+    return -1
+
+
+@njit(error_model="numpy")
+def score_candidate_edges(edges, lat, lon, bearing, nearest,
+                          edge_src, adj_offsets, adj_nodes, adj_lengths, adj_bearings,
+                          node_lats, node_lons):
+    """
+    Scores the candidate edges of a spatial query and returns the best one.
+    The score uses the triangle formed by the query location and the edge
+    nodes, so both directions of a street score the same, and the GPS
+    bearing picks the direction.
+    :param edges: Candidate CSR edge indices
+    :param lat: Query latitude
+    :param lon: Query longitude
+    :param bearing: GPS bearing in degrees, or NaN to ignore the direction
+    :param nearest: Score by the triangle (Heron) distance to the edge and
+        keep the smallest, instead of keeping the largest length ratio
+    :return: Tuple with the node indices of the best edge and its score.
+        The node indices are -1 if there is no edge.
+    """
+    best_j = -1
+    best_score = 0.0
+    for i in range(edges.shape[0]):
+        j = edges[i]
+        u = edge_src[j]
+        v = adj_nodes[j]
+
+        a = num_haversine(lat, lon, node_lats[u], node_lons[u])
+        b = adj_lengths[j]
+        c = num_haversine(lat, lon, node_lats[v], node_lons[v])
+        if nearest:
+            if b * b > a * a + c * c:
+                score = num_heron_distance(a, b, c)
+            else:
+                score = min(a, c)
+            better = score < best_score
+        else:
+            score = b / (a + c)
+            better = score > best_score
+
+        if best_j == -1 or better:
+            best_j = j
+            best_score = score
+
+    if best_j == -1:
+        return -1, -1, best_score
+
+    best_u, best_v = edge_src[best_j], adj_nodes[best_j]
+    if not np.isnan(bearing):
+        j_rev = find_adjacent(adj_offsets, adj_nodes, best_v, best_u)
+        if j_rev >= 0:
+            gps_bearing = np.radians(bearing)
+            bearing0 = np.radians(adj_bearings[best_j])
+            bearing1 = np.radians(adj_bearings[j_rev])
+            if cos(bearing1 - gps_bearing) > cos(bearing0 - gps_bearing):
+                best_u, best_v = best_v, best_u
+    return best_u, best_v, best_score
+
+
+@njit(parallel=True)
+def score_candidate_edges_batch(offsets, edges, lats, lons, valid, bearings, nearest,
+                                edge_src, adj_offsets, adj_nodes, adj_lengths, adj_bearings,
+                                node_lats, node_lons):
+    """
+    Runs score_candidate_edges for each query of a CSR batch of candidate
+    edges, in parallel. Queries with valid set to False are skipped.
+    :return: Tuple with the arrays of edge node indices and scores
+    """
+    n = offsets.shape[0] - 1
+    edge_u = np.full(n, -1, dtype=np.int64)
+    edge_v = np.full(n, -1, dtype=np.int64)
+    scores = np.zeros(n)
+    for i in prange(n):
+        if valid[i]:
+            u, v, score = score_candidate_edges(edges[offsets[i]:offsets[i + 1]],
+                                                lats[i], lons[i], bearings[i], nearest,
+                                                edge_src, adj_offsets, adj_nodes,
+                                                adj_lengths, adj_bearings,
+                                                node_lats, node_lons)
+            edge_u[i] = u
+            edge_v[i] = v
+            scores[i] = score
+    return edge_u, edge_v, scores
+
+
 class RoadNetwork(object):
 
-    def __init__(self, graph, projected=False):
-        self.graph = graph
+    def __init__(self, graph=None, projected=False, spoke_path=None, arrays=None):
+        """
+        :param graph: Road network graph
+        :param projected: Whether the graph is projected
+        :param spoke_path: Optional folder where the node spatial index is
+            cached. The index is loaded from there, memory-mapped, when it
+            matches the graph nodes, and rebuilt and saved otherwise.
+        :param arrays: GraphArrays to build the network from instead of the
+            graph, which is then only materialized when first accessed
+        """
+        self._graph = graph
+        self.arrays = GraphArrays.from_graph(graph) if arrays is None else arrays
         self.projected = projected
-        self.max_edge_length = max([graph[e[0]][e[1]][0]["length"]
-                                    for e in graph.edges])
-        self.ids, self.locations = self.get_locations()
-        self.geo_spoke = GeoSpoke(self.locations)
+        self.ids = self.arrays.node_ids
+        self.locations = np.column_stack([self.arrays.node_lats, self.arrays.node_lons])
+        self.node_index = {n: i for i, n in enumerate(self.ids.tolist())}
+        self.adj_offsets, self.adj_nodes, self.adj_edges = self.arrays.get_adjacency()
+        self.adj_lengths = self.arrays.edge_attribute("length")[self.adj_edges]
+        self.adj_bearings = self.arrays.edge_attribute("bearing")[self.adj_edges]
+        # Source node index of each CSR edge, aligned with adj_nodes
+        self.edge_src = np.repeat(np.arange(self.ids.shape[0]), np.diff(self.adj_offsets))
+        self.max_edge_length = self.adj_lengths.max()
+        if spoke_path is None:
+            self.geo_spoke = GeoSpoke(self.locations)
+        else:
+            self.geo_spoke = GeoSpoke.load_or_build(spoke_path, self.locations)
+        self.edge_grid = None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = self.arrays.to_graph()
+        return self._graph
+
+    @staticmethod
+    def get_spoke_path(file_name: str) -> str:
+        return os.path.splitext(file_name)[0] + ".spoke"
 
     def save(self, file_name: str) -> None:
         ox.io.save_graphml(self.graph, file_name)
+        self.arrays.save(GraphArrays.get_cache_path(file_name))
+        self.geo_spoke.save(self.get_spoke_path(file_name))
 
     @classmethod
     def from_file(cls, file_name: str):
+        """
+        Loads a road network saved as GraphML. The array cache saved next to
+        the file is used when it is up-to-date, and created otherwise.
+        """
+        if GraphArrays.is_cache_valid(file_name):
+            arrays = GraphArrays.load(GraphArrays.get_cache_path(file_name))
+            return RoadNetwork(arrays=arrays, projected=False,
+                               spoke_path=cls.get_spoke_path(file_name))
+
         graph = ox.io.load_graphml(file_name)
-        return RoadNetwork(graph, projected=False)
+        rn = RoadNetwork(graph, projected=False,
+                         spoke_path=cls.get_spoke_path(file_name))
+        rn.arrays.save(GraphArrays.get_cache_path(file_name))
+        return rn
 
-    def get_locations(self):
-        latitudes = []
-        longitudes = []
-        ids = []
-        for n in self.graph.nodes:
-            ids.append(n)
-            node = self.graph.nodes[n]
-            longitudes.append(node['x'])
-            latitudes.append(node['y'])
+    def get_edge_geometries(self) -> list[np.ndarray]:
+        """
+        Polyline of each CSR edge as a [lat, lon] array, from the edge
+        geometry when the graph is simplified, or the end nodes otherwise
+        """
+        return [self.arrays.get_edge_geometry(j) for j in self.adj_edges]
 
-        locations = np.array(list(zip(latitudes, longitudes)))
-        return np.array(ids), locations
+    def get_edge_grid(self, cell_size: float = 100.0) -> EdgeGrid:
+        """
+        Returns the edge segment grid index, building it on first use
+        """
+        if self.edge_grid is None:
+            self.edge_grid = EdgeGrid(self.get_edge_geometries(), cell_size)
+        return self.edge_grid
 
     def get_matching_edge(self, latitude: float, longitude: float,
                           bearing=None, min_r=1.0):
-        best_edge = None
-        loc = np.array([latitude, longitude])
-        _, r = self.geo_spoke.query_knn(loc, 1)
-        if r.min() > min_r:
-            radius = self.max_edge_length + r[0]
-            node_idx, dists = self.geo_spoke.query_radius(loc, radius)
-            nodes = self.ids[node_idx]
-            distances = dict(zip(nodes, dists))
-            tested_edges = set()
-            graph = self.graph
-            node_set = set(nodes)
-
-            for node in nodes:
-                adjacent_nodes = node_set & set(graph.adj[node])
-
-                for adjacent in adjacent_nodes:
-                    if (node, adjacent) not in tested_edges:
-                        edge_length = graph[node][adjacent][0]['length']
-                        ratio = edge_length / (distances[node] + distances[adjacent])
-
-                        if best_edge is None or ratio > best_edge[2]:
-                            best_edge = (node, adjacent, ratio)
-                        tested_edges.add((node, adjacent))
-                        tested_edges.add((adjacent, node))
-
-            if bearing is not None:
-                best_edge = fix_edge_bearing(best_edge, bearing, graph)
-        return best_edge
+        return self.get_matching_edges(np.array([[latitude, longitude]]), [bearing], min_r)[0]
+
+    def get_matching_edges(self, locations: np.ndarray,
+                           bearings=None, min_r=1.0, nearest=False) -> list:
+        """
+        Batch version of get_matching_edge (or get_nearest_edge, if nearest
+        is set) that runs the spatial queries and the edge scoring of all the
+        locations in parallel kernels. The candidates are the edges within
+        twice the distance to the nearest node, found through the edge
+        segment grid. They include the nearest edge and all the edges of the
+        nearest node, and their number does not depend on the longest edge
+        of the network.
+        :param locations: Array of locations in [lat, lon] format
+        :param bearings: Optional array of GPS bearings, one per location
+        :param min_r: Minimum distance to the nearest node to match an edge
+        :param nearest: Pick the nearest edge instead of the best matching one
+        :return: List with the best edge or None for each location
+        """
+        _, _, r = self.geo_spoke.query_knn_batch(locations, 1)
+        offsets, edges, _, _ = self.get_edge_grid().query_radius(locations, 2.0 * r)
+
+        if bearings is None:
+            bearings = np.full(locations.shape[0], np.nan)
+        else:
+            bearings = np.array([np.nan if b is None else b for b in bearings],
+                                dtype=np.float64)
+        lats = np.ascontiguousarray(locations[:, 0], dtype=np.float64)
+        lons = np.ascontiguousarray(locations[:, 1], dtype=np.float64)
+        edge_u, edge_v, scores = score_candidate_edges_batch(offsets, edges, lats, lons,
+                                                             r > min_r, bearings, nearest,
+                                                             self.edge_src,
+                                                             self.adj_offsets, self.adj_nodes,
+                                                             self.adj_lengths, self.adj_bearings,
+                                                             self.arrays.node_lats, self.arrays.node_lons)
+        return [None if u == -1 else (self.ids[u], self.ids[v], score)
+                for u, v, score in zip(edge_u, edge_v, scores)]
 
     def get_nearest_edge(self, latitude, longitude,
                          bearing=None, min_r=1.0):
-        best_edge = None
-        loc = np.array([latitude, longitude])
-        _, r = self.geo_spoke.query_knn(loc, 1)
-        if r.min() > min_r:
-            tested_edges = set()
-            graph = self.graph
-            radius = self.max_edge_length + r[0]
-            node_idx, dists = self.geo_spoke.query_radius(loc, radius)
-            nodes = self.ids[node_idx]
-            distances = dict(zip(nodes, dists))
-            node_set = set(nodes)
-
-            for node in nodes:
-                adjacent_nodes = node_set & set(graph.adj[node])
-
-                for adjacent in adjacent_nodes:
-                    if (node, adjacent) not in tested_edges:
-                        a = distances[node]
-                        b = graph[node][adjacent][0]['length']
-                        c = distances[adjacent]
-
-                        if b * b > a * a + c * c:
-                            distance = heron_distance(a, b, c)
-                        else:
-                            distance = min(a, c)
-
-                        if best_edge is None or distance < best_edge[2]:
-                            best_edge = (node, adjacent, distance)
-                        tested_edges.add((node, adjacent))
-                        tested_edges.add((adjacent, node))
-
-            if bearing is not None:
-                best_edge = fix_edge_bearing(best_edge, bearing, graph)
-        return best_edge
+        return self.get_matching_edges(np.array([[latitude, longitude]]), [bearing], min_r, nearest=True)[0]
+
+    def query_nearest_edges(self, locations: np.ndarray,
+                            bearings=None, max_distance=np.inf, min_r=0.0) -> list:
+        """
+        Finds the nearest edge to each location through the edge segment grid,
+        by distance to the edge's polyline instead of the node triangle score
+        of get_nearest_edge. When both directions of a street are equally
+        near, the one that best matches the GPS bearing is picked.
+        :param locations: Array of locations in [lat, lon] format
+        :param bearings: Optional array of GPS bearings, one per location
+        :param max_distance: Maximum distance from the location to the edge,
+            in meters
+        :param min_r: Minimum distance to the nearest node to match an edge
+        :return: List with the nearest edge as (u, v, distance) or None for
+            each location
+        """
+        valid = np.ones(locations.shape[0], dtype=bool)
+        if min_r > 0.0:
+            _, _, r = self.geo_spoke.query_knn_batch(locations, 1)
+            valid = r > min_r
+        if bearings is not None:
+            bearings = np.array([np.nan if b is None else b for b in bearings],
+                                dtype=np.float64)
+        edges, dists, _ = self.get_edge_grid().query_nearest(locations, bearings, max_distance)
+        return [None if j == -1 or not ok else (self.ids[self.edge_src[j]], self.ids[self.adj_nodes[j]], d)
+                for j, d, ok in zip(edges, dists, valid)]
+
+    def query_edges_radius(self, locations: np.ndarray, r) -> list:
+        """
+        Finds all the edges within a radius of each location through the edge
+        segment grid
+        :param locations: Array of locations in [lat, lon] format
+        :param r: Radius in meters, either a scalar or one per location
+        :return: List with the (u, v, distance) edges of each location, sorted
+            by distance
+        """
+        query_offsets, edges, dists, _ = self.get_edge_grid().query_radius(locations, r)
+        results = []
+        for i in range(locations.shape[0]):
+            lo, hi = query_offsets[i], query_offsets[i + 1]
+            order = np.argsort(dists[lo:hi], kind="stable") + lo
+            results.append([(self.ids[self.edge_src[j]], self.ids[self.adj_nodes[j]], dists[k])
+                            for k, j in zip(order, edges[order])])
+        return results
@@ -1,12 +1,17 @@
 from typing import Tuple
 
 import numpy as np
+import json
 import math
+import os
 
-from numba import njit
+from numba import njit, prange
 from geo.math import num_haversine, vec_haversine
 
 
+SPOKE_ARRAYS = ["lats", "lons", "idx0", "idx1", "sorted0", "sorted1"]
+
+
 @njit()
 def calculate_sorted_distances(latitudes, longitudes, lat, lon):
     dist = vec_haversine(latitudes, longitudes, lat, lon)
@@ -39,23 +44,22 @@ def numba_query_radius(lat, lon, radius,
     return intersect[ix], dist[ix]
 
 
+@njit()
 def spoke_query_knn(lat, lon, k, lat0, lon0, lat1, lon1, density,
                     idx0, idx1, sorted0, sorted1, lats, lons):
     d0 = num_haversine(lat, lon, lat0, lon0)
     d1 = num_haversine(lat, lon, lat1, lon1)
     r = math.sqrt(k / density) * 2.0
+    k = min(k, lats.shape[0])
 
-    idx0 = idx0
-    idx1 = idx1
-    sorted0 = sorted0
-    sorted1 = sorted1
-
-    intersect = np.zeros(0)
+    intersect = np.zeros(0, dtype=idx0.dtype)
     while intersect.shape[0] < k:
-        s0 = np.searchsorted(sorted0, [d0 - r, d0 + r])
-        s1 = np.searchsorted(sorted1, [d1 - r, d1 + r])
-        intersect = np.intersect1d(idx0[s0[0]:s0[1] + 1],
-                                   idx1[s1[0]:s1[1] + 1])
+        i0 = np.searchsorted(sorted0, d0 - r)
+        i1 = np.searchsorted(sorted0, d0 + r)
+        j0 = np.searchsorted(sorted1, d1 - r)
+        j1 = np.searchsorted(sorted1, d1 + r)
+        intersect = np.intersect1d(idx0[i0:i1 + 1],
+                                   idx1[j0:j1 + 1])
         r *= 4
 
     dist = vec_haversine(lats[intersect],
@@ -66,6 +70,74 @@ def spoke_query_knn(lat, lon, k, lat0, lon0, lat1, lon1, density,
     return intersect[idx][:k], dist[idx][:k]
 
 
+@njit(parallel=True)
+def spoke_query_knn_batch(query_lats, query_lons, k,
+                          lat0, lon0, lat1, lon1, density,
+                          idx0, idx1, sorted0, sorted1, lats, lons):
+    """
+    Runs one k-nearest neighbor query per location in parallel
+    :return: Tuple with the CSR offsets, indices and distances. The results
+        of query i are indices[offsets[i]:offsets[i + 1]], sorted by distance.
+    """
+    n = query_lats.shape[0]
+    kk = min(k, lats.shape[0])
+    offsets = np.arange(n + 1) * kk
+    indices = np.zeros(n * kk, dtype=idx0.dtype)
+    distances = np.zeros(n * kk)
+
+    for i in prange(n):
+        ix, dist = spoke_query_knn(query_lats[i], query_lons[i], k,
+                                   lat0, lon0, lat1, lon1, density,
+                                   idx0, idx1, sorted0, sorted1, lats, lons)
+        indices[offsets[i]:offsets[i + 1]] = ix
+        distances[offsets[i]:offsets[i + 1]] = dist
+    return offsets, indices, distances
+
+
+@njit(parallel=True)
+def numba_query_radius_batch(query_lats, query_lons, radii,
+                             lat0, lon0, lat1, lon1,
+                             lats, lons,
+                             sorted0, sorted1,
+                             idx0, idx1):
+    """
+    Runs one radius query per location in parallel. The output is first sized
+    with a cheap upper bound (the smaller of the two spoke rings), filled in
+    parallel and then compacted.
+    :return: Tuple with the CSR offsets, indices and distances. The results
+        of query i are indices[offsets[i]:offsets[i + 1]].
+    """
+    n = query_lats.shape[0]
+    bounds = np.zeros(n + 1, dtype=np.int64)
+    for i in prange(n):
+        d0 = num_haversine(query_lats[i], query_lons[i], lat0, lon0)
+        d1 = num_haversine(query_lats[i], query_lons[i], lat1, lon1)
+        n0 = np.searchsorted(sorted0, d0 + radii[i]) - np.searchsorted(sorted0, d0 - radii[i]) + 1
+        n1 = np.searchsorted(sorted1, d1 + radii[i]) - np.searchsorted(sorted1, d1 - radii[i]) + 1
+        bounds[i + 1] = min(n0, n1)
+    bounds = np.cumsum(bounds)
+
+    counts = np.zeros(n, dtype=np.int64)
+    buffer_idx = np.zeros(bounds[n], dtype=idx0.dtype)
+    buffer_dist = np.zeros(bounds[n])
+    for i in prange(n):
+        ix, dist = numba_query_radius(query_lats[i], query_lons[i], radii[i],
+                                      lat0, lon0, lat1, lon1, lats, lons,
+                                      sorted0, sorted1, idx0, idx1)
+        counts[i] = ix.shape[0]
+        buffer_idx[bounds[i]:bounds[i] + counts[i]] = ix
+        buffer_dist[bounds[i]:bounds[i] + counts[i]] = dist
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    indices = np.zeros(offsets[n], dtype=idx0.dtype)
+    distances = np.zeros(offsets[n])
+    for i in prange(n):
+        indices[offsets[i]:offsets[i + 1]] = buffer_idx[bounds[i]:bounds[i] + counts[i]]
+        distances[offsets[i]:offsets[i + 1]] = buffer_dist[bounds[i]:bounds[i] + counts[i]]
+    return offsets, indices, distances
+
+
 class GeoSpoke(object):
 
     def __init__(self, locations: np.ndarray):
@@ -90,6 +162,65 @@ class GeoSpoke(object):
         self.idx0, self.sorted0 = calculate_sorted_distances(self.lats, self.lons, self.lat0, self.lon0)
         self.idx1, self.sorted1 = calculate_sorted_distances(self.lats, self.lons, self.lat1, self.lon1)
 
+    def save(self, path: str) -> None:
+        """
+        Saves the index to a folder with one .npy file per array, plus a JSON
+        file with the spoke anchors and the point density.
+        :param path: Index folder
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in SPOKE_ARRAYS:
+            np.save(os.path.join(path, name + ".npy"),
+                    np.ascontiguousarray(getattr(self, name)))
+
+        meta = {
+            "lat0": float(self.lat0), "lon0": float(self.lon0),
+            "lat1": float(self.lat1), "lon1": float(self.lon1),
+            "density": float(self.density)
+        }
+        with open(os.path.join(path, "spoke.json"), "w") as f:
+            f.write(json.dumps(meta))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        Loads an index saved with save(). The arrays are memory-mapped read
+        only by default, so processes loading the same index share the pages.
+        :param path: Index folder
+        :param mmap: Memory-map the arrays instead of reading them
+        :return: GeoSpoke object
+        """
+        with open(os.path.join(path, "spoke.json"), "r") as f:
+            meta = json.loads(f.read())
+
+        spoke = cls.__new__(cls)
+        mmap_mode = "r" if mmap else None
+        for name in SPOKE_ARRAYS:
+            array = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            setattr(spoke, name, np.asarray(array))
+        for name, value in meta.items():
+            setattr(spoke, name, value)
+        return spoke
+
+    @classmethod
+    def load_or_build(cls, path: str, locations: np.ndarray):
+        """
+        Loads the index from path if it exists and was built from the same
+        locations, otherwise builds it and saves it to path.
+        :param path: Index folder
+        :param locations: Array of locations in [lat, lon] format
+        :return: GeoSpoke object
+        """
+        if os.path.isfile(os.path.join(path, "spoke.json")):
+            spoke = cls.load(path)
+            if np.array_equal(spoke.lats, locations[:, 0]) and \
+                    np.array_equal(spoke.lons, locations[:, 1]):
+                return spoke
+
+        spoke = cls(locations)
+        spoke.save(path)
+        return spoke
+
     def query_radius(self,
                      location: np.ndarray,
                      r: float) -> tuple[np.ndarray, np.ndarray]:
@@ -114,3 +245,44 @@ class GeoSpoke(object):
         return spoke_query_knn(lat, lon, k, self.lat0, self.lon0, self.lat1, self.lon1,
                                self.density, self.idx0, self.idx1, self.sorted0, self.sorted1,
                                self.lats, self.lons)
+
+    def query_radius_batch(self,
+                           locations: np.ndarray,
+                           r) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Runs a radius query for each of the given locations, in parallel.
+        :param locations: Array of locations to query in [lat, lon] format
+        :param r: Radius in meters, either a scalar or one per location
+        :return: Tuple with the CSR offsets, indices and distances. The
+            results of location i are indices[offsets[i]:offsets[i + 1]].
+        """
+        lats = np.ascontiguousarray(locations[:, 0], dtype=np.float64)
+        lons = np.ascontiguousarray(locations[:, 1], dtype=np.float64)
+        radii = np.ascontiguousarray(np.broadcast_to(np.asarray(r, dtype=np.float64),
+                                                     lats.shape))
+
+        return numba_query_radius_batch(lats, lons, radii,
+                                        self.lat0, self.lon0, self.lat1, self.lon1,
+                                        self.lats, self.lons, self.sorted0, self.sorted1,
+                                        self.idx0, self.idx1)
+
+    def query_knn_batch(self,
+                        locations: np.ndarray,
+                        k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Runs a k-nearest neighbor query for each of the given locations, in
+        parallel.
+        :param locations: Array of locations to query in [lat, lon] format
+        :param k: Number of neighbors
+        :return: Tuple with the CSR offsets, indices and distances. The
+            results of location i are indices[offsets[i]:offsets[i + 1]],
+            sorted by distance.
+        """
+        lats = np.ascontiguousarray(locations[:, 0], dtype=np.float64)
+        lons = np.ascontiguousarray(locations[:, 1], dtype=np.float64)
+
+        return spoke_query_knn_batch(lats, lons, k,
+                                     self.lat0, self.lon0, self.lat1, self.lon1,
+                                     self.density, self.idx0, self.idx1,
+                                     self.sorted0, self.sorted1,
+                                     self.lats, self.lons)
@@ -1,3 +1,4 @@
+import json
 import math
 import numpy as np
 import pandas as pd
@@ -6,11 +7,25 @@ import osmnx as ox
 import geopandas as gpd
 import networkx as nx
 from numba import jit
-from pyquadkey2 import quadkey
-from geo.qk import tile_to_str
-from raster.drawing import smooth_line
+from geo.math import BEARING_SECTORS, bearing_sector_range, bearing_sector_span
+from geo.qk import vec_line_to_qk, qk_child_ranges
 from itertools import pairwise
 from db.api import EVedDb
+from geo.graph import GraphArrays
+from geo.minhash import MinHashIndex
+from geo.postings import LinkPostings
+from geo.qkset import QuadkeySetStore
+from geo.road import download_road_network
+
+
+# Detail level of the quadkeys stored in link_qk. Queries at coarser levels
+# become quadkey range scans.
+LINK_QK_LEVEL = 20
+
+LINK_DTYPE = np.dtype([("link_id", np.int64),
+                       ("traj_id", np.int64),
+                       ("signal_ini", np.int64),
+                       ("signal_end", np.int64)])
 
 
 def geocode_address(address, crs=4326):
@@ -20,17 +35,6 @@ def geocode_address(address, crs=4326):
     return geocode.iloc[0].geometry.y, geocode.iloc[0].geometry.x
 
 
-def get_qk_line(loc0, loc1, level):
-    qk0 = quadkey.from_geo((loc0['y'], loc0['x']), level)
-    qk1 = quadkey.from_geo((loc1['y'], loc1['x']), level)
-
-    ((tx0, ty0), _) = qk0.to_tile()
-    ((tx1, ty1), _) = qk1.to_tile()
-
-    line = smooth_line(tx0, ty0, tx1, ty1)
-    return [(quadkey.from_str(tile_to_str(int(p[0]), int(p[1]), level)), p[2]) for p in line if p[2] > 0.0]
-
-
 def load_signal_range(r):
     db = EVedDb()
     sql = """
@@ -86,6 +90,125 @@ def load_trajectory_quadkeys(traj_id):
     return qks
 
 
+def load_all_trajectory_quadkeys() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loads the quadkey sets of all the trajectories in a single pass
+    :return: Tuple with the sorted array of trajectory ids and the CSR
+        offsets and quadkeys of their sets
+    """
+    db = EVedDb()
+
+    sql = """
+    select distinct
+               t.traj_id
+    ,          s.quadkey
+    from       signal s
+    inner join trajectory t on s.vehicle_id = t.vehicle_id and s.trip_id = t.trip_id
+    where      s.quadkey is not null
+    order by   t.traj_id, s.quadkey;
+    """
+    df = db.query_df(sql)
+    traj_ids, counts = np.unique(df["traj_id"].to_numpy(dtype=np.int64), return_counts=True)
+    offsets = np.zeros(traj_ids.shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return traj_ids, offsets, df["quadkey"].to_numpy(dtype=np.int64)
+
+
+def load_link_postings() -> LinkPostings:
+    """
+    Builds the quadkey posting lists of the trajectory links with a bearing
+    in a single pass over link_qk
+    """
+    db = EVedDb()
+
+    sql = """
+    select     q.quadkey
+    ,          l.traj_id
+    ,          q.link_id
+    ,          l.bearing
+    from       link_qk q
+    inner join link l on l.link_id = q.link_id
+    where      l.bearing > 0;
+    """
+    df = db.query_df(sql)
+    return LinkPostings.build(df["quadkey"].to_numpy(dtype=np.int64),
+                              df["traj_id"].to_numpy(dtype=np.int64),
+                              df["link_id"].to_numpy(dtype=np.int64),
+                              df["bearing"].to_numpy(dtype=np.float64),
+                              LINK_QK_LEVEL)
+
+
+def load_area_trajectories(quadkeys, level=LINK_QK_LEVEL) -> np.ndarray:
+    """
+    Finds the trajectories with links that touch an area, with one link_qk
+    range scan per run of consecutive quadkeys
+    :param quadkeys: Array of integer quadkeys covering the area
+    :param level: Detail level of the quadkeys, not above LINK_QK_LEVEL
+    :return: Sorted array of trajectory ids
+    """
+    db = EVedDb()
+
+    ranges = np.column_stack(qk_child_ranges(quadkeys, level, LINK_QK_LEVEL))
+    sql = """
+    select distinct
+               l.traj_id
+    from       (
+        select json_extract(value, '$[0]') as lo
+        ,      json_extract(value, '$[1]') as hi
+        from   json_each(?)
+    ) r
+    cross join link_qk q on q.quadkey between r.lo and r.hi
+    inner join link l on l.link_id = q.link_id
+    order by   l.traj_id;
+    """
+    rows = db.query(sql, [json.dumps(ranges.tolist())])
+    return np.array([row[0] for row in rows], dtype=np.int64)
+
+
+def load_area_counts(quadkeys, level) -> pd.DataFrame:
+    """
+    Reads the precomputed link and trajectory counts of quadkeys
+    :param quadkeys: Array of integer quadkeys
+    :param level: Detail level of the quadkeys, one of the levels of the
+        link_qk_count table
+    :return: DataFrame with the quadkey, link_count and traj_count of the
+        quadkeys with links
+    """
+    db = EVedDb()
+
+    sql = """
+    select     c.quadkey
+    ,          c.link_count
+    ,          c.traj_count
+    from       json_each(?) j
+    cross join link_qk_count c on c.level = ? and c.quadkey = j.value
+    order by   c.quadkey;
+    """
+    quadkeys = np.unique(np.asarray(quadkeys, dtype=np.int64))
+    return db.query_df(sql, [json.dumps(quadkeys.tolist()), level])
+
+
+def load_links(link_ids) -> np.ndarray:
+    """
+    Loads links by id in a single query
+    :return: Structured array of links with LINK_DTYPE, sorted by
+        trajectory and first signal
+    """
+    db = EVedDb()
+
+    sql = """
+    select     l.link_id
+    ,          l.traj_id
+    ,          l.signal_ini
+    ,          l.signal_end
+    from       json_each(?) j
+    cross join link l on l.link_id = j.value
+    order by   l.traj_id, l.signal_ini;
+    """
+    rows = db.query(sql, [json.dumps([int(link_id) for link_id in link_ids])])
+    return np.array(rows, dtype=LINK_DTYPE)
+
+
 def load_trajectory_points(traj_id, unique=False):
     db = EVedDb()
 
@@ -104,6 +227,29 @@ def load_trajectory_points(traj_id, unique=False):
     return db.query(sql, [traj_id])
 
 
+def iterate_trajectory_points(unique=False):
+    """
+    Reads the points of all the trajectories in a single scan of the signal
+    table, instead of one load_trajectory_points query per trajectory
+    :param unique: Keep only the first of repeated points
+    :return: Generator of (traj_id, points) tuples, with the points as
+        load_trajectory_points returns them
+    """
+    db = EVedDb()
+
+    sql = "select traj_id, vehicle_id, trip_id from trajectory"
+    traj_ids = {(vehicle_id, trip_id): traj_id for traj_id, vehicle_id, trip_id in db.query(sql)}
+
+    columns = ["match_latitude", "match_longitude", "bearing"]
+    for vehicle_id, trip_id, signals in db.iterate_trips(columns):
+        if (vehicle_id, trip_id) in traj_ids:
+            points = [(lat, lon, None if math.isnan(bearing) else bearing)
+                      for lat, lon, bearing in zip(*[signals[column].tolist() for column in columns])]
+            if unique:
+                points = list(dict.fromkeys(points))
+            yield traj_ids[(vehicle_id, trip_id)], points
+
+
 def load_link_points(link_id):
     db = EVedDb()
 
@@ -127,15 +273,96 @@ def jaccard_similarity(set0, set1):
     return len(set0 & set1) / len(set0 | set1)
 
 
+def calculate_jaccard_similarities(query_set, traj_ids, store: QuadkeySetStore = None) -> list[float]:
+    """
+    Exact Jaccard similarities of a quadkey set to trajectories, in a single
+    compiled pass over the encoded store when there is one
+    """
+    if store is not None:
+        query = np.array(sorted(query_set), dtype=np.int64)
+        return store.jaccard(query, np.asarray(traj_ids, dtype=np.int64)).tolist()
+    return [jaccard_similarity(query_set, load_trajectory_quadkeys(int(traj_id)))
+            for traj_id in traj_ids]
+
+
+def rank_similar_trajectories(index: MinHashIndex,
+                              signature: np.ndarray,
+                              query_set=None,
+                              top_k=10,
+                              shortlist=50,
+                              exclude=None,
+                              store: QuadkeySetStore = None) -> list[tuple[int, float]]:
+    """
+    Finds the trajectories most similar to a query through the MinHash
+    index, optionally re-ranking a shortlist with the exact Jaccard
+    similarity
+    :param index: MinHash index of the trajectory quadkey sets
+    :param signature: Query signature
+    :param query_set: Query quadkey set, for the exact re-ranking
+    :param top_k: Number of results
+    :param shortlist: Number of candidates to re-rank exactly
+    :param exclude: Trajectory to leave out
+    :param store: Encoded quadkey sets, for the exact re-ranking
+    :return: List of (traj_id, similarity) tuples by decreasing similarity
+    """
+    if query_set is None:
+        traj_ids, similarity = index.query_signature(signature, top_k, exclude)
+        return list(zip(traj_ids.tolist(), similarity.tolist()))
+
+    traj_ids, _ = index.query_signature(signature, max(top_k, shortlist), exclude)
+    data = list(zip(traj_ids.tolist(), calculate_jaccard_similarities(query_set, traj_ids, store)))
+    data.sort(key=lambda item: item[1], reverse=True)
+    return data[:top_k]
+
+
 class GraphRoute(object):
 
-    def __init__(self, graph):
-        self.graph = graph
-        self.graph = ox.add_edge_speeds(self.graph)
-        self.graph = ox.add_edge_travel_times(self.graph)
-        self.graph = ox.bearing.add_edge_bearings(self.graph)
+    def __init__(self, graph=None, arrays=None):
+        """
+        :param graph: Road network graph
+        :param arrays: GraphArrays with the precomputed edge speeds, travel
+            times and bearings, used instead of the graph. The graph is then
+            only materialized when first accessed.
+        """
+        if graph is None and arrays is None:
+            raise ValueError("GraphRoute requires either a graph or arrays")
+        if arrays is None or not arrays.has_edge_attributes():
+            graph = arrays.to_graph() if graph is None else graph
+            graph = ox.add_edge_speeds(graph)
+            graph = ox.add_edge_travel_times(graph)
+            graph = ox.bearing.add_edge_bearings(graph)
+            arrays = GraphArrays.from_graph(graph)
+        self._graph = graph
+        self.arrays = arrays
         self.route = None
 
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = self.arrays.to_graph()
+        return self._graph
+
+    @classmethod
+    def from_place(cls, place_name):
+        return GraphRoute(download_road_network(place_name))
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        Loads a road network saved as GraphML, through its array cache when
+        it is up-to-date
+        """
+        if GraphArrays.is_cache_valid(file_name):
+            return GraphRoute(arrays=GraphArrays.load(GraphArrays.get_cache_path(file_name)))
+
+        gr = GraphRoute(ox.io.load_graphml(file_name))
+        gr.arrays.save(GraphArrays.get_cache_path(file_name))
+        return gr
+
+    def save(self, file_name):
+        ox.io.save_graphml(self.graph, file_name)
+        self.arrays.save(GraphArrays.get_cache_path(file_name))
+
     def generate_route(self, addr_ini, addr_end, weight='travel_time'):
         g = self.graph
         loc_ini = geocode_address(addr_ini)
@@ -151,67 +378,120 @@ class GraphRoute(object):
     def get_route_nodes(self):
         return [self.graph.nodes[n] for n in self.route]
 
-    def get_route_quadkeys(self, level=20):
-        qks = set()
+    def get_route_quadkeys(self, level=LINK_QK_LEVEL):
         g = self.graph
-        shift = 64 - 2 * level
-        for n0, n1 in pairwise(self.route):
-            edge = g[n0][n1]
-            l0 = g.nodes[n0]
-            l1 = g.nodes[n1]
-            qks.update([(qk.to_quadint() >> shift, edge[0]['bearing'])
-                        for qk, _ in get_qk_line(l0, l1, level)])
-        return list(qks)
-
-    def get_overlapping_links(self, level=20, angle_delta=2.5):
-        qks = self.get_route_quadkeys(level)
-        cos_angle_delta = math.cos(math.radians(angle_delta))
-
-        sql = """
-        select     q.link_id
+        nodes = [g.nodes[n] for n in self.route]
+        lats = np.array([node['y'] for node in nodes], dtype=np.float64)
+        lons = np.array([node['x'] for node in nodes], dtype=np.float64)
+        bearings = np.array([g[n0][n1][0]['bearing'] for n0, n1 in pairwise(self.route)])
+
+        segments, qks, _ = vec_line_to_qk(lats, lons, level)
+        return list(set(zip(qks.tolist(), bearings[segments].tolist())))
+
+    def get_overlapping_links(self, level=LINK_QK_LEVEL, angle_delta=2.5, postings: LinkPostings = None):
+        """
+        Finds the trajectory links that overlap the route in a single query.
+        The route's (quadkey, sector, bearing) probes are passed as one JSON
+        parameter, joined to the (quadkey, sector) index of link_qk, and
+        refined on the exact bearing. Below LINK_QK_LEVEL, each route
+        quadkey probes the range of its descendants.
+        :param level: Detail level of the route quadkeys
+        :param postings: Link posting lists, merged in memory instead of
+            probing link_qk
+        :return: Structured array of links with LINK_DTYPE, sorted by
+            trajectory and first signal
+        """
+        if postings is not None:
+            route_qks = self.get_route_quadkeys(level)
+            link_ids, _, _ = postings.match(np.array([qk for qk, _ in route_qks], dtype=np.int64),
+                                            np.array([bearing for _, bearing in route_qks]),
+                                            angle_delta, level)
+            return load_links(np.unique(link_ids))
+
+        shift = 2 * (LINK_QK_LEVEL - level)
+        probes = [[qk << shift, ((qk + 1) << shift) - 1, sector, bearing]
+                  for qk, bearing in self.get_route_quadkeys(level)
+                  for sector in bearing_sector_range(bearing, angle_delta)]
+
+        # A level-20 probe is a single quadkey, so it keeps the equality that
+        # seeks on the whole (quadkey, sector) index
+        quadkey_join = "q.quadkey = r.lo" if shift == 0 else "q.quadkey between r.lo and r.hi"
+        sql = f"""
+        select distinct
+                   q.link_id
         ,          l.traj_id
         ,          l.signal_ini
         ,          l.signal_end
-        from       link_qk q
+        from       (
+            select json_extract(value, '$[0]') as lo
+            ,      json_extract(value, '$[1]') as hi
+            ,      json_extract(value, '$[2]') as sector
+            ,      json_extract(value, '$[3]') as bearing
+            from   json_each(?)
+        ) r
+        cross join link_qk q on {quadkey_join} and q.sector = r.sector
         inner join link l on l.link_id = q.link_id
-        where      q.quadkey = ? and l.bearing > 0 and cos(radians(l.bearing - ?)) >= ?;
+        where      l.bearing > 0 and cos(radians(l.bearing - r.bearing)) >= ?
+        order by   l.traj_id, l.signal_ini;
         """
         db = EVedDb()
-        links = set()
-        for qk, bearing in qks:
-            links.update(db.query(sql, [qk, bearing, cos_angle_delta]))
-        return np.array(list(links))
-
-    def get_matching_trajectories(self, level=20, angle_delta=2.5):
-        links = self.get_overlapping_links(level, angle_delta)
-        trajectories = np.unique(links[:, 1])
+        rows = db.query(sql, [json.dumps(probes), math.cos(math.radians(angle_delta))])
+        return np.array(rows, dtype=LINK_DTYPE)
+
+    def get_matching_trajectories(self, level=LINK_QK_LEVEL, angle_delta=2.5, postings: LinkPostings = None):
+        links = self.get_overlapping_links(level, angle_delta, postings)
+        trajectories = np.unique(links["traj_id"])
         return trajectories, links
 
-    def get_overlapping_signal_ranges(self, level=20, angle_delta=2.5):
-        trajectories, links = self.get_matching_trajectories(level, angle_delta)
+    def get_overlapping_signal_ranges(self, level=LINK_QK_LEVEL, angle_delta=2.5, postings: LinkPostings = None):
+        trajectories, links = self.get_matching_trajectories(level, angle_delta, postings)
 
         ranges = []
         for t in trajectories:
-            index = links[:, 1] == t
+            index = links["traj_id"] == t
 
-            signal_ini = links[index, 2]
-            signal_end = links[index, 3]
+            signal_ini = links["signal_ini"][index]
+            signal_end = links["signal_end"][index]
             ranges.extend(get_contiguous_ranges(signal_ini, signal_end).tolist())
         return ranges
 
-    def calculate_trajectory_matches(self, level=20):
-        trajectories, links = self.get_matching_trajectories(level)
+    def calculate_trajectory_matches(self, level=LINK_QK_LEVEL, store: QuadkeySetStore = None,
+                                     postings: LinkPostings = None):
+        """
+        Scores the trajectories that overlap the route
+        :param level: Detail level of the overlap search. The similarities
+            are always between LINK_QK_LEVEL quadkey sets.
+        :return: List of (traj_id, similarity) tuples
+        """
+        trajectories, links = self.get_matching_trajectories(level, postings=postings)
+
+        route_qks = {qk[0] for qk in self.get_route_quadkeys(LINK_QK_LEVEL)}
+        similarities = calculate_jaccard_similarities(route_qks, trajectories, store)
+        return list(zip(trajectories, similarities))
 
+    def get_similar_trajectories(self, index: MinHashIndex, level=LINK_QK_LEVEL, top_k=10, exact=False,
+                                 store: QuadkeySetStore = None):
+        """
+        Finds the trajectories most similar to the route's quadkey set
+        through a MinHash index, without scanning the candidates
+        :param index: MinHash index of the trajectory quadkey sets
+        :param level: Quadkey detail level
+        :param top_k: Number of results
+        :param exact: Re-rank a shortlist with the exact Jaccard similarity
+        :param store: Encoded quadkey sets, for the exact re-ranking
+        :return: List of (traj_id, similarity) tuples by decreasing similarity
+        """
         route_qks = {qk[0] for qk in self.get_route_quadkeys(level)}
-        data = []
-        for trajectory in trajectories:
-            traj_qks = load_trajectory_quadkeys(int(trajectory))
-            similarity = jaccard_similarity(traj_qks, route_qks)
-            data.append((trajectory, similarity))
-        return data
-
-    def get_top_match_trajectories(self, level=20, top=0.05):
-        match_df = pd.DataFrame(data=self.calculate_trajectory_matches(level), columns=['traj_id', 'similarity'])
+        signature = index.signature(np.array(sorted(route_qks), dtype=np.int64))
+        return rank_similar_trajectories(index, signature,
+                                         query_set=route_qks if exact else None,
+                                         top_k=top_k,
+                                         store=store)
+
+    def get_top_match_trajectories(self, level=LINK_QK_LEVEL, top=0.05, store: QuadkeySetStore = None,
+                                   postings: LinkPostings = None):
+        match_df = pd.DataFrame(data=self.calculate_trajectory_matches(level, store, postings),
+                                columns=['traj_id', 'similarity'])
         match_df["percent_rank"] = match_df["similarity"].rank(pct=True)
 
         filtered_df = match_df[match_df["percent_rank"] > (1.0 - top)]
@@ -219,25 +499,46 @@ class GraphRoute(object):
         return trajectories
 
 
-def load_matching_links(traj_id, angle_delta=2.5):
+def load_matching_links(traj_id, angle_delta=2.5, postings: LinkPostings = None):
+    """
+    Finds the links that share a quadkey with a link of the trajectory,
+    within angle_delta of its bearing
+    :param postings: Link posting lists, merged in memory instead of
+        self-joining link_qk
+    :return: DataFrame with the link_id, quadkey and traj_id of the matches
+    """
+    if postings is not None:
+        quadkeys, bearings = postings.get_trajectory_links(traj_id)
+        link_ids, quadkeys, traj_ids = postings.match(quadkeys, bearings, angle_delta)
+        return pd.DataFrame({"link_id": link_ids, "quadkey": quadkeys, "traj_id": traj_ids})
+
     db = EVedDb()
 
-    sql = """
+    # Join each link quadkey of the trajectory to the same quadkey in the
+    # neighbouring sectors only, then refine on the exact bearing. The cross
+    # joins fix the join order, so link_qk is probed on (quadkey, sector).
+    span = bearing_sector_span(angle_delta)
+    offsets = sorted({d % BEARING_SECTORS for d in range(-span, span + 1)})
+
+    sql = f"""
+    with sector_offset (d) as (values {", ".join(["(?)"] * len(offsets))})
     select     q.link_id
     ,          q.quadkey
     ,          l.traj_id
-    from       link_qk q
-    inner join link l on l.link_id = q.link_id
-    inner join (
+    from       (
         select     qk.quadkey
+        ,          qk.sector
         ,          lk.bearing
         from       link_qk qk
         inner join link lk on lk.link_id = qk.link_id
-        where      lk.traj_id = ?
-    ) x on x.quadkey = q.quadkey
-    where l.bearing > 0 and x.bearing > 0 and cos(radians(x.bearing - l.bearing)) >= cos(radians(?));
+        where      lk.traj_id = ? and lk.bearing > 0
+    ) x
+    cross join sector_offset o
+    cross join link_qk q on q.quadkey = x.quadkey and q.sector = (x.sector + o.d) % ?
+    inner join link l on l.link_id = q.link_id
+    where l.bearing > 0 and cos(radians(x.bearing - l.bearing)) >= cos(radians(?));
     """
-    traj_df = db.query_df(sql, [traj_id, angle_delta])
+    traj_df = db.query_df(sql, [*offsets, traj_id, BEARING_SECTORS, angle_delta])
     return traj_df
 
 
@@ -247,27 +548,60 @@ class GraphTrajectory(object):
         assert isinstance(traj_id, int)
         self.traj_id = int(traj_id)
 
-    def get_top_matching_trajectories(self, top=0.05, exclude_self=True):
-        df = load_matching_links(self.traj_id)
+    def get_top_matching_trajectories(self, top=0.05, exclude_self=True, postings: LinkPostings = None):
+        df = load_matching_links(self.traj_id, postings=postings)
 
-        query_set = set(df[df["traj_id"] == self.traj_id]["quadkey"].values)
+        query_set = np.unique(df[df["traj_id"] == self.traj_id]["quadkey"].values)
 
         if exclude_self:
             df = df[df["traj_id"] != self.traj_id]
 
-        trajectories = np.unique(df["traj_id"].values)
+        # Jaccard similarities of all the trajectories at once, from their
+        # distinct matched quadkeys
+        pairs = df[["traj_id", "quadkey"]].drop_duplicates()
+        inter = pairs[pairs["quadkey"].isin(query_set)].groupby("traj_id").size()
+        size = pairs.groupby("traj_id").size()
+
+        trajectories = size.index.values
+        inter = inter.reindex(size.index, fill_value=0).values
         traj_df = pd.DataFrame(data=trajectories, columns=["traj_id"])
-        traj_df["similarity"] = [jaccard_similarity(query_set,
-                                                    set(df[df["traj_id"] == t]["quadkey"].values))
-                                 for t in trajectories]
+        traj_df["similarity"] = inter / (query_set.shape[0] + size.values - inter)
         traj_df["percent_rank"] = traj_df["similarity"].rank(pct=True)
 
         filtered_df = traj_df[traj_df["percent_rank"] > (1.0 - top)]
         trajectories = filtered_df["traj_id"].values
         return trajectories
 
-    def get_matching_links(self, exclude_self=True):
-        df = load_matching_links(self.traj_id)
+    def get_similar_trajectories(self, index: MinHashIndex, top_k=10, exact=False, exclude_self=True,
+                                 store: QuadkeySetStore = None):
+        """
+        Finds the trajectories most similar to this one through a MinHash
+        index, using its precomputed signature
+        :param index: MinHash index of the trajectory quadkey sets
+        :param top_k: Number of results
+        :param exact: Re-rank a shortlist with the exact Jaccard similarity
+        :param exclude_self: Leave this trajectory out of the results
+        :param store: Encoded quadkey sets, for the exact re-ranking and
+            instead of querying the trajectory's own quadkeys
+        :return: List of (traj_id, similarity) tuples by decreasing similarity
+        """
+        query_set = None
+        if store is not None:
+            query_set = set(store.get(self.traj_id).tolist())
+        elif exact or index.get_signature(self.traj_id) is None:
+            query_set = load_trajectory_quadkeys(self.traj_id)
+
+        signature = index.get_signature(self.traj_id)
+        if signature is None:
+            signature = index.signature(np.array(sorted(query_set), dtype=np.int64))
+        return rank_similar_trajectories(index, signature,
+                                         query_set=query_set if exact else None,
+                                         top_k=top_k,
+                                         exclude=self.traj_id if exclude_self else None,
+                                         store=store)
+
+    def get_matching_links(self, exclude_self=True, postings: LinkPostings = None):
+        df = load_matching_links(self.traj_id, postings=postings)
 
         if exclude_self:
             df = df[df["traj_id"] != self.traj_id]
@@ -0,0 +1,130 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from tqdm import tqdm
+from db.api import EVedDb
+from tools import parallel_imap
+
+
+COLUMNS = ['DayNum', 'VehId', 'Trip', 'Timestamp(ms)', 'Latitude[deg]',
+           'Longitude[deg]', 'Vehicle Speed[km/h]', 'MAF[g/sec]',
+           'Engine RPM[RPM]', 'Absolute Load[%]', 'OAT[DegC]', 'Fuel Rate[L/hr]',
+           'Air Conditioning Power[kW]', 'Air Conditioning Power[Watts]',
+           'Heater Power[Watts]', 'HV Battery Current[A]', 'HV Battery SOC[%]',
+           'HV Battery Voltage[V]', 'Short Term Fuel Trim Bank 1[%]',
+           'Short Term Fuel Trim Bank 2[%]', 'Long Term Fuel Trim Bank 1[%]',
+           'Long Term Fuel Trim Bank 2[%]', 'Elevation Raw[m]',
+           'Elevation Smoothed[m]', 'Gradient', 'Energy_Consumption',
+           'Matchted Latitude[deg]', 'Matched Longitude[deg]', 'Match Type',
+           'Class of Speed Limit', 'Speed Limit[km/h]',
+           'Speed Limit with Direction[km/h]', 'Intersection', 'Bus Stops',
+           'Focus Points']
+
+TYPES = {'DayNum': np.float64,
+         'VehId': np.int64,
+         'Trip': np.int64,
+         'Timestamp(ms)': np.int64,
+         'Latitude[deg]': np.float64,
+         'Longitude[deg]': np.float64,
+         'Vehicle Speed[km/h]': np.float64,
+         'MAF[g/sec]': np.float64,
+         'Engine RPM[RPM]': np.float64,
+         'Absolute Load[%]': np.float64,
+         'OAT[DegC]': np.float64,
+         'Fuel Rate[L/hr]': np.float64,
+         'Air Conditioning Power[kW]': np.float64,
+         'Air Conditioning Power[Watts]': np.float64,
+         'Heater Power[Watts]': np.float64,
+         'HV Battery Current[A]': np.float64,
+         'HV Battery SOC[%]': np.float64,
+         'HV Battery Voltage[V]': np.float64,
+         'Short Term Fuel Trim Bank 1[%]': np.float64,
+         'Short Term Fuel Trim Bank 2[%]': np.float64,
+         'Long Term Fuel Trim Bank 1[%]': np.float64,
+         'Long Term Fuel Trim Bank 2[%]': np.float64,
+         'Elevation Raw[m]': np.float64,
+         'Elevation Smoothed[m]': np.float64,
+         'Gradient': np.float64,
+         'Energy_Consumption': np.float64,
+         'Matchted Latitude[deg]': np.float64,
+         'Matched Longitude[deg]': np.float64,
+         'Match Type': np.int32,
+         'Class of Speed Limit': np.float64,
+         'Speed Limit[km/h]': str,
+         'Speed Limit with Direction[km/h]': np.float64,
+         'Intersection': np.float32,
+         'Bus Stops': np.float32,
+         'Focus Points': str
+         }
+
+
+class SemicolonFilter(object):
+    """
+    Read-only file wrapper that strips the stray semicolons of the eVED CSV
+    files while pandas streams them, so the files never have to be fully
+    loaded and rewritten in memory.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, size=-1):
+        return self.file.read(size).replace(";", "")
+
+    def __iter__(self):
+        return (line.replace(";", "") for line in self.file)
+
+
+def read_signal_chunks(filename, chunk_size=250_000):
+    """
+    Stream-parses an eVED CSV file
+    :param filename: CSV file name
+    :param chunk_size: Number of rows per chunk
+    :return: Generator of DataFrames with the columns in signal table order
+    """
+    with open(filename, "r") as f:
+        reader = pd.read_csv(SemicolonFilter(f), usecols=COLUMNS,
+                             dtype=TYPES, chunksize=chunk_size)
+        for df in reader:
+            yield df[COLUMNS]
+
+
+def parse_signal_file(filename, chunk_size=250_000):
+    """
+    Worker function: parses a whole CSV file into signal row lists
+    :param filename: CSV file name
+    :param chunk_size: Number of rows per chunk
+    :return: List of signal row lists, one per chunk
+    """
+    return [list(df.itertuples(index=False, name=None))
+            for df in read_signal_chunks(filename, chunk_size)]
+
+
+def parse_files(files, n_jobs=8):
+    """
+    Parses the CSV files in parallel worker processes and yields the parsed
+    chunks in completion order
+    """
+    for chunks in parallel_imap(parse_signal_file, files, n_jobs=n_jobs):
+        yield from chunks
+
+
+def get_csv_files(data_path):
+    return sorted([os.path.join(data_path, file) for file in os.listdir(data_path)
+                   if file.endswith(".csv")])
+
+
+def main():
+    data_path = sys.argv[1] if len(sys.argv) > 1 else "./data/eVED"
+    files = get_csv_files(data_path)
+
+    db = EVedDb()
+    chunks = parse_files(files)
+    row_count = db.bulk_insert_signals(tqdm(chunks, unit="chunk"))
+    print(f"Inserted {row_count} signals from {len(files)} files")
+
+
+if __name__ == "__main__":
+    main()
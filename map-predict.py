@@ -8,7 +8,7 @@ from valhalla.utils import decode_polyline
 
 from common.streamlit import fit_map
 from geo.mapping import map_match
-from valhalla import Actor, get_config
+from geo.matching import get_worker_actor
 
 from streamlit_folium import st_folium
 from db.api import TrajDb
@@ -17,14 +17,14 @@ from folium.vector_layers import PolyLine
 from collections import Counter
 
 
-def get_hex_location(h: int) -> tuple[float, float]:
-    db = TrajDb()
+def get_hex_location(db: TrajDb, h: int) -> tuple[float, float]:
     sql = "select lat, lon from h3_node where h3=?"
     return db.query(sql, [h])[0]
 
 
 def locations_from_hex_list(hex_list: np.ndarray) -> list[(float, float)]:
-    return [get_hex_location(int(h)) for h in hex_list]
+    with TrajDb(persistent=True) as db:
+        return [get_hex_location(db, int(h)) for h in hex_list]
 
 
 class PredictedPath:
@@ -194,12 +194,10 @@ def predict(max_branch: int = 3,
 def handle_map_data(map_data: dict):
     st.session_state["map_data"] = map_data
 
-    config = get_config(tile_extract='./valhalla/custom_files/valhalla_tiles.tar', verbose=True)
-
     if "all_drawings" in map_data and map_data["all_drawings"]:
         for drawing in map_data["all_drawings"]:
             if drawing["type"] == "Feature" and drawing["geometry"]["type"] == "LineString":
-                actor = Actor(config)
+                actor = get_worker_actor()
                 path = map_match(actor, drawing["geometry"]["coordinates"])
                 # st.write(decode_polyline(path))
                 hex_list = [h3.geo_to_h3(lat, lng, 15) for lng, lat in decode_polyline(path)]
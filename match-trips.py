@@ -1,9 +1,9 @@
 import h3.api.numpy_int as h3
-import pandas as pd
 from valhalla.utils import decode_polyline
 
 from db.api import EVedDb, TrajDb
-from valhalla import Actor, get_config
+from db.queue import WorkQueue
+from geo.matching import match_trajectories
 
 
 def get_max_traj_id() -> int:
@@ -14,15 +14,11 @@ def get_max_traj_id() -> int:
     return n
 
 
-def get_max_match() -> int:
+def get_matched_ids() -> set[int]:
     db = TrajDb()
 
-    sql = "select max(traj_id) from traj_match;"
-    n = db.query_scalar(sql)
-    if n is None:
-        return 0
-    else:
-        return int(n)
+    sql = "select traj_id from traj_match;"
+    return set(r[0] for r in db.query(sql))
 
 
 def load_trajectory_points(traj_id):
@@ -49,24 +45,23 @@ def get_traj_nodes(traj_id: int) -> list[int]:
     return nodes
 
 
-def insert_geometry(traj_id: int,
+def insert_geometry(db: TrajDb,
+                    traj_id: int,
                     geometry: str) -> None:
-    db = TrajDb()
     sql = "insert into traj_match (traj_id, geometry) values (?, ?)"
     db.execute_sql(sql, [traj_id, geometry])
 
 
-def insert_error(traj_id: int,
+def insert_error(db: TrajDb,
+                 traj_id: int,
                  error: str) -> None:
-    db = TrajDb()
-
     sql = "insert into traj_match (traj_id, match_error) values (?, ?)"
     db.execute_sql(sql, [traj_id, error])
 
 
-def insert_h3(traj_id: int,
+def insert_h3(db: TrajDb,
+              traj_id: int,
               h3_list: list[int]) -> None:
-    db = TrajDb()
     sql = "insert into traj_h3 (traj_id, h3) values (?, ?)"
 
     params = [[traj_id, int(h)] for h in h3_list]
@@ -74,50 +69,20 @@ def insert_h3(traj_id: int,
     db.execute_sql(sql, params, many=True)
 
 
-def insert_triples(traj_id: int,
+def insert_triples(db: TrajDb,
+                   traj_id: int,
                    triples: list[(int,int,int)]):
-    db = TrajDb()
     sql = "insert into triple (traj_id, t0, t1, t2) values (?, ?, ?, ?)"
     params = [(traj_id, t0, t1, t2) for t0, t1, t2 in triples]
     db.execute_sql(sql, params, many=True)
 
 
-def insert_h3_nodes(h3_nodes: list[tuple[int,tuple[float,float]]]):
-    db = TrajDb()
+def insert_h3_nodes(db: TrajDb,
+                    h3_nodes: list[tuple[int,tuple[float,float]]]):
     sql = "insert or ignore into h3_node (h3, lat, lon) values (?, ?, ?)"
     db.execute_sql(sql, [(n[0], n[1][1], n[1][0]) for n in h3_nodes], many=True)
 
 
-def map_match(actor: Actor,
-              df: pd.DataFrame) -> str:
-    param = {
-        "use_timestamps": True,
-        "shortest": True,
-        "shape_match": "walk_or_snap",
-        "shape": df.to_dict(orient='records'),
-        "costing": "auto",
-        "format": "osrm",
-        "directions_options": {
-            "directions_type": "none"
-        },
-        "trace_options": {
-            "search_radius": 50,
-            "max_search_radius": 200,
-            "gps_accuracy": 10,
-            "breakage_distance": 2000,
-            "turn_penalty_factor": 1
-        },
-        "costing_options": {
-            "auto": {
-                "country_crossing_penalty": 2000.0,
-                "maneuver_penalty": 30
-            }
-        }
-    }
-    route = actor.trace_route(param)
-    return route["matchings"][0]["geometry"]
-
-
 def generate_triples(hex_list: list[int]) -> list[(int,int,int)]:
     triples = []
     if len(hex_list) > 2:
@@ -127,36 +92,76 @@ def generate_triples(hex_list: list[int]) -> list[(int,int,int)]:
     return triples
 
 
-def main():
-    tiles = './valhalla/custom_files/valhalla_tiles.tar'
-    config = get_config(tile_extract=tiles, verbose=True)
+def load_match_tasks(queue: WorkQueue, batch_size: int = 100, stale_timeout: float = None):
+    for traj_ids in queue.iterate(batch_size, older_than=stale_timeout):
+        for traj_id in traj_ids:
+            df = load_trajectory_points(traj_id)
+            yield traj_id, list(zip(df["lon"], df["lat"])), df["time"].tolist()
 
-    max_traj_id = get_max_traj_id()
-    max_match = get_max_match()
 
-    for traj_id in range(max_match + 1, max_traj_id + 1):
-        actor = Actor(config)
+def save_match(db: TrajDb,
+               traj_id: int,
+               geometry: str) -> None:
+    insert_geometry(db, traj_id, geometry)
+    if geometry is not None:
+        line = decode_polyline(geometry)[1:-1]
 
-        print(traj_id)
-        try:
-            traj_df = load_trajectory_points(traj_id)
-            geometry = map_match(actor, traj_df)
-            insert_geometry(traj_id, geometry)
-            if geometry is not None:
-                line = decode_polyline(geometry)[1:-1]
+        hex_list = [h3.geo_to_h3(lat, lng, 15) for lng, lat in line]
+
+        insert_h3(db, traj_id, hex_list)
+
+        insert_h3_nodes(db, list(zip(hex_list, line)))
+
+        triples = generate_triples(hex_list)
+        if len(triples):
+            insert_triples(db, traj_id, triples)
 
-                hex_list = [h3.geo_to_h3(lat, lng, 15) for lng, lat in line]
 
-                insert_h3(traj_id, hex_list)
+def save_results(db: TrajDb,
+                 queue: WorkQueue,
+                 results: list[tuple[int, str, str]]) -> None:
+    """
+    Saves a batch of match results and completes their jobs in a single
+    transaction. Jobs this worker no longer holds are skipped.
+    """
+    with db.transaction():
+        owned = queue.owned([traj_id for traj_id, _, _ in results])
+        done = []
+        for traj_id, geometry, error in results:
+            if traj_id not in owned:
+                continue
+            if error is None:
+                save_match(db, traj_id, geometry)
+                done.append(traj_id)
+            else:
+                insert_error(db, traj_id, error)
+                queue.fail(traj_id, error)
+        queue.complete(done)
+
+
+def main(n_jobs=8, batch_size=100, stale_timeout=600.0):
+    max_traj_id = get_max_traj_id()
+    matched = get_matched_ids()
 
-                insert_h3_nodes(list(zip(hex_list, line)))
+    db = TrajDb(persistent=True)
+    queue = WorkQueue(db, "match-trips")
+    queue.populate(traj_id for traj_id in range(1, max_traj_id + 1)
+                   if traj_id not in matched)
+    queue.requeue(older_than=stale_timeout)
 
-                triples = generate_triples(hex_list)
-                if len(triples):
-                    insert_triples(traj_id, triples)
-        except RuntimeError as e:
-            insert_error(traj_id, str(e))
-            print(e)
+    results = []
+    tasks = load_match_tasks(queue, batch_size=batch_size, stale_timeout=stale_timeout)
+    for traj_id, geometry, error in match_trajectories(tasks, n_jobs=n_jobs):
+        print(traj_id)
+        if error is not None:
+            print(error)
+        results.append((traj_id, geometry, error))
+        if len(results) == batch_size:
+            save_results(db, queue, results)
+            results = []
+    if len(results):
+        save_results(db, queue, results)
+    db.close()
 
 
 if __name__ == "__main__":
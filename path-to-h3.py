@@ -3,6 +3,7 @@ import h3.api.numpy_int as h3
 
 from pathlib import Path
 from db.api import EVedDb
+from db.queue import WorkQueue
 from geo.road import RoadNetwork, download_road_network_bbox
 from geo.trajectory import GraphRoute
 from valhalla.utils import decode_polyline
@@ -18,14 +19,10 @@ def get_geometry(traj_id: int) -> str:
     return geometry
 
 
-def get_max_traj_h3() -> int:
+def get_traj_h3_ids() -> set[int]:
     db = EVedDb()
-    sql = "select max(traj_id) from traj_h3;"
-    n = db.query_scalar(sql)
-    if n is None:
-        return 0
-    else:
-        return int(n)
+    sql = "select distinct traj_id from traj_h3;"
+    return set(r[0] for r in db.query(sql))
 
 
 def get_max_traj_id() -> int:
@@ -36,9 +33,9 @@ def get_max_traj_id() -> int:
     return n
 
 
-def insert_h3(traj_id: int,
+def insert_h3(db: EVedDb,
+              traj_id: int,
               h3_list: list[int]) -> None:
-    db = EVedDb()
     sql = "insert into traj_h3 (traj_id, h3) values (?, ?)"
 
     params = [[traj_id, int(h)] for h in h3_list]
@@ -46,8 +43,8 @@ def insert_h3(traj_id: int,
     db.execute_sql(sql, params, many=True)
 
 
-def insert_h3_node(h3_nodes: list[tuple[int,tuple[float,float]]]):
-    db = EVedDb()
+def insert_h3_node(db: EVedDb,
+                   h3_nodes: list[tuple[int,tuple[float,float]]]):
     sql = "insert or ignore into h3_node (h3, lat, lon) values (?, ?, ?)"
     db.execute_sql(sql, [(n[0], n[1][1], n[1][0]) for n in h3_nodes], many=True)
 
@@ -67,25 +64,35 @@ def load_graph():
                                               network_type="all")  # , custom_filter=f'["highway"~"{"|".join(types)}"]')
         rn = RoadNetwork(road_net)
         rn.save(file_name)
-    gr = GraphRoute(rn.graph)
+    gr = GraphRoute(arrays=rn.arrays)
     return gr
 
 
-def main():
+def main(batch_size=100, stale_timeout=600.0):
     max_traj_id = get_max_traj_id()
-    max_nodes = get_max_traj_h3()
+    converted = get_traj_h3_ids()
+
+    db = EVedDb(persistent=True)
+    queue = WorkQueue(db, "path-to-h3")
+    queue.populate(traj_id for traj_id in range(1, max_traj_id + 1)
+                   if traj_id not in converted)
+    queue.requeue(older_than=stale_timeout)
 
-    for traj_id in range(max_nodes + 1, max_traj_id + 1):
-        print(traj_id)
-        geometry = get_geometry(traj_id)
-        if geometry is not None:
-            line = decode_polyline(geometry)
+    for traj_ids in queue.iterate(batch_size, older_than=stale_timeout):
+        with db.transaction():
+            for traj_id in traj_ids:
+                print(traj_id)
+                geometry = get_geometry(traj_id)
+                if geometry is not None:
+                    line = decode_polyline(geometry)
 
-            hex_list = [h3.geo_to_h3(lat, lng, 15) for lng, lat in line]
+                    hex_list = [h3.geo_to_h3(lat, lng, 15) for lng, lat in line]
 
-            insert_h3(traj_id, hex_list)
+                    insert_h3(db, traj_id, hex_list)
 
-            insert_h3_node(list(zip(hex_list, line)))
+                    insert_h3_node(db, list(zip(hex_list, line)))
+            queue.complete(traj_ids)
+    db.close()
 
 
 if __name__ == "__main__":
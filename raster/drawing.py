@@ -67,4 +67,146 @@ def smooth_line(x0: int, y0: int, x1: int, y1: int):
             line[i, 2] = f_y
             i += 1
     return line
- 
\ No newline at end of file
+ 
+
+@jit(nopython=True)
+def smooth_line_size(x0: int, y0: int, x1: int, y1: int) -> int:
+    return 2 * (max(abs(x1 - x0), abs(y1 - y0)) + 1)
+
+
+@jit(nopython=True)
+def supercover_line_size(x0: int, y0: int, x1: int, y1: int) -> int:
+    nx = abs(x1 - x0)
+    ny = abs(y1 - y0)
+    return nx + ny + min(nx, ny) + 1
+
+
+@jit(nopython=True)
+def smooth_lines(x0: np.ndarray, y0: np.ndarray,
+                 x1: np.ndarray, y1: np.ndarray):
+    """
+    Rasterizes many segments at once with the same anti-aliased algorithm
+    as smooth_line, writing the cells straight into pre-sized buffers.
+    Cells with zero weight are dropped.
+    :param x0: Array of initial tile x coordinates
+    :param y0: Array of initial tile y coordinates
+    :param x1: Array of final tile x coordinates
+    :param y1: Array of final tile y coordinates
+    :return: Tuple with the arrays of segment indices, tile x and y
+        coordinates and weights of the rasterized cells
+    """
+    n = x0.shape[0]
+    size = 0
+    for k in range(n):
+        size += smooth_line_size(x0[k], y0[k], x1[k], y1[k])
+
+    segments = np.zeros(size, dtype=np.int64)
+    xs = np.zeros(size, dtype=np.int64)
+    ys = np.zeros(size, dtype=np.int64)
+    weights = np.zeros(size)
+
+    i = 0
+    for k in range(n):
+        ax, ay, bx, by = x0[k], y0[k], x1[k], y1[k]
+        steep = (abs(by - ay) > abs(bx - ax))
+        if steep:
+            ax, ay = ay, ax
+            bx, by = by, bx
+        if ax > bx:
+            ax, bx = bx, ax
+            ay, by = by, ay
+
+        dx = bx - ax
+        gradient = 1.0 if dx == 0 else (by - ay) / dx
+        intersect_y = ay
+        for x in range(ax, bx + 1):
+            i_y = int(intersect_y)
+            f_y = decimal_part(intersect_y)
+            r_y = 1.0 - f_y
+            intersect_y += gradient
+
+            # Both cells across the line, skipping those with zero weight
+            for y, w in ((i_y, r_y), (i_y + 1, f_y)):
+                if w > 0.0:
+                    segments[i] = k
+                    if steep:
+                        xs[i] = y
+                        ys[i] = x
+                    else:
+                        xs[i] = x
+                        ys[i] = y
+                    weights[i] = w
+                    i += 1
+    return segments[:i], xs[:i], ys[:i], weights[:i]
+
+
+@jit(nopython=True)
+def supercover_lines(x0: np.ndarray, y0: np.ndarray,
+                     x1: np.ndarray, y1: np.ndarray):
+    """
+    Rasterizes many segments at once, listing every cell that each segment
+    (drawn between cell centers) passes through. When a segment crosses a
+    cell corner exactly, both cells beside the corner are included. All the
+    cells have unit weight.
+    :param x0: Array of initial tile x coordinates
+    :param y0: Array of initial tile y coordinates
+    :param x1: Array of final tile x coordinates
+    :param y1: Array of final tile y coordinates
+    :return: Tuple with the arrays of segment indices, tile x and y
+        coordinates and weights of the rasterized cells
+    """
+    n = x0.shape[0]
+    size = 0
+    for k in range(n):
+        size += supercover_line_size(x0[k], y0[k], x1[k], y1[k])
+
+    segments = np.zeros(size, dtype=np.int64)
+    xs = np.zeros(size, dtype=np.int64)
+    ys = np.zeros(size, dtype=np.int64)
+
+    i = 0
+    for k in range(n):
+        x = x0[k]
+        y = y0[k]
+        nx = abs(x1[k] - x)
+        ny = abs(y1[k] - y)
+        step_x = 1 if x1[k] > x else -1
+        step_y = 1 if y1[k] > y else -1
+
+        segments[i] = k
+        xs[i] = x
+        ys[i] = y
+        i += 1
+
+        ix = 0
+        iy = 0
+        while ix < nx or iy < ny:
+            decision = (1 + 2 * ix) * ny - (1 + 2 * iy) * nx
+            if decision == 0:
+                # Exact corner crossing: include both side cells
+                segments[i] = k
+                xs[i] = x + step_x
+                ys[i] = y
+                i += 1
+
+                segments[i] = k
+                xs[i] = x
+                ys[i] = y + step_y
+                i += 1
+
+                x += step_x
+                y += step_y
+                ix += 1
+                iy += 1
+            elif decision < 0:
+                x += step_x
+                ix += 1
+            else:
+                y += step_y
+                iy += 1
+
+            segments[i] = k
+            xs[i] = x
+            ys[i] = y
+            i += 1
+    return segments[:i], xs[:i], ys[:i], np.ones(i)
@@ -5,12 +5,11 @@ import os
 
 import pandas as pd
 
-from geo.mapping import map_match
+from geo.matching import match_trajectories
 from geo.math import vec_haversine, num_haversine, outer_haversine
 from geo.road import RoadNetwork
 from db.api import TrajDb, EVedDb
 from valhalla.utils import decode_polyline
-from valhalla import Actor, get_config
 from dataclasses import dataclass
 
 
@@ -224,27 +223,38 @@ def get_segment_average_speed(trip_ids: list[int],
     return seg_avg
 
 
-def main() -> None:
+def load_edge_tasks(rn: RoadNetwork):
+    arrays = rn.arrays
+    for i in range(arrays.edge_u.shape[0]):
+        lo, hi = arrays.geometry_offsets[i], arrays.geometry_offsets[i + 1]
+        if hi > lo:
+            edge_id = (rn.ids[arrays.edge_u[i]], rn.ids[arrays.edge_v[i]], arrays.edge_keys[i])
+            coords = list(zip(arrays.geometry_lons[lo:hi], arrays.geometry_lats[lo:hi]))
+            yield edge_id, coords, None
+
+
+def main(n_jobs=8) -> None:
     rn = load_road_network()
     tiles = './valhalla/custom_files/valhalla_tiles.tar'
-    config = get_config(tile_extract=tiles, verbose=True)
-
-    for edge_id in rn.graph.edges:
-        edge = rn.graph.edges[edge_id]
-        if "geometry" in edge:
-            print(f"Edge: {edge_id}")
-            actor = Actor(config)
-            ll = decode_polyline(map_match(actor, list(edge['geometry'].coords)))
-            nodes = [int(h3.geo_to_h3(p[1], p[0], 15)) for p in ll]
-
-            num_nodes = len(nodes)
-            if num_nodes > 2:
-                trip_ids = get_trips_for_nodes(nodes)
-                node_locations = get_nodes_locations(nodes)
-
-                if len(node_locations) > 1:
-                    seg_avg = get_segment_average_speed(trip_ids, node_locations)
-                    print(seg_avg)
+
+    for edge_id, geometry, error in match_trajectories(load_edge_tasks(rn), n_jobs=n_jobs,
+                                                       tile_extract=tiles):
+        print(f"Edge: {edge_id}")
+        if error is not None:
+            print(error)
+            continue
+
+        ll = decode_polyline(geometry)
+        nodes = [int(h3.geo_to_h3(p[1], p[0], 15)) for p in ll]
+
+        num_nodes = len(nodes)
+        if num_nodes > 2:
+            trip_ids = get_trips_for_nodes(nodes)
+            node_locations = get_nodes_locations(nodes)
+
+            if len(node_locations) > 1:
+                seg_avg = get_segment_average_speed(trip_ids, node_locations)
+                print(seg_avg)
 
 
 if __name__ == "__main__":
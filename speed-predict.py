@@ -1,10 +1,11 @@
 from itertools import pairwise
 
+import numpy as np
 import streamlit as st
 import folium
 import h3.api.numpy_int as h3
 
-from common.mapspeed import get_edge_times, update_dt_and_speed
+from common.mapspeed import EdgeTimeModel, update_dt_and_speed
 from common.streamlit import fit_map
 from folium import FeatureGroup
 from folium.plugins import Draw
@@ -51,13 +52,24 @@ def get_actor() -> Actor:
     return actor
 
 
+@st.cache_resource
+def get_edge_time_model() -> EdgeTimeModel:
+    return EdgeTimeModel.load()
+
+
 def time_maneuvers(maneuvers: list) -> list:
+    model = get_edge_time_model()
     for m in maneuvers:
         total_map_time = 0.0
         total_avg_time = 0.0
         total_med_time = 0.0
 
         locations = m["locations"]
+
+        # Price the whole leg in one lookup, edge i joins locations i and i + 1
+        h3_cells = np.array([h3.geo_to_h3(*loc, 15) for loc in locations], dtype=np.int64)
+        edge_times = model.get_edge_times(h3_cells[:-1], h3_cells[1:])
+
         for step in m["steps"]:
             ix_ini = step["begin_shape_index"]
             ix_end = step["end_shape_index"]
@@ -70,10 +82,7 @@ def time_maneuvers(maneuvers: list) -> list:
                 loc0 = locations[i0]
                 loc1 = locations[i1]
 
-                h3_ini = h3.geo_to_h3(*loc0, 15)
-                h3_end = h3.geo_to_h3(*loc1, 15)
-
-                min_dt, avg_dt, med_dt, max_dt, n = get_edge_times(h3_ini, h3_end)
+                min_dt, avg_dt, med_dt, max_dt = [float(times[i0]) for times in edge_times[:4]]
 
                 d = num_haversine(*loc0, *loc1)
                 avg_dt, avg_speed = update_dt_and_speed(d, avg_dt, avg_speed)
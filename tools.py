@@ -1,4 +1,4 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from tqdm import tqdm
 
@@ -62,3 +62,55 @@ def parallel_process(array,
         except Exception as e:
             out.append(e)
     return front + out
+
+
+def parallel_imap(function,
+                  array,
+                  n_jobs=16,
+                  use_kwargs=False,
+                  max_in_flight=None):
+    """
+        A parallel version of the map function that yields the results in
+        completion order, keeping at most max_in_flight tasks submitted at
+        any time so that a single consumer can stream them without the
+        results piling up in memory.
+
+        Args:
+            function (function):
+                A python function to apply to the elements of array
+            array (iterable): The arguments to iterate over.
+            n_jobs (int, default=16): The number of cores to use
+            use_kwargs (boolean, default=False):
+                Whether to consider the elements of array as dictionaries of
+                keyword arguments to function
+            max_in_flight (int, default=2 * n_jobs):
+                The maximum number of submitted but not yet consumed tasks
+        Returns:
+            Generator of function(a) results
+    """
+    if n_jobs == 1:
+        for a in array:
+            yield function(**a) if use_kwargs else function(a)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_jobs
+
+    def submit(pool, a):
+        return pool.submit(function, **a) if use_kwargs else pool.submit(function, a)
+
+    pending = set()
+    arg_iter = iter(array)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for a in arg_iter:
+            pending.add(submit(pool, a))
+            if len(pending) >= max_in_flight:
+                break
+
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for a in arg_iter:
+                    pending.add(submit(pool, a))
+                    break
+                yield future.result()